@@ -0,0 +1,152 @@
+import json
+import os
+import logging
+import functions_framework
+from flask import make_response
+from google.cloud import firestore
+from dingdoor_utils_package.auth import Unauthorized, verified_uid
+from dingdoor_utils_package.responses import finalize_response
+from dingdoor_utils_package.signing import sign_attachments
+from dingdoor_utils_package.timing import finish_request, request_timer, timed
+from utils.message_pages import (
+    InvalidCursor, bucket_and_path, decode_cursor, encode_cursor, needs_resign, page_size, projection,
+)
+
+AI_ASSISTANT_CHATS = os.getenv("AI_ASSISTANT_CHATS_COLLECTION", "aiAssistantChats")
+ROOT_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
+# pages change with every turn: clients keep them but revalidate (304 when unchanged)
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "private, no-cache")
+
+_db = None
+def get_db():
+    global _db
+    if _db is None:
+        _db = firestore.Client()
+    return _db
+
+
+def add_cors(resp):
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+    resp.headers["Access-Control-Allow-Headers"] = "Authorization, *"  # "*" alone does not cover Authorization
+    resp.headers["Access-Control-Expose-Headers"] = "Server-Timing, ETag"
+    resp.headers["Timing-Allow-Origin"] = "*"
+    return resp
+
+
+def _json(body, status=200):
+    resp = make_response(json.dumps(body), status)
+    resp.headers["Content-Type"] = "application/json"
+    return add_cors(resp)
+
+
+def _resign_attachments(messages):
+    """
+    Signs again, in the response only, the attachment URLs that are missing or close
+    to expiry. Nothing is written back: a GET never modifies the messages.
+    """
+    stale = {}  # bucket -> attachments to sign
+    previous = {}  # id(attachment) -> URL kept if signing fails
+    for message in messages:
+        for a in message.get("attachments") or []:
+            if isinstance(a, dict) and needs_resign(a):
+                bucket, path = bucket_and_path(a)
+                previous[id(a)] = a.get("url")
+                a["storagePath"] = path
+                a["url"] = None
+                stale.setdefault(bucket, []).append(a)
+    if not stale:
+        return
+    with timed("resign"):
+        for bucket, attachments in stale.items():
+            sign_attachments(bucket, attachments)
+            for a in attachments:
+                a["url"] = a["url"] or previous[id(a)]
+
+
+@functions_framework.http
+def ai_get_text_assistant_messages(request):
+    """
+    Pages a chat's messages newest-first.
+
+      GET ?chatId=...[&userId=...][&limit=30][&cursor=...][&fields=tokenUsage,eventData|*][&count=true]
+
+    Response: {"messages": [...newest first], "nextCursor": "..." | null[, "totalMessageCount": n]}
+    Callers send `Authorization: Bearer <Firebase ID token>`; the chat must belong to
+    the token's uid (a `userId` parameter, if sent, must be that uid too).
+    Pass `nextCursor` back as `cursor` for the next (older) page. Messages carry the
+    default fields only; `fields` adds tokenUsage/eventData, `*` returns whole documents.
+    Attachment URLs expiring within RESIGN_BEFORE_EXPIRY_SECONDS are signed again (in the response only).
+    `count=true` adds the chat's totalMessageCount (no extra read).
+    Each page costs one chat read (ownership) plus `limit` + 1 message reads, whatever the chat length.
+    Pages carry an ETag; a matching `If-None-Match` gets an empty 304.
+    """
+    if request.method == "OPTIONS":
+        return add_cors(make_response("", 204))
+    with request_timer("ai_get_text_assistant_messages") as timer:
+        response = _handle(request)
+        with timed("encode"):
+            response = finalize_response(request, response, etag=True, cache_control=CACHE_CONTROL)
+        return finish_request(timer, response)
+
+
+def _handle(request):
+    if request.method != "GET":
+        return _json({"error": "Method not allowed"}, 405)
+    try:
+        args = request.args
+        try:
+            user_id = verified_uid(request)
+        except Unauthorized as e:
+            return _json({"error": str(e)}, 401)
+        chat_id = args.get("chatId") or args.get("id")
+        if not chat_id:
+            return _json({"error": "chatId is required"}, 400)
+        if args.get("userId") and args["userId"] != user_id:
+            return _json({"error": "userId does not match the ID token"}, 403)
+        try:
+            limit = page_size(args.get("limit"))
+            fields = projection(args.get("fields"))
+            start_after = decode_cursor(args["cursor"]) if args.get("cursor") else None
+        except (InvalidCursor, ValueError) as e:
+            return _json({"error": str(e)}, 400)
+
+        with_count = (args.get("count") or "").lower() == "true"
+        db = get_db()
+        chat_ref = db.collection(AI_ASSISTANT_CHATS).document(chat_id)
+        with timed("chat_read"):
+            chat_snap = chat_ref.get(field_paths=["userId", "totalMessageCount"] if with_count else ["userId"])
+        if not chat_snap.exists:
+            return _json({"error": "Chat not found"}, 404)
+        if (chat_snap.to_dict() or {}).get("userId") != user_id:
+            return _json({"error": "Chat does not belong to this user"}, 403)
+
+        query = (
+            db.collection(ROOT_COLLECTION).document(chat_id).collection("messages")
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .order_by("__name__", direction=firestore.Query.DESCENDING)
+        )
+        if fields is not None:
+            query = query.select(fields)
+        if start_after is not None:
+            query = query.start_after(start_after)
+        with timed("messages_read"):
+            docs = list(query.limit(limit + 1).get())
+
+        has_more = len(docs) > limit
+        docs = docs[:limit]
+        messages = [{"id": doc.id, **(doc.to_dict() or {})} for doc in docs]
+        _resign_attachments(messages)
+
+        last = docs[-1] if has_more else None
+        body = {
+            "messages": messages,
+            "nextCursor": encode_cursor((last.to_dict() or {}).get("timestamp"), last.id) if last is not None else None,
+        }
+        if with_count:
+            body["totalMessageCount"] = (chat_snap.to_dict() or {}).get("totalMessageCount") or 0
+        return _json(body)
+
+    except Exception as e:
+        logging.exception("ai_get_text_assistant_messages failed")
+        return _json({"error": str(e)}, 500)
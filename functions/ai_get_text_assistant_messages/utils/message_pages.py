@@ -0,0 +1,92 @@
+import os
+import base64
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE_DEFAULT = int(os.getenv("MESSAGES_PAGE_SIZE", "30"))
+PAGE_SIZE_MAX = int(os.getenv("MESSAGES_PAGE_SIZE_MAX", "100"))
+# fields returned unless `fields` asks for more (tokenUsage/eventData are the heavy ones)
+DEFAULT_MESSAGE_FIELDS = [
+    f.strip() for f in os.getenv(
+        "MESSAGE_DEFAULT_FIELDS", "id,role,content,timestamp,attachments,event,isCxInteraction,rate,summarized"
+    ).split(",") if f.strip()
+]
+OPTIONAL_MESSAGE_FIELDS = {"tokenUsage", "eventData"}
+# attachment URLs expiring within this window are signed again when a page is read
+RESIGN_BEFORE_EXPIRY_SECONDS = int(os.getenv("RESIGN_BEFORE_EXPIRY_SECONDS", str(6 * 3600)))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp: Any, doc_id: str) -> str:
+    """Opaque page cursor: the (timestamp, document id) of the last message returned."""
+    raw = json.dumps({"t": timestamp, "id": doc_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Returns the start_after values ({"timestamp", "__name__"}) for a cursor."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(data, dict) or not isinstance(data.get("id"), str) or not data["id"]:
+            raise ValueError
+        return {"timestamp": data.get("t"), "__name__": data["id"]}
+    except ValueError:
+        raise InvalidCursor("Invalid cursor")
+
+
+def page_size(raw: Optional[str]) -> int:
+    if not raw:
+        return PAGE_SIZE_DEFAULT
+    try:
+        size = int(raw)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    return max(1, min(size, PAGE_SIZE_MAX))
+
+
+def projection(raw: Optional[str]) -> Optional[List[str]]:
+    """
+    Fields to select: the defaults plus any of OPTIONAL_MESSAGE_FIELDS named in `raw`
+    (comma separated). `*` selects whole documents (returns None).
+    """
+    requested = [f.strip() for f in (raw or "").split(",") if f.strip()]
+    if "*" in requested:
+        return None
+    unknown = [f for f in requested if f not in OPTIONAL_MESSAGE_FIELDS and f not in DEFAULT_MESSAGE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)} (allowed: {', '.join(sorted(OPTIONAL_MESSAGE_FIELDS))} or *)")
+    return DEFAULT_MESSAGE_FIELDS + [f for f in requested if f in OPTIONAL_MESSAGE_FIELDS]
+
+
+def signed_url_expiry(url: Optional[str]) -> Optional[float]:
+    """Epoch seconds at which a V4 signed URL expires (X-Goog-Date + X-Goog-Expires), or None."""
+    if not url:
+        return None
+    try:
+        params = parse_qs(urlparse(url).query)
+        signed_at = datetime.strptime(params["X-Goog-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        return signed_at.timestamp() + int(params["X-Goog-Expires"][0])
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def bucket_and_path(attachment: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    gcs_uri = attachment.get("gcsUri") or ""
+    if not gcs_uri.startswith("gs://"):
+        return None
+    bucket, _, path = gcs_uri[len("gs://"):].partition("/")
+    return (bucket, attachment.get("storagePath") or path) if bucket and path else None
+
+
+def needs_resign(attachment: Dict[str, Any], now: Optional[float] = None) -> bool:
+    """True for a stored attachment whose URL is missing, unreadable or expires within RESIGN_BEFORE_EXPIRY_SECONDS."""
+    if bucket_and_path(attachment) is None:
+        return False
+    expiry = signed_url_expiry(attachment.get("url"))
+    return expiry is None or expiry - (now or time.time()) < RESIGN_BEFORE_EXPIRY_SECONDS
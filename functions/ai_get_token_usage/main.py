@@ -0,0 +1,101 @@
+import json
+import os
+import logging
+import functions_framework
+from flask import make_response
+from google.cloud import firestore
+from dingdoor_utils_package.auth import Unauthorized, is_admin, verified_claims
+from dingdoor_utils_package.responses import finalize_response
+from dingdoor_utils_package.token_usage import (
+    CHAT_TOTALS_FIELD, CHAT_TURNS_FIELD, GLOBAL_USER, parse_day_range, read_chat_usage, read_daily_usage,
+)
+
+AI_ASSISTANT_CHATS = os.getenv("AI_ASSISTANT_CHATS_COLLECTION", "aiAssistantChats")
+# rollups move with every turn; a minute of client-side staleness saves the re-reads
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "private, max-age=60")
+
+_db = None
+def get_db():
+    global _db
+    if _db is None:
+        _db = firestore.Client()
+    return _db
+
+
+def add_cors(resp):
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.headers["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+    resp.headers["Access-Control-Allow-Headers"] = "Authorization, *"  # "*" alone does not cover Authorization
+    resp.headers["Access-Control-Expose-Headers"] = "ETag"
+    return resp
+
+
+def _json(body, status=200):
+    resp = make_response(json.dumps(body), status)
+    resp.headers["Content-Type"] = "application/json"
+    return add_cors(resp)
+
+
+@functions_framework.http
+def ai_get_token_usage(request):
+    """
+    Read API over the token usage rollups written by ai_send_text_assistant_message.
+
+      GET ?chatId=...                            -> totals of one chat (from its aiAssistantChats doc)
+      GET [?userId=...]&from=YYYY-MM-DD&to=...   -> per-day and total usage of one user
+      GET ?scope=global&from=...&to=...          -> the same for all users
+
+    Callers send `Authorization: Bearer <Firebase ID token>`. The chat or user must be
+    the token's uid (`userId` defaults to it); tokens with the ADMIN_CLAIM custom claim
+    may read any chat or user, and only they may ask for scope=global.
+    `from`/`to` are inclusive and default to the current month up to today.
+    Reads one document per chat, or days x shards documents per range; no scans.
+    Answers carry an ETag and CACHE_CONTROL; `If-None-Match` gets a 304.
+    """
+    if request.method == "OPTIONS":
+        return add_cors(make_response("", 204))
+    return finalize_response(request, _handle(request), etag=True, cache_control=CACHE_CONTROL)
+
+
+def _handle(request):
+    if request.method != "GET":
+        return _json({"error": "Method not allowed"}, 405)
+
+    try:
+        args = request.args
+        try:
+            claims = verified_claims(request)
+        except Unauthorized as e:
+            return _json({"error": str(e)}, 401)
+        uid, admin = claims["uid"], is_admin(claims)
+
+        chat_id = args.get("chatId")
+        if chat_id:
+            snap = get_db().collection(AI_ASSISTANT_CHATS).document(chat_id).get(
+                field_paths=["userId", CHAT_TOTALS_FIELD, CHAT_TURNS_FIELD]
+            )
+            if not snap.exists:
+                return _json({"error": "Chat not found"}, 404)
+            if not admin and (snap.to_dict() or {}).get("userId") != uid:
+                return _json({"error": "Chat does not belong to this user"}, 403)
+            return _json(read_chat_usage(snap))
+
+        if args.get("scope") == "global":
+            if not admin:
+                return _json({"error": "scope=global is restricted to admins"}, 403)
+            user_id = GLOBAL_USER
+        else:
+            user_id = args.get("userId") or uid
+            if user_id != uid and not admin:
+                return _json({"error": "userId does not match the ID token"}, 403)
+        try:
+            day_from, day_to = parse_day_range(args.get("from"), args.get("to"))
+        except ValueError as e:
+            return _json({"error": str(e)}, 400)
+
+        usage = read_daily_usage(get_db(), user_id, day_from, day_to)
+        return _json({"userId": None if user_id == GLOBAL_USER else user_id, **usage})
+
+    except Exception as e:
+        logging.exception("ai_get_token_usage failed")
+        return _json({"error": str(e)}, 500)
@@ -2,82 +2,225 @@ import json
 import os
 import time
 import uuid
-import mimetypes
 import logging
-import markdown
+import re
 import functions_framework
 from flask import jsonify, make_response
+from werkzeug.exceptions import RequestEntityTooLarge
+from google.api_core.exceptions import NotFound
 from google.cloud import firestore
-from google.cloud import storage
-from datetime import timedelta
-from google.auth.transport.requests import Request
-import google.auth
-from utils.ai_chat_utils import update_chat_metadata, save_messages_to_firestore
+from dingdoor_utils_package.attachments import upload_attachments
+from dingdoor_utils_package.responses import finalize_response
+from dingdoor_utils_package.timing import annotate, finish_request, register_stats, request_timer, timed
+from dingdoor_utils_package.uploads import UploadTooLarge, check_request_size, collect_uploads
+from utils.ai_chat_utils import build_message_data, save_messages_to_firestore
+from utils.bulk_messages import (
+    BULK_BATCH_SIZE, BulkRequestError, commit_messages, delete_messages, parse_bulk_messages, read_chat_owners,
+)
+from utils.chat_owner_cache import ChatOwnerCache
+from utils.markdown_renderer import render_markdown
+from utils.metadata_coalescer import METADATA_COALESCE_WINDOW_MS, METADATA_FLUSH_TIMEOUT_SECONDS, ChatMetadataCoalescer
 
 
 # env vars
 FILES_BUCKET = os.getenv("FILES_BUCKET")
 ROOT_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
 AI_ASSISTANT_CHATS = "aiAssistantChats"
+# chat ownership (userId) is cached per instance so bursts into one chat skip the chat read
+CHAT_OWNER_CACHE_TTL_SECONDS = float(os.getenv("CHAT_OWNER_CACHE_TTL_SECONDS", "60"))
+CHAT_OWNER_CACHE_MAX_CHATS = int(os.getenv("CHAT_OWNER_CACHE_MAX_CHATS", "2048"))
+
+chat_owners = ChatOwnerCache(CHAT_OWNER_CACHE_MAX_CHATS, CHAT_OWNER_CACHE_TTL_SECONDS)
+register_stats("chatOwners", chat_owners.stats)
+
+_db = None
+def get_db():
+    global _db
+    if _db is None:
+        _db = firestore.Client()
+    return _db
+
+# lastMessage/lastMessageAt + message count writes, merged per chat (see utils/metadata_coalescer.py)
+chat_metadata = ChatMetadataCoalescer(get_db, METADATA_COALESCE_WINDOW_MS / 1000)
+register_stats("chatMetadata", chat_metadata.stats)
 
 def add_cors(resp):
     resp.headers["Access-Control-Allow-Origin"] = "*"
     resp.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
     resp.headers["Access-Control-Allow-Headers"] = "*"
+    resp.headers["Access-Control-Expose-Headers"] = "Server-Timing"
+    resp.headers["Timing-Allow-Origin"] = "*"
     return resp
 
-_storage_client = None
-def _gcs():
-    global _storage_client
-    if _storage_client is None:
-        _storage_client = storage.Client()
-    return _storage_client
-
-def _upload_to_bucket(bucket_name: str, blob_path: str, data: bytes, content_type: str) -> dict:
-    bucket = _gcs().bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    blob.upload_from_string(data, content_type=content_type)
-    blob.cache_control = "public, max-age=3600"
-    blob.content_disposition = f'inline; filename="{os.path.basename(blob_path)}"'
-    blob.patch()
-
-    preview_url = None
-    try:
-        signer_email = os.getenv("SIGNED_URL_SA_EMAIL")
-        # IMPORTANT: request a token with the right scopes for IAMCredentials.signBlob
-        scopes = ["https://www.googleapis.com/auth/cloud-platform"]  # or "https://www.googleapis.com/auth/iam"
-        creds, _ = google.auth.default(scopes=scopes)
-        creds.refresh(Request())
-        access_token = creds.token
-
-        preview_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(hours=int(os.getenv("SIGNED_URL_EXPIRES_HOURS", "72"))),
-            method="GET",
-            service_account_email=signer_email,
-            access_token=access_token,
-        )
-    except Exception as e:
-        logging.warning(f"Could not generate signed URL for {blob_path}: {e}")
-
-    return {
-        "filename": os.path.basename(blob_path),
-        "contentType": content_type,
-        "bytes": len(data),
-        "storagePath": blob_path,
-        "gcsUri": f"gs://{bucket_name}/{blob_path}",
-        "url": preview_url,
-    }
-
-
 @functions_framework.http
 def ai_insert_text_assistant_message(request):
     # CORS preflight
     if request.method == "OPTIONS":
         return add_cors(make_response("", 204))
 
+    # Server-Timing header + one structured timing log record per request
+    with request_timer("ai_insert_text_assistant_message") as timer:
+        response = _handle(request)
+        with timed("encode"):
+            response = finalize_response(request, response)
+        return finish_request(timer, response)
+
+
+def _read_chat(db, conversation_id):
+    """
+    (snapshot, userId) of the chat. A cached owner costs no read and returns no
+    snapshot; otherwise this is the insert's only read (the metadata write needs none).
+    """
+    user_id = chat_owners.get(conversation_id)
+    if user_id is not None:
+        annotate(chatReads=0)
+        return None, user_id
+    snap = db.collection(AI_ASSISTANT_CHATS).document(conversation_id).get()
+    annotate(chatReads=1)
+    user_id = (snap.to_dict() or {}).get("userId") if snap.exists else None
+    if user_id:
+        chat_owners.put(conversation_id, user_id)
+    return snap, user_id
+
+
+_BULK_FILES_FIELD = re.compile(r"^files\[(\d+)\]$")
+
+
+def _bulk_files(request):
+    """Bulk multipart uploads: the files of messages[i] are sent as `files[i]`."""
+    files_by_index = {}
+    for key in request.files.keys():
+        match = _BULK_FILES_FIELD.match(key)
+        if match:
+            files_by_index[int(match.group(1))] = request.files.getlist(key)
+    return files_by_index
+
+
+def _handle_bulk(db, items, default_conversation_id, files_by_index):
+    """
+    Inserts an ordered array of messages, into one chat or several: one batched
+    ownership read for the chats not cached, the messages in chunked batch commits,
+    then one coalesced metadata write (lastMessage + one counter Increment) per chat.
+    """
+    now_ms = int(time.time() * 1000)
+    try:
+        entries = parse_bulk_messages(items, default_conversation_id, now_ms, lambda i: bool(files_by_index.get(i)))
+    except BulkRequestError as e:
+        return add_cors(make_response(json.dumps({"error": str(e)}), 400))
+    stray = sorted(i for i in files_by_index if i >= len(entries))
+    if stray:
+        return add_cors(make_response(json.dumps({"error": f"files[{stray[0]}] has no matching message"}), 400))
+
+    chat_ids = list(dict.fromkeys(entry["conversationId"] for entry in entries))
+    owners = {chat_id: chat_owners.get(chat_id) for chat_id in chat_ids}
+    uncached = [chat_id for chat_id, user_id in owners.items() if user_id is None]
+    with timed("chat_read"):
+        read = read_chat_owners(db, uncached)
+    annotate(chatReads=len(uncached), bulkMessages=len(entries), bulkChats=len(chat_ids))
+    missing = [chat_id for chat_id in uncached if chat_id not in read]
+    if missing:
+        return add_cors(make_response(json.dumps({"error": "Chat not found", "conversationIds": missing}), 404))
+    no_owner = [chat_id for chat_id, user_id in read.items() if not user_id]
+    if no_owner:
+        return add_cors(make_response(json.dumps({"error": "Chat has no userId", "conversationIds": no_owner}), 400))
+    for chat_id, user_id in read.items():
+        chat_owners.put(chat_id, user_id)
+    owners.update(read)
+
+    writes = []
+    results = []
+    for entry in entries:
+        chat_id = entry["conversationId"]
+        msg_ref = db.collection(ROOT_COLLECTION).document(chat_id).collection("messages").document()
+        attachments = []
+        files = files_by_index.get(entry["index"])
+        if FILES_BUCKET and files:
+            with timed("uploads"):
+                attachments = upload_attachments(
+                    FILES_BUCKET, f"conversations/{owners[chat_id]}/{chat_id}/{msg_ref.id}", collect_uploads(files),
+                    content_prefix=f"conversations/{owners[chat_id]}/blobs",
+                )
+        with timed("markdown"):
+            message_html = render_markdown(entry["message"]) if entry["message"] else ""
+        writes.append((msg_ref, build_message_data(
+            entry["role"], msg_ref.id, message_html, entry["timestamp"], entry["event"], entry["eventData"], attachments,
+        )))
+        results.append({
+            "index": entry["index"],
+            "conversationId": chat_id,
+            "messageId": msg_ref.id,
+            "timestamp": entry["timestamp"],
+            "attachmentsCount": len(attachments),
+        })
+
+    with timed("save"):
+        outcomes = commit_messages(db, writes)
+
+    # metadata only counts what was written; the latest message (by timestamp) becomes lastMessage
+    per_chat = {}
+    latest = {}
+    failed = []
+    for position, (entry, result) in enumerate(zip(entries, results)):
+        if outcomes[position // BULK_BATCH_SIZE] is not None:
+            failed.append(entry["index"])
+            continue
+        chat_id = entry["conversationId"]
+        last_message, count = per_chat.get(chat_id, (None, 0))
+        if chat_id not in latest or entry["timestamp"] >= latest[chat_id]:
+            latest[chat_id] = entry["timestamp"]
+            last_message = entry["message"]
+        per_chat[chat_id] = (last_message, count + 1)
+    with timed("metadata"):
+        now = int(time.time() * 1000)
+        metadata_writes = {
+            chat_id: chat_metadata.submit(chat_id, last_message, now, count)
+            for chat_id, (last_message, count) in per_chat.items()
+        }
+        gone = []
+        for chat_id, metadata_write in metadata_writes.items():
+            try:
+                metadata_write.result(timeout=METADATA_FLUSH_TIMEOUT_SECONDS)
+            except NotFound:
+                chat_owners.invalidate(chat_id)
+                gone.append(chat_id)
+
+    if gone:
+        # chats deleted since they were read (or their owner cached): take their messages back out
+        gone_set = set(gone)
+        written = [
+            (ref, entry) for position, ((ref, _), entry) in enumerate(zip(writes, entries))
+            if outcomes[position // BULK_BATCH_SIZE] is None
+        ]
+        with timed("rollback"):
+            delete_messages(db, [ref for ref, entry in written if entry["conversationId"] in gone_set])
+        kept = {entry["index"] for ref, entry in written if entry["conversationId"] not in gone_set}
+        body = {
+            "error": "Chat not found",
+            "conversationIds": gone,
+            "messages": [r for r in results if r["index"] in kept],
+        }
+        if failed:
+            body["failedIndexes"] = failed
+        return add_cors(make_response(json.dumps(body), 404))
+    if failed:
+        failed_set = set(failed)
+        return add_cors(make_response(json.dumps({
+            "error": f"{len(failed)} of {len(entries)} messages could not be written",
+            "messages": [r for r in results if r["index"] not in failed_set],
+            "failedIndexes": failed,
+        }), 500))
+    return add_cors(jsonify({
+        "success": True,
+        "count": len(results),
+        "messages": results,
+    }))
+
+
+def _handle(request):
     try:
-        db = firestore.Client()
+        check_request_size(request)
+        with timed("client"):
+            db = get_db()
 
         content_type = (request.headers.get("Content-Type") or "").lower()
         attachments = []
@@ -85,6 +228,12 @@ def ai_insert_text_assistant_message(request):
         # ---- parse input ----
         if "multipart/form-data" in content_type:
             form = request.form
+            if form.get("messages"):
+                try:
+                    items = json.loads(form["messages"])
+                except ValueError:
+                    return add_cors(make_response(json.dumps({"error": "messages is not valid JSON"}), 400))
+                return _handle_bulk(db, items, form.get("conversationId") or form.get("id"), _bulk_files(request))
 
             conversation_id = form.get("conversationId") or form.get("id") or str(uuid.uuid4())
             role = (form.get("role") or "user").strip()
@@ -93,12 +242,11 @@ def ai_insert_text_assistant_message(request):
             event_data_raw = form.get("eventData")
             event_data = json.loads(event_data_raw) if event_data_raw else {}
             
-            #fetching chat
-            chat_snap = db.collection(AI_ASSISTANT_CHATS).document(conversation_id).get()
-            if not chat_snap.exists:
+            #fetching chat (skipped while its owner is cached)
+            with timed("chat_read"):
+                chat_snap, user_id = _read_chat(db, conversation_id)
+            if chat_snap is not None and not chat_snap.exists:
                 return add_cors(make_response(json.dumps({"error": "Chat not found"}), 404))
-            chat_data = chat_snap.to_dict() or {}
-            user_id = chat_data.get("userId")
             if not user_id:
                 return add_cors(make_response(json.dumps({"error": "Chat has no userId"}), 400))
 
@@ -111,17 +259,15 @@ def ai_insert_text_assistant_message(request):
                 if not incoming:
                     incoming = list(request.files.values())
 
-                for f in incoming:
-                    blob_bytes = f.read()
-                    ctype = f.content_type or (mimetypes.guess_type(f.filename)[0] or "application/octet-stream")
-                    fname = f.filename or f"upload-{uuid.uuid4().hex}"
-                    file_list.append((fname, blob_bytes, ctype))
+                file_list = collect_uploads(incoming)
 
         else:
             if not request.is_json:
                 return add_cors(make_response(json.dumps({"error": "Missing JSON"}), 400))
 
             data = request.get_json(silent=True) or {}
+            if "messages" in data:
+                return _handle_bulk(db, data["messages"], data.get("conversationId") or data.get("id"), {})
             conversation_id = data.get("conversationId") or data.get("id") or str(uuid.uuid4())
             role = (data.get("role") or "user").strip()
             message = data.get("message")
@@ -130,12 +276,11 @@ def ai_insert_text_assistant_message(request):
             event_data = json.loads(event_data_raw) if event_data_raw else {}
             file_list = [] 
             
-            #fetching chat
-            chat_snap = db.collection(AI_ASSISTANT_CHATS).document(conversation_id).get()
-            if not chat_snap.exists:
+            #fetching chat (skipped while its owner is cached)
+            with timed("chat_read"):
+                chat_snap, user_id = _read_chat(db, conversation_id)
+            if chat_snap is not None and not chat_snap.exists:
                 return add_cors(make_response(json.dumps({"error": "Chat not found"}), 404))
-            chat_data = chat_snap.to_dict() or {}
-            user_id = chat_data.get("userId")
             if not user_id:
                 return add_cors(make_response(json.dumps({"error": "Chat has no userId"}), 400))
 
@@ -152,30 +297,41 @@ def ai_insert_text_assistant_message(request):
         msg_ref = messages_col.document()
         msg_id = msg_ref.id
         
-        #update chat metadata
-        update_chat_metadata(db, conversation_id, message)
-
         if FILES_BUCKET and file_list:
-            for (fname, blob_bytes, ctype) in file_list:
-                storage_path = f"conversations/{user_id}/{conversation_id}/{msg_id}/{fname}"
-                meta = _upload_to_bucket(FILES_BUCKET, storage_path, blob_bytes, ctype)
-                attachments.append(meta)
+            with timed("uploads"):
+                attachments = upload_attachments(
+                    FILES_BUCKET, f"conversations/{user_id}/{conversation_id}/{msg_id}", file_list,
+                    content_prefix=f"conversations/{user_id}/blobs",
+                )
 
         #converting message to html
-        message_html = markdown.markdown(message) if message else ""
+        with timed("markdown"):
+            message_html = render_markdown(message) if message else ""
         # save user message
-        save_messages_to_firestore(
-            db,
-            messages_col,
-            role,
-            msg_ref,
-            msg_id,
-            message_html,
-            now_ms,
-            event=event,
-            event_data=event_data,
-            attachments=attachments,
-        )
+        with timed("save"):
+            save_messages_to_firestore(
+                db,
+                messages_col,
+                role,
+                msg_ref,
+                msg_id,
+                message_html,
+                now_ms,
+                event=event,
+                event_data=event_data,
+                attachments=attachments,
+            )
+
+        #update chat metadata once the message is stored; inserts into the same chat within
+        #METADATA_COALESCE_WINDOW_MS share one write (no chat read: update() fails on a missing chat)
+        with timed("metadata"):
+            try:
+                chat_metadata.update(conversation_id, message, now_ms)
+            except NotFound:
+                # deleted since it was read (or its owner cached): take the message back out
+                chat_owners.invalidate(conversation_id)
+                msg_ref.delete()
+                return add_cors(make_response(json.dumps({"error": "Chat not found"}), 404))
 
         return add_cors(jsonify({
             "success": True,
@@ -184,6 +340,9 @@ def ai_insert_text_assistant_message(request):
             "attachmentsCount": len(attachments),
         }))
 
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        logging.warning(f"Rejected oversized upload: {e}")
+        return add_cors(make_response(json.dumps({"error": str(e)}), 413))
     except Exception as e:
         logging.exception("ai_insert_text_assistant_message failed")
         return add_cors(make_response(json.dumps({"error": str(e)}), 500))
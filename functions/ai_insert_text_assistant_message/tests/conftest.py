@@ -0,0 +1,24 @@
+import os
+import sys
+import pytest
+
+# modules are imported from the function folder, as the Functions Framework does
+FUNCTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTION_DIR)
+
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test-project")
+# no trailing write to wait for between the inserts of a test
+os.environ.setdefault("METADATA_COALESCE_WINDOW_MS", "0")
+
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """The fake behind main.get_db(), with an empty chat owner cache."""
+    import main
+    from utils.chat_owner_cache import ChatOwnerCache
+    fake = FakeFirestore()
+    monkeypatch.setattr(main, "_db", fake)
+    monkeypatch.setattr(main, "chat_owners", ChatOwnerCache(main.CHAT_OWNER_CACHE_MAX_CHATS, main.CHAT_OWNER_CACHE_TTL_SECONDS))
+    return fake
@@ -0,0 +1,82 @@
+"""
+Reads per insert: one read of the chat document validates it and feeds the metadata
+write, and none while the chat's owner is cached.
+"""
+import json
+import flask
+import main
+
+app = flask.Flask(__name__)
+
+
+def _post(body):
+    with app.test_request_context("/", method="POST", json=body):
+        response = main.ai_insert_text_assistant_message(flask.request)
+    return response.status_code, json.loads(response.get_data())
+
+
+def _messages(db, chat_id):
+    return db.children(f"{main.ROOT_COLLECTION}/{chat_id}/messages")
+
+
+def test_first_insert_reads_the_chat_once_then_uses_the_cached_owner(db):
+    db.put(f"{main.AI_ASSISTANT_CHATS}/c1", {"id": "c1", "userId": "u1", "totalMessageCount": 0})
+
+    db.reset_ops()
+    status, body = _post({"conversationId": "c1", "message": "hi", "role": "humanAgent"})
+    assert status == 200 and body["success"]
+    # the message batch and the metadata update
+    assert (db.ops["reads"], db.ops["commits"]) == (1, 2)
+
+    for i in range(3):
+        db.reset_ops()
+        status, _ = _post({"conversationId": "c1", "message": f"more {i}", "role": "humanAgent"})
+        assert status == 200
+        assert (db.ops["reads"], db.ops["commits"]) == (0, 2)
+
+    chat = db.data(f"{main.AI_ASSISTANT_CHATS}/c1")
+    assert chat["totalMessageCount"] == 4
+    assert chat["lastMessage"] == "more 2"
+    assert len(_messages(db, "c1")) == 4
+
+
+def test_missing_chat_is_404_after_one_read_and_writes_nothing(db):
+    status, body = _post({"conversationId": "nope", "message": "hi"})
+
+    assert status == 404
+    assert (db.ops["reads"], db.ops["commits"]) == (1, 0)
+    assert not _messages(db, "nope")
+
+
+def test_chat_deleted_while_owner_cached_rolls_the_message_back(db):
+    db.put(f"{main.AI_ASSISTANT_CHATS}/c1", {"id": "c1", "userId": "u1"})
+    assert _post({"conversationId": "c1", "message": "hi"})[0] == 200
+    db.docs.pop(f"{main.AI_ASSISTANT_CHATS}/c1")
+
+    db.reset_ops()
+    status, body = _post({"conversationId": "c1", "message": "after delete"})
+    assert status == 404 and body["error"] == "Chat not found"
+    assert db.ops["reads"] == 0
+    assert [m["content"] for m in _messages(db, "c1").values()] == ["<p>hi</p>"]
+
+    # the owner was evicted, so the next insert reads the chat again
+    db.reset_ops()
+    assert _post({"conversationId": "c1", "message": "again"})[0] == 404
+    assert db.ops["reads"] == 1
+
+
+def test_bulk_insert_reads_each_uncached_chat_once(db):
+    for chat_id in ("c1", "c2"):
+        db.put(f"{main.AI_ASSISTANT_CHATS}/{chat_id}", {"id": chat_id, "userId": "u1"})
+    messages = [{"message": f"m{i}", "conversationId": "c1" if i % 2 else "c2"} for i in range(6)]
+
+    db.reset_ops()
+    status, body = _post({"messages": messages})
+    assert status == 200 and body["count"] == 6
+    # one batched read for both chats, one message commit, one metadata write per chat
+    assert (db.ops["reads"], db.ops["commits"]) == (2, 3)
+
+    db.reset_ops()
+    assert _post({"messages": messages})[0] == 200
+    assert db.ops["reads"] == 0
+    assert db.data(f"{main.AI_ASSISTANT_CHATS}/c1")["totalMessageCount"] == 6
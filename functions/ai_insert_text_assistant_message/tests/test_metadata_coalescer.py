@@ -0,0 +1,69 @@
+import threading
+import time
+import pytest
+from google.api_core.exceptions import NotFound
+from fake_firestore import FakeFirestore
+from utils.ai_chat_utils import AI_ASSISTANT_CHATS
+from utils.metadata_coalescer import ChatMetadataCoalescer
+
+CHAT = f"{AI_ASSISTANT_CHATS}/c1"
+
+
+@pytest.fixture
+def db():
+    fake = FakeFirestore()
+    fake.put(CHAT, {"id": "c1", "userId": "u1", "totalMessageCount": 0})
+    fake.reset_ops()
+    return fake
+
+
+def test_lone_update_is_written_without_waiting_for_the_window(db):
+    coalescer = ChatMetadataCoalescer(lambda: db, window_seconds=5)
+
+    started = time.monotonic()
+    coalescer.update("c1", "hi", 1)
+
+    assert time.monotonic() - started < 1
+    assert db.ops["commits"] == 1
+    assert db.data(CHAT)["lastMessage"] == "hi"
+
+
+def test_burst_is_merged_into_one_trailing_write(db):
+    coalescer = ChatMetadataCoalescer(lambda: db, window_seconds=0.2)
+    coalescer.update("c1", "first", 1)
+    db.reset_ops()
+
+    start = threading.Barrier(20)
+    def insert(i):
+        start.wait()
+        coalescer.update("c1", f"m{i}", 100 + i)
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert db.ops["commits"] == 1
+    chat = db.data(CHAT)
+    assert chat["totalMessageCount"] == 21
+    assert chat["lastMessage"] == "m19"
+
+
+def test_last_message_at_never_goes_backwards(db):
+    coalescer = ChatMetadataCoalescer(lambda: db, window_seconds=0)
+    stamps = []
+    for i in range(5):
+        coalescer.update("c1", f"m{i}", 0)  # requests that started long ago
+        stamps.append(db.data(CHAT)["lastMessageAt"])
+
+    assert stamps == sorted(stamps)
+    assert stamps[0] > 0
+
+
+def test_deleted_chat_fails_every_merged_caller(db):
+    db.docs.pop(CHAT)
+    coalescer = ChatMetadataCoalescer(lambda: db, window_seconds=0)
+
+    with pytest.raises(NotFound):
+        coalescer.update("c1", "hi", 1)
+    assert coalescer.stats()["failed"] == 1
@@ -0,0 +1,118 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from utils.ai_chat_utils import AI_ASSISTANT_CHATS
+
+# Bulk insert (see README "Bulk insert")
+BULK_MAX_MESSAGES = int(os.getenv("BULK_MAX_MESSAGES", "500"))
+# messages per batch commit; Firestore caps a commit at 500 writes and 10 MiB
+BULK_BATCH_SIZE = min(500, int(os.getenv("BULK_BATCH_SIZE", "200")))
+BULK_COMMIT_WORKERS = int(os.getenv("BULK_COMMIT_WORKERS", "4"))
+
+ROLES = ("user", "humanAgent", "system")
+
+_commit_pool = ThreadPoolExecutor(max_workers=max(1, BULK_COMMIT_WORKERS), thread_name_prefix="bulk-commit")
+
+
+class BulkRequestError(ValueError):
+    """The bulk body is invalid; nothing has been written."""
+
+
+def parse_bulk_messages(
+    items: Any, default_conversation_id: Optional[str], now_ms: int, has_files: Callable[[int], bool],
+) -> List[Dict[str, Any]]:
+    """
+    Validates the ordered `messages` array and returns one entry per message.
+
+    Each item is {"message", "role"?, "conversationId"?, "event"?, "eventData"?, "timestamp"?};
+    `conversationId` defaults to the request's. Items without a `timestamp` get
+    now + their position, so timestamp order is the order they were posted in.
+    """
+    if not isinstance(items, list) or not items:
+        raise BulkRequestError("messages must be a non-empty array")
+    if len(items) > BULK_MAX_MESSAGES:
+        raise BulkRequestError(f"At most {BULK_MAX_MESSAGES} messages per request")
+
+    entries = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise BulkRequestError(f"messages[{index}] must be an object")
+        conversation_id = item.get("conversationId") or item.get("id") or default_conversation_id
+        if not conversation_id:
+            raise BulkRequestError(f"messages[{index}]: conversationId is required")
+        role = (item.get("role") or "user").strip()
+        if role not in ROLES:
+            raise BulkRequestError(f"messages[{index}]: role must be 'user', 'humanAgent' or 'system'")
+        message = item.get("message")
+        if not message and not has_files(index):
+            raise BulkRequestError(f"messages[{index}]: message is required")
+        event_data = item.get("eventData") or {}
+        if isinstance(event_data, str):
+            try:
+                event_data = json.loads(event_data)
+            except ValueError:
+                raise BulkRequestError(f"messages[{index}]: eventData is not valid JSON")
+        timestamp = item.get("timestamp")
+        if timestamp is None:
+            timestamp = now_ms + index
+        elif not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            raise BulkRequestError(f"messages[{index}]: timestamp must be epoch milliseconds")
+        entries.append({
+            "index": index,
+            "conversationId": conversation_id,
+            "role": role,
+            "message": message,
+            "event": item.get("event"),
+            "eventData": event_data,
+            "timestamp": timestamp,
+        })
+    return entries
+
+
+def read_chat_owners(db, chat_ids: List[str]) -> Dict[str, Optional[str]]:
+    """userId of each chat (None when the chat has none), in one batched read; missing chats are left out."""
+    if not chat_ids:
+        return {}
+    refs = [db.collection(AI_ASSISTANT_CHATS).document(chat_id) for chat_id in chat_ids]
+    return {
+        snap.id: (snap.to_dict() or {}).get("userId")
+        for snap in db.get_all(refs, field_paths=["userId"])
+        if snap.exists
+    }
+
+
+def _commit(db, writes: List[Tuple[Any, Dict]]) -> None:
+    batch = db.batch()
+    for ref, data in writes:
+        batch.set(ref, data)
+    batch.commit()
+
+
+def commit_messages(db, writes: List[Tuple[Any, Dict]]) -> List[Optional[Exception]]:
+    """
+    Writes the message documents in chunks of BULK_BATCH_SIZE, committed concurrently.
+    Returns one result per chunk (None when it committed), so a failed chunk leaves
+    the others in place and the caller can report exactly what was written.
+    """
+    chunks = [writes[i:i + BULK_BATCH_SIZE] for i in range(0, len(writes), BULK_BATCH_SIZE)]
+    futures = [_commit_pool.submit(_commit, db, chunk) for chunk in chunks]
+    results: List[Optional[Exception]] = []
+    for future in futures:
+        try:
+            future.result()
+            results.append(None)
+        except Exception as e:
+            logging.warning(f"Bulk insert chunk failed: {e}")
+            results.append(e)
+    return results
+
+
+def delete_messages(db, refs: List[Any]) -> None:
+    """Deletes message documents already written, in batches of at most 500."""
+    for i in range(0, len(refs), 500):
+        batch = db.batch()
+        for ref in refs[i:i + 500]:
+            batch.delete(ref)
+        batch.commit()
@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class ChatOwnerCache:
+    """
+    Bounded LRU + TTL cache of chat id -> owning userId.
+
+    A chat's userId never changes, so the only staleness is a chat deleted within the
+    TTL; the metadata update fails on a missing document, and the caller deletes the
+    messages it wrote and evicts the chat.
+    Only chats that exist and have a userId are cached.
+    """
+
+    def __init__(self, max_chats: int = 2048, ttl_seconds: float = 60):
+        self.max_chats = max_chats
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # chat id -> (userId, stored at)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, chat_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None or time.monotonic() - entry[1] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[chat_id]
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(chat_id)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, chat_id: str, user_id: str) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[chat_id] = (user_id, time.monotonic())
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: str) -> None:
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
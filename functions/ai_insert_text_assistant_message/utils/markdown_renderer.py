@@ -0,0 +1,30 @@
+import os
+import threading
+from functools import lru_cache
+import markdown
+
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "256"))
+
+# markdown.Markdown instances are not thread-safe, so each worker thread keeps its own
+_local = threading.local()
+
+
+def _renderer() -> markdown.Markdown:
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = markdown.Markdown()
+        _local.md = md
+    return md
+
+
+@lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def render_markdown(text: str) -> str:
+    """
+    Same output as markdown.markdown(text), but reuses a per-thread Markdown
+    instance (extension registry built once) and memoizes repeated inputs.
+    """
+    md = _renderer()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
@@ -0,0 +1,144 @@
+import os
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+from google.cloud import firestore
+from utils.ai_chat_utils import AI_ASSISTANT_CHATS, chat_metadata_update
+
+# Chat metadata coalescing (see README "Chat metadata coalescing and message counts")
+METADATA_COALESCE_WINDOW_MS = int(os.getenv("METADATA_COALESCE_WINDOW_MS", "250"))  # 0 never holds an update back
+METADATA_FLUSH_TIMEOUT_SECONDS = float(os.getenv("METADATA_FLUSH_TIMEOUT_SECONDS", "30"))
+METADATA_FLUSH_WORKERS = int(os.getenv("METADATA_FLUSH_WORKERS", "8"))
+
+
+class _Pending:
+    __slots__ = ("count", "last_message", "last_message_at", "updates", "future")
+
+    def __init__(self):
+        self.count = 0
+        self.last_message = None
+        self.last_message_at = None
+        self.updates = 0
+        self.future: Future = Future()
+
+
+class _ChatState:
+    __slots__ = ("pending", "busy", "last_flush", "written_at")
+
+    def __init__(self):
+        self.pending: Optional[_Pending] = None
+        self.busy = False         # a write is running or scheduled
+        self.last_flush = 0.0     # monotonic start of the last write
+        self.written_at = 0       # lastMessageAt of the last write
+
+
+class ChatMetadataCoalescer:
+    """
+    Group commit of aiAssistantChats metadata, per chat.
+
+    An update for a chat that has not been written within the last `window_seconds`
+    is written at once (leading edge). Updates that arrive while a write is running,
+    or within `window_seconds` of the previous one, are merged (message counts summed,
+    the latest message becomes lastMessage) into one write made when the window
+    closes. So a lone insert does not wait, and a burst costs at most one write per
+    window per chat. Writes of a chat never overlap.
+
+    lastMessageAt/updatedAt are stamped when the write is made, and never below the
+    last value this instance wrote, so they don't go backwards when requests finish
+    out of order.
+
+    submit() returns a Future that every merged caller waits on, so an insert is only
+    acknowledged once the write carrying its update has committed; nothing is left
+    pending in memory when an instance is shut down. A failure (e.g. NotFound for a
+    deleted chat) is raised to every caller merged into that write.
+    """
+
+    def __init__(self, db_getter: Callable[[], firestore.Client], window_seconds: float):
+        self._db = db_getter
+        self.window_seconds = window_seconds
+        self._chats: Dict[str, _ChatState] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, METADATA_FLUSH_WORKERS), thread_name_prefix="chat-metadata")
+        self._stats = {"updates": 0, "writes": 0, "failed": 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, open=sum(1 for state in self._chats.values() if state.pending is not None))
+
+    def submit(self, chat_id: str, last_message: Optional[str], last_message_at: int, message_count: int = 1) -> Future:
+        with self._lock:
+            self._stats["updates"] += 1
+            state = self._chats.get(chat_id)
+            if state is None:
+                self._prune()
+                state = self._chats[chat_id] = _ChatState()
+            if state.pending is None:
+                state.pending = _Pending()
+            pending = state.pending
+            pending.count += message_count
+            pending.updates += 1
+            if pending.last_message_at is None or last_message_at >= pending.last_message_at:
+                pending.last_message_at = last_message_at
+                pending.last_message = last_message
+            delay = None
+            if not state.busy:
+                state.busy = True
+                delay = state.last_flush + self.window_seconds - time.monotonic()
+        if delay is not None:
+            self._schedule(chat_id, delay)
+        return pending.future
+
+    def update(self, chat_id: str, last_message: Optional[str], last_message_at: int, message_count: int = 1) -> None:
+        """submit() and wait for the write; raises what the write raised."""
+        self.submit(chat_id, last_message, last_message_at, message_count).result(timeout=METADATA_FLUSH_TIMEOUT_SECONDS)
+
+    def _schedule(self, chat_id: str, delay: float) -> None:
+        if delay > 0:
+            timer = threading.Timer(delay, self._flush, args=(chat_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._pool.submit(self._flush, chat_id)
+
+    def _prune(self) -> None:
+        """Forgets idle chats whose window has closed (caller holds the lock)."""
+        if len(self._chats) < 1024:
+            return
+        cutoff = time.monotonic() - self.window_seconds
+        for chat_id in [c for c, s in self._chats.items() if not s.busy and s.last_flush < cutoff]:
+            del self._chats[chat_id]
+
+    def _flush(self, chat_id: str) -> None:
+        with self._lock:
+            state = self._chats[chat_id]
+            pending, state.pending = state.pending, None
+            state.last_flush = time.monotonic()
+            now = max(int(time.time() * 1000), state.written_at)
+        try:
+            db = self._db()
+            chat_ref = db.collection(AI_ASSISTANT_CHATS).document(chat_id)
+            # update() fails (NotFound) if the chat is gone
+            chat_ref.update(chat_metadata_update(pending.last_message, now, now, pending.count))
+        except Exception as e:
+            with self._lock:
+                self._stats["failed"] += 1
+            logging.warning(f"Chat metadata write for {chat_id} failed ({pending.updates} updates): {e}")
+            pending.future.set_exception(e)
+        else:
+            with self._lock:
+                self._stats["writes"] += 1
+                state.written_at = now
+            if pending.updates > 1:
+                logging.info(f"Coalesced {pending.updates} metadata updates ({pending.count} messages) of chat {chat_id} into one write")
+            pending.future.set_result(pending.count)
+        finally:
+            with self._lock:
+                delay = None
+                if state.pending is not None:
+                    delay = state.last_flush + self.window_seconds - time.monotonic()
+                else:
+                    state.busy = False
+            if delay is not None:
+                self._schedule(chat_id, delay)
@@ -0,0 +1,54 @@
+# common.py
+# Pieces shared by the sync (Flask) and async (ASGI) text assistant handlers.
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
+from typing import Dict, List
+from utils.markdown_renderer import render_markdown
+
+MIAMI_TZ = ZoneInfo("America/New_York")
+
+OFFLINE_ES = """
+Nuestro equipo no está disponible en este momento, pero te responderemos apenas volvamos. Nuestro tiempo de respuesta habitual es de menos de 2 horas entre las 9am y 5pm (Miami). Recibirás todas las actualizaciones por aquí.
+"""
+
+OFFLINE_EN = """
+Our team's currently offline, but we'll hit you back first thing when we're back online. During business hours (9am-5pm Miami), we reply fast — usually under 2 hours. You'll get your updates right here.
+"""
+
+# static content is rendered once per instance
+OFFLINE_ES_HTML = render_markdown(OFFLINE_ES)
+OFFLINE_EN_HTML = render_markdown(OFFLINE_EN)
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Expose-Headers": "Idempotent-Replayed, Server-Timing, ETag",
+    # lets browsers expose Server-Timing to cross-origin pages (PerformanceResourceTiming.serverTiming)
+    "Timing-Allow-Origin": "*",
+}
+
+
+def is_miami_business_hours(now_utc: datetime) -> bool:
+    local = now_utc.astimezone(MIAMI_TZ)
+    start = dtime(9, 0)
+    end   = dtime(17, 0)
+    return start <= local.time() < end
+
+
+def offline_message_html(locale: str) -> str:
+    return OFFLINE_ES_HTML if locale.startswith("es") else OFFLINE_EN_HTML
+
+
+def apply_attachments_map(attachments: List[Dict], attachments_map: List[Dict]) -> List[Dict]:
+    """Copies the chatbot's fileId (and contentType if missing) onto our uploaded attachments, matched by filename."""
+    if attachments and attachments_map:
+        idx = {a.get("filename"): a for a in attachments_map if a.get("filename")}
+        for a in attachments:
+            match = idx.get(a.get("filename"))
+            if match:
+                if match.get("fileId"):
+                    a["fileId"] = match["fileId"]
+                if match.get("contentType") and not a.get("contentType"):
+                    a["contentType"] = match["contentType"]
+    return attachments
@@ -1,95 +1,286 @@
 # send_text_assistant_message.py
-from datetime import datetime, time as dtime, timezone
-from zoneinfo import ZoneInfo
+from datetime import datetime, timezone
 import functions_framework
-from flask import make_response
-from google.cloud import firestore
+from flask import Response, make_response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 import logging
 import time
 import json
-import markdown
 import os
 import uuid
-import mimetypes
+from dingdoor_utils_package.attachments import upload_attachments
+from dingdoor_utils_package.responses import finalize_response
+from dingdoor_utils_package.timing import defer_emit, finish_request, register_stats, request_timer, timed, use_timer
+from dingdoor_utils_package.uploads import UploadTooLarge, check_request_size, collect_uploads
 from services.ai_chat_service import AiChatService
-from utils.ai_chat_utils import save_messages_to_firestore, update_chat_metadata
-from google.cloud import storage 
-from datetime import timedelta
-from google.auth.transport.requests import Request
-import google.auth
+from services.turn_tasks import HUMAN_HANDOFF, SIGN_ATTACHMENTS, register_turn_tasks, sign_payload
+from api.http.text_assistant.common import CORS_HEADERS, apply_attachments_map, is_miami_business_hours, offline_message_html
+from utils.ai_chat_utils import save_turn_to_firestore
+from utils.clients import get_firestore_client
+from utils.idempotency import IdempotencyError, IdempotencyStore, request_fingerprint
+from utils.stage_graph import run_stage_graph
+from utils.task_queue import TaskQueue
+from utils.sse import format_sse_event
+from utils.markdown_renderer import render_markdown
+from utils.media import close_copies, preprocess_media
+from utils.resilience import CircuitOpenError
 
-MIAMI_TZ = ZoneInfo("America/New_York")
-
-OFFLINE_ES = """
-Nuestro equipo no está disponible en este momento, pero te responderemos apenas volvamos. Nuestro tiempo de respuesta habitual es de menos de 2 horas entre las 9am y 5pm (Miami). Recibirás todas las actualizaciones por aquí.
-"""
-
-OFFLINE_EN = """
-Our team's currently offline, but we'll hit you back first thing when we're back online. During business hours (9am-5pm Miami), we reply fast — usually under 2 hours. You'll get your updates right here.
-"""
-
-def _is_miami_business_hours(now_utc: datetime) -> bool:
-    local = now_utc.astimezone(MIAMI_TZ)
-    start = dtime(9, 0)
-    end   = dtime(17, 0)
-    return start <= local.time() < end
-
-
-db = firestore.Client()
 ai_chat_service = AiChatService()
+register_stats("historyCache", ai_chat_service.history_cache_stats)
+idempotency_store = IdempotencyStore(get_firestore_client)
+task_queue = register_turn_tasks(TaskQueue(get_firestore_client), ai_chat_service.handoff_human, ai_chat_service.record_turn)
 FILES_BUCKET = os.getenv("FILES_BUCKET", "text-assistant-uploads")  # e.g. dingdoor-uploads
 AI_ASSISTANT_MESSAGES_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
+# the handoff call and URL signing go through task_queue instead of holding up the reply
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"
+if WRITE_BEHIND:
+    # sweep from startup: retries and tasks orphaned by other instances don't wait for a first enqueue here
+    task_queue.start()
+    register_stats("taskQueue", task_queue.stats)
 
 def add_cors_headers(response):
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers.update(CORS_HEADERS)
     return response
 
-# ---- helpers for GCS uploads ----
-_storage_client = None
-def _gcs():
-    global _storage_client
-    if _storage_client is None:
-        _storage_client = storage.Client()
-    return _storage_client
-
-def _upload_to_bucket(bucket_name: str, blob_path: str, data: bytes, content_type: str) -> dict:
-    bucket = _gcs().bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    blob.upload_from_string(data, content_type=content_type)
-    blob.cache_control = "public, max-age=3600"
-    blob.content_disposition = f'inline; filename="{os.path.basename(blob_path)}"'
-    blob.patch()
-
-    preview_url = None
-    try:
-        signer_email = os.getenv("SIGNED_URL_SA_EMAIL","bucket-manager-text-assistant@knock24-inc.iam.gserviceaccount.com")
-        # IMPORTANT: request a token with the right scopes for IAMCredentials.signBlob
-        scopes = ["https://www.googleapis.com/auth/cloud-platform"]  # or "https://www.googleapis.com/auth/iam"
-        creds, _ = google.auth.default(scopes=scopes)
-        creds.refresh(Request())
-        access_token = creds.token
-
-        preview_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(hours=int(os.getenv("SIGNED_URL_EXPIRES_HOURS", "72"))),
-            method="GET",
-            service_account_email=signer_email,
-            access_token=access_token,  # forces IAM-backed signing (no local key)
+
+def _finalize_turn(message_result, chat_id, user_id, user_message, called_at, assistant_message_timestamp, file_list):
+    """
+    Renders the assistant reply, runs the post-reply stages (CTA, uploads, persist)
+    and returns the JSON body sent back to the client. `file_list` is what gets stored in GCS.
+
+    With WRITE_BEHIND the turn is still stored before the reply, but the handoff call
+    and the attachment URL signing are left to tasks (services/turn_tasks.py) that are
+    created in the turn's commit and run once it is stored.
+    """
+    attachments_map = message_result.get("attachmentsMap") or []  # <- from chatbot
+    token_usage = message_result.get("tokenUsage", "")
+    result_id = message_result.get("id")
+    result_reply = message_result.get("message", "")
+    cta = message_result.get("cta", "")
+    locale = message_result.get("locale", "en")
+    history_summary = message_result.get("historySummary")  # rolled by compact_history, stored with the turn
+    handoff_reason = message_result.get("ctaData", "User requested human handoff.")
+
+    conversation_id = result_id or chat_id or str(uuid.uuid4())
+    chat_title = message_result.get("title", "New Chat")
+    with timed("markdown"):
+        result_reply_html = render_markdown(result_reply)
+        user_message_html = render_markdown(user_message)
+
+    result_reply_clean = result_reply_html.replace("\n", "")
+
+    db = get_firestore_client()
+    messages_collection = db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(conversation_id).collection('messages')
+    user_message_ref = messages_collection.document()
+    user_message_id = user_message_ref.id
+    assistant_message_id = messages_collection.document().id
+
+    # ---- post-reply stages: independent ones run concurrently, persist waits for all ----
+    #professional help CTA handling
+    def _summary_stage(_):
+        enhanced_response = ai_chat_service.get_summary_for_cta(message_result.get("ctaData", ""))
+        if enhanced_response and isinstance(enhanced_response.get("data"), dict):
+            response_data = enhanced_response.get("data", {})
+            return {
+                "summary": response_data.get("summary", ""),
+                "inferredCategory": response_data.get("inferredCategory", {})
+            }
+        return {}
+
+    # human_handoff processing
+    def _handoff_stage(_):
+        if not WRITE_BEHIND:  # otherwise a task created with the turn (_persist_stage)
+            ai_chat_service.handoff_human(conversation_id, reason=handoff_reason)
+        logging.info(f"Human handoff requested for chat {conversation_id} with reason: {handoff_reason} at time {datetime.now(timezone.utc).isoformat()}")
+        if not is_miami_business_hours(datetime.now(timezone.utc)):
+            logging.info(f"Outside Miami business hours, sending offline message for chat {conversation_id}")
+            return offline_message_html(locale)
+        return ""
+
+    def _uploads_stage(_):
+        uploaded = upload_attachments(
+            FILES_BUCKET, f"conversations/{user_id}/{conversation_id}/{user_message_id}", file_list,
+            content_prefix=f"conversations/{user_id}/blobs", sign=not WRITE_BEHIND,
         )
-    except Exception as e:
-        logging.warning(f"Could not generate signed URL for {blob_path}: {e}")
+        return apply_attachments_map(uploaded, attachments_map)
+
+    # messages + chat metadata go out in one batch once everything else is ready
+    def _persist_stage(deps):
+        event = 'requestService' if cta == "professional_help" else None
+        attachments = deps.get("uploads") or None
+        dispatches = []
+
+        def _stage_tasks(batch):
+            # a commit retried with the other is_new_chat guess rebuilds the batch
+            dispatches.clear()
+            if cta == 'human_handoff':
+                dispatches.append(task_queue.stage(
+                    batch, HUMAN_HANDOFF, {"conversationId": conversation_id, "reason": handoff_reason}, conversation_id
+                ))
+            if attachments:
+                dispatches.append(task_queue.stage(
+                    batch, SIGN_ATTACHMENTS, sign_payload(conversation_id, user_message_id, FILES_BUCKET, attachments),
+                    conversation_id,
+                ))
+
+        user_msg, assistant_msg, chat_metadata = save_turn_to_firestore(
+            db, conversation_id, user_id, result_reply_html or user_message_html, chat_title,
+            messages_collection, user_message_ref, user_message_id, user_message_html, called_at, result_reply_clean,
+            assistant_message_timestamp, event,
+            deps.get("summary", {}), token_usage if token_usage else {}, deps.get("handoff", ""),
+            attachments=attachments, is_new_chat=not chat_id, assistant_message_id=assistant_message_id,
+            history_summary=history_summary, prepare=_stage_tasks if WRITE_BEHIND else None,
+        )
+        for dispatch in dispatches:
+            dispatch()
+        ai_chat_service.record_turn(
+            conversation_id, [user_msg, assistant_msg], chat_metadata.get("lastMessageAt"), is_new_chat="createdAt" in chat_metadata
+        )
+
+    stages = {}
+    if cta == 'professional_help' and message_result.get("ctaData", ""):
+        stages["summary"] = (_summary_stage, [])
+    if cta == 'human_handoff':
+        stages["handoff"] = (_handoff_stage, [])
+    if FILES_BUCKET and file_list:
+        stages["uploads"] = (_uploads_stage, [])
+    stages["persist"] = (_persist_stage, list(stages))
+
+    done = run_stage_graph(stages)
+    enhanced_request = done.get("summary", {})
+    offline_markdown = done.get("handoff", "")
 
     return {
-        "filename": os.path.basename(blob_path),
-        "contentType": content_type,
-        "bytes": len(data),
-        "storagePath": blob_path,
-        "gcsUri": f"gs://{bucket_name}/{blob_path}",
-        "url": preview_url,
+        "success": True,
+        "conversationId": conversation_id,
+        "reply": result_reply_clean if not offline_markdown else offline_markdown,
+        "replyId": assistant_message_id,
+        "userMsgId": user_message_id,
+        "event": "requestService" if cta == "professional_help" else "",
+        "eventData": enhanced_request if cta == "professional_help" else {},
+        "tokenUsage": token_usage
     }
-    
+
+
+def _sse_response(events):
+    response = Response(stream_with_context(events), status=200, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return add_cors_headers(response)
+
+
+def _replay_response(replay, stream: bool):
+    """Answers a duplicate Idempotency-Key request with the stored response."""
+    if stream:
+        event = "done" if replay.get("statusCode") == 200 else "error"
+        response = _sse_response(iter([format_sse_event(event, replay.get("body") or {})]))
+    else:
+        response = add_cors_headers(make_response(json.dumps(replay.get("body") or {}), replay.get("statusCode", 200)))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _complete_idempotency_key(user_id, idempotency_key, body):
+    # the turn is already persisted: a failure here must not turn the reply into an error
+    try:
+        idempotency_store.complete(user_id, idempotency_key, 200, body)
+    except Exception:
+        logging.exception(f"Could not store idempotent response for user {user_id}")
+
+
+def _release_idempotency_key(user_id, idempotency_key):
+    try:
+        idempotency_store.release(user_id, idempotency_key)
+    except Exception:
+        logging.exception(f"Could not release idempotency key for user {user_id}")
+
+
+def _stream_reply(chat_id, user_id, user_message, prev_msgs, file_list, storage_files, idempotency_key=None, on_close=None):
+    """
+    Relays the assistant reply as Server-Sent Events:
+      event: token  data: {"delta": "..."}   (raw markdown as it is generated)
+      event: done   data: <same body as the non-streaming response>
+      event: error  data: {"error": "..."}
+    The turn is persisted once the upstream stream closes, before `done` is sent.
+    If the client disconnects mid-stream, the rest of the upstream stream is read
+    (without relaying it) and the turn is persisted all the same.
+    With an idempotency key, the `done` body is stored for replay; a stream that ends
+    without one, whatever the reason, releases the key.
+    The Server-Timing header only covers the stages before the stream starts; the timing
+    log record is written once the stream ends and covers the whole turn.
+    `on_close` runs when the stream is over (e.g. to close the request's spooled files).
+    """
+    called_at = int(time.time() * 1000)
+    timer = defer_emit()
+
+    def generate():
+        outcome = "done"
+        events = None
+        message_result = {}
+        body = None
+        settled = not idempotency_key  # the key was completed or released
+
+        def finish(result):
+            nonlocal body, settled
+            body = _finalize_turn(
+                result, chat_id, user_id, user_message, called_at, int(time.time() * 1000), storage_files
+            )
+            if not settled:
+                _complete_idempotency_key(user_id, idempotency_key, body)
+                settled = True
+
+        def release():
+            nonlocal settled
+            if not settled:
+                _release_idempotency_key(user_id, idempotency_key)
+                settled = True
+
+        with use_timer(timer):
+            try:
+                events = ai_chat_service.stream_message_to_assistant(
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    message=user_message,
+                    previous_messages=prev_msgs,
+                    files=file_list or None,
+                )
+                for evt in events:
+                    if evt["type"] == "token":
+                        yield format_sse_event("token", {"delta": evt["delta"]})
+                    elif evt["type"] == "done":
+                        message_result = evt["result"]
+
+                finish(message_result)
+                yield format_sse_event("done", body)
+            except GeneratorExit:
+                # the client went away (the server closed this generator at a yield)
+                if body is None:
+                    outcome = "disconnected"
+                    logging.info(f"Client disconnected mid-stream; finishing the turn of user {user_id}")
+                    try:
+                        for evt in events:
+                            if evt["type"] == "done":
+                                message_result = evt["result"]
+                        finish(message_result)
+                    except Exception:
+                        logging.exception("Could not finish the turn of a disconnected stream.")
+                raise
+            except Exception as e:
+                outcome = "error"
+                logging.exception("Unexpected error in assistant message stream.")
+                release()
+                yield format_sse_event("error", {"error": str(e)})
+            finally:
+                # closed before a response was stored (e.g. the client went away): let a
+                # retry run the turn again instead of waiting out the lease
+                release()
+                if on_close is not None:
+                    on_close()
+                if timer is not None:
+                    timer.emit(status=200, stream=outcome)
+
+    return _sse_response(generate())
+
 
 @functions_framework.http
 def ai_send_text_assistant_message(req):
@@ -103,159 +294,136 @@ def ai_send_text_assistant_message(req):
       - message: text
       - id: text (optional)
       - previousMessages: text JSON (optional)
-      - files: file (repeatable) — images or PDFs
+      - files: file (repeatable) — images or PDFs, kept spooled on disk, not read into memory
+      - keepOriginal: "true" to store the original files in GCS when MEDIA_PREPROCESS is on (optional)
+
+    Sending `Accept: text/event-stream` switches the response to a Server-Sent Events
+    stream (see _stream_reply); otherwise a single JSON body is returned.
+
+    An `Idempotency-Key` header (or `idempotencyKey` field) makes retries safe: the first
+    successful response is stored and replayed (with `Idempotent-Replayed: true`) for
+    duplicates, which wait while the first request is still running.
+
+    Every response carries a `Server-Timing` header with the duration of each stage,
+    and one structured timing record is logged per request (SERVER_TIMING=false turns both off).
     """
     if req.method == 'OPTIONS':
         return add_cors_headers(make_response("", 204))
 
-    try:
-        content_type = (req.headers.get("Content-Type") or "").lower()
-        attachments = []
-
-        if "multipart/form-data" in content_type:
-            form = req.form
-            files = req.files
-            user_id = form.get("userId")
-            user_message = form.get("message")
-            chat_id = form.get("id")
-            
-            if not user_id or not user_message:
-                return add_cors_headers(make_response(json.dumps({"error": "userId and message are required"}), 400))
+    with request_timer("ai_send_text_assistant_message") as timer:
+        response = _handle(req)
+        with timed("encode"):
+            response = finalize_response(req, response)
+        return finish_request(timer, response)
 
-            prev_msgs = []
-            prev_raw = form.get("previousMessages")
-            if prev_raw:
-                try:
-                    prev_msgs = json.loads(prev_raw)
-                except Exception:
-                    return add_cors_headers(make_response(json.dumps({"error": "previousMessages must be JSON list"}), 400))
 
+def _handle(req):
+    user_id = None
+    idempotency_key = None
+    claimed = False
+    keep_original = False
+    file_list = []
+    upstream_files = []
+    streaming = False
+    try:
+        with timed("parse"):
+            check_request_size(req)
+            content_type = (req.headers.get("Content-Type") or "").lower()
             file_list = []
-            if files:
-                for key in files:
-                    incoming = files.getlist(key) if hasattr(files, "getlist") else [files[key]]
-                    for f in incoming:
-                        blob_bytes = f.read()
-                        ctype = f.content_type or (mimetypes.guess_type(f.filename)[0] or "application/octet-stream")
-                        fname = f.filename or f"upload-{uuid.uuid4().hex}"
-                        file_list.append((fname, blob_bytes, ctype))
-
-            called_at = int(time.time() * 1000)
-            message_result = ai_chat_service.send_message_to_assistant(
-                chat_id=chat_id,
-                user_id=user_id,
-                message=user_message,
-                previous_messages=prev_msgs,
-                files=file_list,
-            )
-            attachments_map = message_result.get("attachmentsMap") or []  # <- from chatbot
-            
-            assistant_message_timestamp = int(time.time() * 1000)
-
-        else:
-            if not req.is_json:
-                return add_cors_headers(make_response(json.dumps({"error": "Missing JSON"}), 400))
-            data = req.get_json()
-            if not data:
-                return add_cors_headers(make_response(json.dumps({"error": "Empty JSON body"}), 400))
-            if 'userId' not in data or 'message' not in data:
-                return add_cors_headers(make_response(json.dumps({"error": "userId and message are required"}), 400))
-
-            chat_id = data.get("id")
-            user_id = data.get("userId")
-            user_message = data.get("message")
-            prev_msgs = data.get("previousMessages") or []
-            called_at = int(time.time() * 1000)
-            message_result = ai_chat_service.send_message_to_assistant(
-                chat_id=chat_id,
-                user_id=user_id,
-                message=user_message,
-                previous_messages=prev_msgs,
-                files=None,
-            )
+
+            if "multipart/form-data" in content_type:
+                form = req.form
+                files = req.files
+                user_id = form.get("userId")
+                user_message = form.get("message")
+                chat_id = form.get("id")
             
-            assistant_message_timestamp = int(time.time() * 1000)
+                if not user_id or not user_message:
+                    return add_cors_headers(make_response(json.dumps({"error": "userId and message are required"}), 400))
 
-        token_usage = message_result.get("tokenUsage", "")
-        result_id = message_result.get("id")
-        result_reply = message_result.get("message", "")
-        cta = message_result.get("cta", "")
-        locale = message_result.get("locale", "en")
+                idempotency_key = req.headers.get("Idempotency-Key") or form.get("idempotencyKey")
+                keep_original = (form.get("keepOriginal") or "").lower() == "true"
+                prev_msgs = []
+                prev_raw = form.get("previousMessages")
+                if prev_raw:
+                    try:
+                        prev_msgs = json.loads(prev_raw)
+                    except Exception:
+                        return add_cors_headers(make_response(json.dumps({"error": "previousMessages must be JSON list"}), 400))
 
-        conversation_id = result_id or chat_id or str(uuid.uuid4())
-        chat_title = message_result.get("title", "New Chat")
-        result_reply_html = markdown.markdown(result_reply)
-        user_message_html = markdown.markdown(user_message)
+                if files:
+                    for key in files:
+                        incoming = files.getlist(key) if hasattr(files, "getlist") else [files[key]]
+                        file_list.extend(collect_uploads(incoming))
 
-        update_chat_metadata(
-            db, conversation_id, user_id, result_reply_html or user_message_html,chat_title ,message_count=2
-        )
+            else:
+                if not req.is_json:
+                    return add_cors_headers(make_response(json.dumps({"error": "Missing JSON"}), 400))
+                data = req.get_json()
+                if not data:
+                    return add_cors_headers(make_response(json.dumps({"error": "Empty JSON body"}), 400))
+                if 'userId' not in data or 'message' not in data:
+                    return add_cors_headers(make_response(json.dumps({"error": "userId and message are required"}), 400))
+
+                chat_id = data.get("id")
+                user_id = data.get("userId")
+                user_message = data.get("message")
+                prev_msgs = data.get("previousMessages") or []
+                idempotency_key = req.headers.get("Idempotency-Key") or data.get("idempotencyKey")
+
+            stream = "text/event-stream" in (req.headers.get("Accept") or "")
+        if idempotency_key:
+            with timed("idempotency"):
+                replay = idempotency_store.begin(user_id, idempotency_key, request_fingerprint(chat_id, user_message, file_list))
+            if replay is not None:
+                logging.info(f"Replaying stored response for idempotency key of user {user_id}")
+                return _replay_response(replay, stream)
+            claimed = True
 
-        enhanced_request = {}
-        #professional help CTA handling
-        if cta == 'professional_help':
-            summary = message_result.get("ctaData", "")
-            if summary:
-                enhanced_response = ai_chat_service.get_summary_for_cta(summary)
-                if enhanced_response and isinstance(enhanced_response.get("data"), dict):
-                    response_data = enhanced_response.get("data", {})
-                    enhanced_request = {
-                        "summary": response_data.get("summary", ""),
-                        "inferredCategory": response_data.get("inferredCategory", {})
-                    }
-        # human_handoff processing
-        offline_markdown = ""
-        if cta == 'human_handoff':
-            reason = message_result.get("ctaData", "User requested human handoff.")
-            resp = ai_chat_service.handoff_human(conversation_id, reason=reason)
-            logging.info(f"Human handoff requested for chat {conversation_id} with reason: {reason} at time {datetime.now(timezone.utc).isoformat()}")
-            if not _is_miami_business_hours(datetime.now(timezone.utc)):
-                logging.info(f"Outside Miami business hours, sending offline message for chat {conversation_id}")
-                offline_msg = OFFLINE_ES if locale.startswith("es") else OFFLINE_EN
-                offline_markdown = markdown.markdown(offline_msg)
-                
-
-        result_reply_clean = result_reply_html.replace("\n", "")
-
-        messages_collection = db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(conversation_id).collection('messages')
-        user_message_ref = messages_collection.document()
-        user_message_id = user_message_ref.id
-
-        if FILES_BUCKET and 'file_list' in locals() and file_list:
-            for (fname, blob_bytes, ctype) in file_list:
-                storage_path = f"conversations/{user_id}/{conversation_id}/{user_message_id}/{fname}"
-                meta = _upload_to_bucket(FILES_BUCKET, storage_path, blob_bytes, ctype)
-                attachments.append(meta)
-                
-        if attachments and attachments_map:
-            idx = {a.get("filename"): a for a in attachments_map if a.get("filename")}
-            for a in attachments:
-                match = idx.get(a.get("filename"))
-                if match:
-                    if match.get("fileId"):
-                        a["fileId"] = match["fileId"]
-                    if match.get("contentType") and not a.get("contentType"):
-                        a["contentType"] = match["contentType"]       
-                
-
-        user_msg, assistant_msg = save_messages_to_firestore(
-            db, messages_collection, user_message_ref, user_message_id, user_message_html, called_at, result_reply_clean,
-            assistant_message_timestamp, 'requestService' if cta == "professional_help" else None,
-            enhanced_request if cta == "professional_help" else {}, token_usage if token_usage else {},offline_markdown,
-            attachments=attachments if attachments else None
+        with timed("media"):
+            upstream_files, storage_files = preprocess_media(file_list, keep_original)
+        if stream:
+            streaming = True  # the stream closes the optimized copies once the turn is stored
+            return _stream_reply(
+                chat_id, user_id, user_message, prev_msgs, upstream_files, storage_files, idempotency_key,
+                on_close=lambda: close_copies(file_list, upstream_files),
+            )
+
+        called_at = int(time.time() * 1000)
+        message_result = ai_chat_service.send_message_to_assistant(
+            chat_id=chat_id,
+            user_id=user_id,
+            message=user_message,
+            previous_messages=prev_msgs,
+            files=upstream_files or None,
         )
+        assistant_message_timestamp = int(time.time() * 1000)
 
-        return add_cors_headers(make_response(json.dumps({
-            "success": True,
-            "conversationId": conversation_id,
-            "reply": result_reply_clean if not offline_markdown else offline_markdown,
-            "replyId": assistant_msg["id"],
-            "userMsgId": user_msg["id"],
-            "event": "requestService" if cta == "professional_help" else "",
-            "eventData": enhanced_request if cta == "professional_help" else {},
-            "tokenUsage": token_usage
-        }), 200))
+        body = _finalize_turn(
+            message_result, chat_id, user_id, user_message, called_at, assistant_message_timestamp, storage_files
+        )
+        if claimed:
+            _complete_idempotency_key(user_id, idempotency_key, body)
+        return add_cors_headers(make_response(json.dumps(body), 200))
 
+    except IdempotencyError as e:
+        logging.warning(f"Idempotency key rejected for user {user_id}: {e}")
+        return add_cors_headers(make_response(json.dumps({"error": str(e)}), e.status))
+    except CircuitOpenError as e:
+        logging.warning(f"Failing fast: {e}")
+        if claimed:
+            _release_idempotency_key(user_id, idempotency_key)
+        response = add_cors_headers(make_response(json.dumps({"error": str(e)}), 503))
+        response.headers["Retry-After"] = str(max(1, int(e.retry_after)))
+        return response
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        logging.warning(f"Rejected oversized upload: {e}")
+        return add_cors_headers(make_response(json.dumps({"error": str(e)}), 413))
     except Exception as e:
         logging.exception("Unexpected error in assistant message handler.")
+        if claimed:
+            _release_idempotency_key(user_id, idempotency_key)
         return add_cors_headers(make_response(json.dumps({"error": str(e)}), 500))
+    finally:
+        if not streaming:
+            close_copies(file_list, upstream_files)
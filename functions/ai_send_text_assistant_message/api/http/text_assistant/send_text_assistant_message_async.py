@@ -0,0 +1,326 @@
+# send_text_assistant_message_async.py
+# asyncio (ASGI) variant of send_text_assistant_message.py, enabled with TEXT_ASSISTANT_ASYNC=true (see main.py).
+from datetime import datetime, timezone
+import asyncio
+import functions_framework.aio
+from starlette.datastructures import UploadFile
+from starlette.responses import Response
+from google.cloud import firestore
+import logging
+import mimetypes
+import time
+import json
+import os
+import uuid
+from dingdoor_utils_package.attachments import upload_attachments
+from dingdoor_utils_package.responses import finalize_response
+from dingdoor_utils_package.timing import finish_request, register_stats, request_timer, timed
+from dingdoor_utils_package.uploads import MAX_REQUEST_BYTES, MAX_UPLOAD_FILE_BYTES, UploadTooLarge, stream_size
+from services.ai_chat_service import AiChatService
+from services.async_ai_chat_service import AsyncAiChatService
+from services.turn_tasks import HUMAN_HANDOFF, SIGN_ATTACHMENTS, register_turn_tasks, sign_payload
+from api.http.text_assistant.common import CORS_HEADERS, apply_attachments_map, is_miami_business_hours, offline_message_html
+from utils.ai_chat_utils import commit_turn_async
+from utils.clients import get_firestore_client
+from utils.idempotency import IdempotencyError, IdempotencyStore, request_fingerprint
+from utils.markdown_renderer import render_markdown
+from utils.media import close_copies, preprocess_media
+from utils.resilience import CircuitOpenError
+from utils.task_queue import TaskQueue
+
+FILES_BUCKET = os.getenv("FILES_BUCKET", "text-assistant-uploads")  # e.g. dingdoor-uploads
+AI_ASSISTANT_MESSAGES_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() == "true"  # see send_text_assistant_message.py
+
+# created on first request so the gRPC channel binds to the server's event loop
+_db = None
+_ai_chat_service = None
+def _clients():
+    global _db, _ai_chat_service
+    if _db is None:
+        _db = firestore.AsyncClient()
+        _ai_chat_service = AsyncAiChatService(_db)
+        register_stats("historyCache", _ai_chat_service.history_cache.stats)
+    return _db, _ai_chat_service
+
+
+# shared with the sync handler's records; its blocking Firestore calls run in worker threads
+idempotency_store = IdempotencyStore(get_firestore_client)
+
+
+def _record_turn(*args, **kwargs):
+    if _ai_chat_service is not None:
+        _ai_chat_service.record_turn(*args, **kwargs)
+
+
+# write-behind tasks run on the queue's worker threads, so they use the sync client and service
+task_queue = register_turn_tasks(TaskQueue(get_firestore_client), AiChatService().handoff_human, _record_turn)
+if WRITE_BEHIND:
+    task_queue.start()  # see send_text_assistant_message.py
+    register_stats("taskQueue", task_queue.stats)
+
+
+def _json_response(body, status: int) -> Response:
+    return Response(json.dumps(body), status_code=status, media_type="application/json", headers=CORS_HEADERS)
+
+
+async def _timed_stage(name, coro):
+    with timed(name):
+        return await coro
+
+
+async def _finalize_turn(db, ai_chat_service, message_result, chat_id, user_id, user_message, called_at, assistant_message_timestamp, file_list):
+    """Async counterpart of send_text_assistant_message._finalize_turn (same WRITE_BEHIND split)."""
+    attachments_map = message_result.get("attachmentsMap") or []  # <- from chatbot
+    token_usage = message_result.get("tokenUsage", "")
+    result_id = message_result.get("id")
+    result_reply = message_result.get("message", "")
+    cta = message_result.get("cta", "")
+    locale = message_result.get("locale", "en")
+    history_summary = message_result.get("historySummary")
+    handoff_reason = message_result.get("ctaData", "User requested human handoff.")
+
+    conversation_id = result_id or chat_id or str(uuid.uuid4())
+    chat_title = message_result.get("title", "New Chat")
+    with timed("markdown"):
+        result_reply_html = render_markdown(result_reply)
+        user_message_html = render_markdown(user_message)
+
+    result_reply_clean = result_reply_html.replace("\n", "")
+
+    messages_collection = db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(conversation_id).collection('messages')
+    user_message_ref = messages_collection.document()
+    user_message_id = user_message_ref.id
+    assistant_message_id = messages_collection.document().id
+
+    async def _summary():
+        enhanced_response = await ai_chat_service.get_summary_for_cta(message_result.get("ctaData", ""))
+        if enhanced_response and isinstance(enhanced_response.get("data"), dict):
+            response_data = enhanced_response.get("data", {})
+            return {
+                "summary": response_data.get("summary", ""),
+                "inferredCategory": response_data.get("inferredCategory", {})
+            }
+        return {}
+
+    async def _handoff():
+        if not WRITE_BEHIND:  # otherwise a task created with the turn
+            await ai_chat_service.handoff_human(conversation_id, reason=handoff_reason)
+        logging.info(f"Human handoff requested for chat {conversation_id} with reason: {handoff_reason} at time {datetime.now(timezone.utc).isoformat()}")
+        if not is_miami_business_hours(datetime.now(timezone.utc)):
+            logging.info(f"Outside Miami business hours, sending offline message for chat {conversation_id}")
+            return offline_message_html(locale)
+        return ""
+
+    async def _uploads():
+        # google-cloud-storage has no asyncio client; the upload pool runs in a worker thread
+        uploaded = await asyncio.to_thread(
+            upload_attachments, FILES_BUCKET, f"conversations/{user_id}/{conversation_id}/{user_message_id}", file_list,
+            f"conversations/{user_id}/blobs", not WRITE_BEHIND,
+        )
+        return apply_attachments_map(uploaded, attachments_map)
+
+    # independent post-reply stages run concurrently; persist waits for all of them
+    stages = {}
+    if cta == 'professional_help' and message_result.get("ctaData", ""):
+        stages["summary"] = _summary()
+    if cta == 'human_handoff':
+        stages["handoff"] = _handoff()
+    if FILES_BUCKET and file_list:
+        stages["uploads"] = _uploads()
+    done = dict(zip(stages, await asyncio.gather(*(_timed_stage(name, stage) for name, stage in stages.items()))))
+
+    event = 'requestService' if cta == "professional_help" else None
+    attachments = done.get("uploads") or None
+    dispatches = []
+
+    def _stage_tasks(batch):
+        # same follow-up tasks as the sync handler, created in the turn's commit (the async batch
+        # only takes the path of the task document the sync client allocates)
+        dispatches.clear()
+        if cta == 'human_handoff':
+            dispatches.append(task_queue.stage(
+                batch, HUMAN_HANDOFF, {"conversationId": conversation_id, "reason": handoff_reason}, conversation_id
+            ))
+        if attachments:
+            dispatches.append(task_queue.stage(
+                batch, SIGN_ATTACHMENTS, sign_payload(conversation_id, user_message_id, FILES_BUCKET, attachments),
+                conversation_id,
+            ))
+
+    with timed("persist"):
+        user_msg, assistant_msg, chat_metadata = await commit_turn_async(
+            db, conversation_id, user_id, result_reply_html or user_message_html, chat_title,
+            messages_collection, user_message_ref, user_message_id, user_message_html, called_at, result_reply_clean,
+            assistant_message_timestamp, event,
+            done.get("summary", {}), token_usage if token_usage else {}, done.get("handoff", ""),
+            attachments=attachments, is_new_chat=not chat_id, assistant_message_id=assistant_message_id,
+            history_summary=history_summary, prepare=_stage_tasks if WRITE_BEHIND else None,
+        )
+    for dispatch in dispatches:
+        dispatch()
+    ai_chat_service.record_turn(
+        conversation_id, [user_msg, assistant_msg], chat_metadata.get("lastMessageAt"), is_new_chat="createdAt" in chat_metadata
+    )
+    enhanced_request = done.get("summary", {})
+    offline_markdown = done.get("handoff", "")
+
+    return {
+        "success": True,
+        "conversationId": conversation_id,
+        "reply": result_reply_clean if not offline_markdown else offline_markdown,
+        "replyId": assistant_message_id,
+        "userMsgId": user_message_id,
+        "event": "requestService" if cta == "professional_help" else "",
+        "eventData": enhanced_request if cta == "professional_help" else {},
+        "tokenUsage": token_usage
+    }
+
+
+@functions_framework.aio.http
+async def ai_send_text_assistant_message(req):
+    """
+    Same request/response contract as the sync handler (JSON or multipart/form-data,
+    see send_text_assistant_message.py), served on the ASGI stack so a single
+    instance multiplexes many in-flight turns while they wait on the LLM.
+    Streaming (Accept: text/event-stream) is only served by the sync handler.
+    Responses carry the same Server-Timing header and timing log record.
+    """
+    if req.method == 'OPTIONS':
+        return Response("", status_code=204, headers=CORS_HEADERS)
+
+    with request_timer("ai_send_text_assistant_message") as timer:
+        response = await _handle(req)
+        with timed("encode"):
+            response = finalize_response(req, response)
+        return finish_request(timer, response)
+
+
+async def _handle(req):
+    user_id = None
+    idempotency_key = None
+    claimed = False
+    keep_original = False
+    file_list = []
+    upstream_files = []
+    try:
+        with timed("parse"):
+            content_length = req.headers.get("Content-Length")
+            if content_length and int(content_length) > MAX_REQUEST_BYTES:
+                raise UploadTooLarge(f"Request body exceeds {MAX_REQUEST_BYTES} bytes")
+
+            with timed("clients"):
+                db, ai_chat_service = _clients()
+            content_type = (req.headers.get("Content-Type") or "").lower()
+            file_list = []
+
+            if "multipart/form-data" in content_type:
+                form = await req.form()
+                user_id = form.get("userId")
+                user_message = form.get("message")
+                chat_id = form.get("id")
+
+                if not user_id or not user_message:
+                    return _json_response({"error": "userId and message are required"}, 400)
+
+                idempotency_key = req.headers.get("Idempotency-Key") or form.get("idempotencyKey")
+                keep_original = (form.get("keepOriginal") or "").lower() == "true"
+                prev_msgs = []
+                prev_raw = form.get("previousMessages")
+                if prev_raw:
+                    try:
+                        prev_msgs = json.loads(prev_raw)
+                    except Exception:
+                        return _json_response({"error": "previousMessages must be JSON list"}, 400)
+
+                for _, f in form.multi_items():
+                    if not isinstance(f, UploadFile):
+                        continue
+                    if stream_size(f.file) > MAX_UPLOAD_FILE_BYTES:
+                        raise UploadTooLarge(f"File '{f.filename}' exceeds {MAX_UPLOAD_FILE_BYTES} bytes")
+                    ctype = f.content_type or (mimetypes.guess_type(f.filename or "")[0] or "application/octet-stream")
+                    fname = f.filename or f"upload-{uuid.uuid4().hex}"
+                    file_list.append((fname, f.file, ctype))
+
+            else:
+                if "application/json" not in content_type:
+                    return _json_response({"error": "Missing JSON"}, 400)
+                try:
+                    data = await req.json()
+                except ValueError:
+                    data = None
+                if not data:
+                    return _json_response({"error": "Empty JSON body"}, 400)
+                if 'userId' not in data or 'message' not in data:
+                    return _json_response({"error": "userId and message are required"}, 400)
+
+                chat_id = data.get("id")
+                user_id = data.get("userId")
+                user_message = data.get("message")
+                prev_msgs = data.get("previousMessages") or []
+                idempotency_key = req.headers.get("Idempotency-Key") or data.get("idempotencyKey")
+
+        if idempotency_key:
+            with timed("idempotency"):
+                replay = await asyncio.to_thread(
+                    idempotency_store.begin, user_id, idempotency_key, request_fingerprint(chat_id, user_message, file_list)
+                )
+            if replay is not None:
+                logging.info(f"Replaying stored response for idempotency key of user {user_id}")
+                response = _json_response(replay.get("body") or {}, replay.get("statusCode", 200))
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+            claimed = True
+
+        if file_list:
+            with timed("media"):
+                upstream_files, storage_files = await asyncio.to_thread(preprocess_media, file_list, keep_original)
+        else:
+            upstream_files = storage_files = file_list
+
+        called_at = int(time.time() * 1000)
+        message_result = await ai_chat_service.send_message_to_assistant(
+            chat_id=chat_id,
+            user_id=user_id,
+            message=user_message,
+            previous_messages=prev_msgs,
+            files=upstream_files or None,
+        )
+        assistant_message_timestamp = int(time.time() * 1000)
+
+        body = await _finalize_turn(
+            db, ai_chat_service, message_result, chat_id, user_id, user_message, called_at, assistant_message_timestamp, storage_files
+        )
+        if claimed:
+            try:
+                await asyncio.to_thread(idempotency_store.complete, user_id, idempotency_key, 200, body)
+            except Exception:
+                logging.exception(f"Could not store idempotent response for user {user_id}")
+        return _json_response(body, 200)
+
+    except IdempotencyError as e:
+        logging.warning(f"Idempotency key rejected for user {user_id}: {e}")
+        return _json_response({"error": str(e)}, e.status)
+    except CircuitOpenError as e:
+        logging.warning(f"Failing fast: {e}")
+        if claimed:
+            try:
+                await asyncio.to_thread(idempotency_store.release, user_id, idempotency_key)
+            except Exception:
+                logging.exception(f"Could not release idempotency key for user {user_id}")
+        response = _json_response({"error": str(e)}, 503)
+        response.headers["Retry-After"] = str(max(1, int(e.retry_after)))
+        return response
+    except UploadTooLarge as e:
+        logging.warning(f"Rejected oversized upload: {e}")
+        return _json_response({"error": str(e)}, 413)
+    except Exception as e:
+        logging.exception("Unexpected error in async assistant message handler.")
+        if claimed:
+            try:
+                await asyncio.to_thread(idempotency_store.release, user_id, idempotency_key)
+            except Exception:
+                logging.exception(f"Could not release idempotency key for user {user_id}")
+        return _json_response({"error": str(e)}, 500)
+    finally:
+        close_copies(file_list, upstream_files)
@@ -1,3 +1,9 @@
-from api.http.text_assistant.send_text_assistant_message import ai_send_text_assistant_message
+import os
+
+# TEXT_ASSISTANT_ASYNC=true serves the asyncio/ASGI variant under the same entrypoint name
+if os.getenv("TEXT_ASSISTANT_ASYNC", "false").lower() == "true":
+    from api.http.text_assistant.send_text_assistant_message_async import ai_send_text_assistant_message
+else:
+    from api.http.text_assistant.send_text_assistant_message import ai_send_text_assistant_message
 
 __all__ = ["ai_send_text_assistant_message"]
@@ -3,11 +3,19 @@ import logging
 import os
 import requests
 from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
 import uuid
-from typing import List, Dict, Optional, Tuple, Any
+from typing import IO, List, Dict, Optional, Tuple, Any, Iterator
 import json
+from dingdoor_utils_package.timing import timed
+from utils.clients import get_firestore_client
+from utils.http_client import get_http_session
+from utils.sse import iter_sse_events
+from utils.history_cache import HistoryCache
+from utils.history_compaction import roll_summary, split_to_budget, summary_message, upstream_message
+from utils.resilience import CircuitOpenError, call_upstream, get_upstream
 
-FileTuple = Tuple[str, bytes, str]  # (filename, data, content_type)
+FileTuple = Tuple[str, IO[bytes], str]  # (filename, stream, content_type)
 
 
 def _required_env(var_name: str) -> str:
@@ -18,76 +26,268 @@ def _required_env(var_name: str) -> str:
 
 
 AI_ASSISTANT_MESSAGES_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
+AI_ASSISTANT_CHATS_COLLECTION = os.getenv("AI_ASSISTANT_CHATS_COLLECTION", "aiAssistantChats")
+HISTORY_CACHE_MAX_CHATS = int(os.getenv("HISTORY_CACHE_MAX_CHATS", "512"))
+HISTORY_CACHE_TTL_SECONDS = int(os.getenv("HISTORY_CACHE_TTL_SECONDS", "600"))
+HISTORY_LIMIT = 20
+# "tail": latest N non-CX turns with field projection; "legacy": first N messages, filtered client-side
+HISTORY_QUERY_MODE = os.getenv("HISTORY_QUERY_MODE", "tail")
+HISTORY_FIELDS = ["role", "content", "attachments", "event", "timestamp"]
+# extra pages the tail query may read when system events (humanAgentJoined) leave it short of N turns
+HISTORY_TAIL_MAX_PAGES = max(1, int(os.getenv("HISTORY_TAIL_MAX_PAGES", "3")))
+# upstream calls fail fast when the host does not accept the connection
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT_SECONDS", "5"))
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "2"))
 AI_TEXT_ASSISTANT_URL = _required_env("AI_TEXT_ASSISTANT_URL")
 AI_REQUEST_ENHANCED_URL = _required_env("AI_REQUEST_ENHANCED_URL")
 AI_HUMAN_HANDOFF_URL = _required_env("AI_HUMAN_HANDOFF_URL")
 
+
+def validate_turn(user_id: str, message: str) -> None:
+    if not user_id:
+        raise ValueError("Missing required field: 'userId'")
+    if not message or not isinstance(message, str):
+        raise ValueError("Missing or invalid field: 'message'")
+
+
+def assistant_payload(chat_id: Optional[str], user_id: str, message: str, previous_messages: Optional[List[Dict]]) -> Dict[str, Any]:
+    """Text fields sent to the agent service (previousMessages stays a list; multipart callers JSON-encode it)."""
+    payload: Dict[str, Any] = {
+        "userId": user_id,
+        "message": message,
+    }
+    if chat_id:
+        payload["id"] = chat_id
+    if previous_messages:
+        payload["previousMessages"] = previous_messages
+    return payload
+
+
+def is_history_message(d: Dict) -> bool:
+    """Messages the assistant sees as history: no CX interactions, no humanAgentJoined events."""
+    return d.get("isCxInteraction") is not True and d.get("event") != "humanAgentJoined"
+
+
+def format_history_entry(d: Dict) -> Dict:
+    return {
+        "role": d.get("role"),
+        "output": d.get("content"),
+        "attachments": d.get("attachments") or [],
+        "timestamp": d.get("timestamp"),  # anchors the rolling summary; not sent upstream
+    }
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """What counts against an upstream's breaker: timeouts, connection errors, 429 and 5xx."""
+    if isinstance(e, requests.HTTPError):
+        return e.response is None or e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def with_history_summary(result: Dict, history_summary: Optional[Dict]) -> Dict:
+    """The assistant's result plus, as `historySummary`, the rolled summary the turn has to store."""
+    if history_summary is not None:
+        result["historySummary"] = history_summary
+    return result
+
+
+def empty_cta_summary() -> Dict:
+    return {"data": {"summary": "", "inferredCategory": {}}}
+
+
 class AiChatService:
     def __init__(self):
-        self.db = firestore.Client()
+        # clients are shared per process and built on first use, not at import
+        self.history_cache = HistoryCache(
+            max_chats=HISTORY_CACHE_MAX_CHATS,
+            ttl_seconds=HISTORY_CACHE_TTL_SECONDS,
+            max_messages=HISTORY_LIMIT,
+        )
+
+    @property
+    def db(self) -> firestore.Client:
+        return get_firestore_client()
+
+    @property
+    def http(self) -> requests.Session:
+        return get_http_session()
+
+    def _history_version(self, chat_id: str):
+        """Current `lastMessageAt` of the chat: bumped by every writer, including the insert function."""
+        snap = self.db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id).get(field_paths=["lastMessageAt"])
+        return (snap.to_dict() or {}).get("lastMessageAt") if snap.exists else None
+
+    def _cached_history(self, chat_id: str, limit: int) -> Optional[List[Dict]]:
+        entry = self.history_cache.get(chat_id)
+        if entry is None or entry["version"] is None:
+            self.history_cache.record("misses")
+            return None
+        if self._history_version(chat_id) != entry["version"]:
+            # someone else wrote to this chat since we cached it
+            self.history_cache.invalidate(chat_id)
+            self.history_cache.record("stale")
+            return None
+        messages = entry["messages"][-limit:]
+        self.history_cache.record("hits")
+        # one chat-doc read replaced len(messages) message reads
+        self.history_cache.record("readsSaved", max(len(messages) - 1, 0))
+        return messages
 
-    def get_conversation_history(self, chat_id: str, limit: int = 20) -> List[Dict]:
+    def record_turn(self, chat_id: str, messages: List[Dict], version: Any, is_new_chat: bool = False) -> None:
+        """
+        Feeds messages just committed by this instance into the history cache.
+        `version` is the `lastMessageAt` written to the chat document in the same turn.
+        """
+        if not chat_id or version is None:
+            return
+        formatted = [format_history_entry(m) for m in messages]
+        if is_new_chat:
+            self.history_cache.put(chat_id, formatted, version=version)
+        else:
+            self.history_cache.append(chat_id, formatted, version=version)
+
+    def invalidate_history(self, chat_id: str) -> None:
+        self.history_cache.invalidate(chat_id)
+
+    def history_cache_stats(self) -> Dict[str, int]:
+        return self.history_cache.stats()
+
+    def _history_tail(self, messages_ref, limit: int) -> List[Any]:
+        """
+        Latest `limit` assistant-visible turns, oldest first.
+
+        CX interactions are excluded in the query itself and only the fields the
+        assistant needs are downloaded. Events the query cannot exclude (humanAgentJoined)
+        are dropped here, and the query continues after the last document read until
+        `limit` turns are found, the chat runs out, or HISTORY_TAIL_MAX_PAGES pages were read.
+
+        Needs the (isCxInteraction ASC, timestamp DESC) index from firestore.indexes.json,
+        and `isCxInteraction` on every message: a message without the field never matches
+        (scripts/backfill_is_cx_interaction.py sets it on messages written before it existed).
+        """
+        query = (
+            messages_ref
+            .where(filter=FieldFilter("isCxInteraction", "==", False))
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .select(HISTORY_FIELDS)
+        )
+        kept = []
+        for _ in range(HISTORY_TAIL_MAX_PAGES):
+            wanted = limit - len(kept)
+            docs = list(query.limit(wanted).get())
+            kept.extend(doc for doc in docs if is_history_message(doc.to_dict()))
+            if len(docs) < wanted or len(kept) >= limit:
+                break
+            query = query.start_after(docs[-1])  # cursor on the snapshot's timestamp (selected)
+        kept.reverse()
+        return kept
+
+    def get_conversation_history(self, chat_id: str, limit: int = HISTORY_LIMIT) -> List[Dict]:
         if not chat_id:
             return []
         try:
+            cached = self._cached_history(chat_id, limit)
+            if cached is not None:
+                logging.info(f"History cache hit for chat_id {chat_id} ({len(cached)} messages)")
+                return cached
+
             messages_ref = self.db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(chat_id).collection("messages")
-            docs = messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(limit).get()
+            docs = None
+            if HISTORY_QUERY_MODE == "tail":
+                try:
+                    docs = self._history_tail(messages_ref, limit)
+                except Exception as e:
+                    # e.g. FailedPrecondition while the composite index is not deployed yet
+                    logging.warning(f"Tail history query failed for chat_id {chat_id}, falling back to legacy query: {e}")
+            if docs is None:
+                docs = messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(limit).get()
             formatted = []
             for doc in docs:
                 d = doc.to_dict()
-                if d.get("isCxInteraction") is True:
-                    continue
-                
-                if d.get("event") == "humanAgentJoined":
-                   continue
-
-                formatted.append({
-                    "role": d.get("role"),
-                    "output": d.get("content"),
-                    "attachments": d.get("attachments") or [],   
-                })
+                if is_history_message(d):
+                    formatted.append(format_history_entry(d))
             logging.info(f"Retrieved {len(formatted)} messages for chat_id {chat_id}")
+            # version is filled in by record_turn once this instance writes the turn
+            self.history_cache.put(chat_id, formatted, version=None)
             return formatted
         except Exception as e:
             logging.error(f"Error retrieving conversation history: {e}")
             return []
 
-    def _post_json(self, url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        headers = {'Content-Type': 'application/json'}
-        resp = requests.post(url, json=payload, headers=headers, timeout=60)
-        resp.raise_for_status()
-        return resp.json()
+    def _history_summary(self, chat_id: str) -> Optional[Dict]:
+        snap = self.db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id).get(field_paths=["historySummary"])
+        return (snap.to_dict() or {}).get("historySummary") if snap.exists else None
+
+    def compact_history(self, chat_id: Optional[str], previous_messages: Optional[List[Dict]]) -> Tuple[List[Dict], Optional[Dict]]:
+        """
+        Fits previousMessages into HISTORY_TOKEN_BUDGET before it goes upstream: HTML is
+        reduced to text, attachments to ids/names, the newest messages are kept and the
+        older ones are folded into a rolling summary of the chat (`historySummary`),
+        sent as the first entry.
 
-    def _post_multipart(
+        Returns (messages, summary) where `summary` is the rolled summary to store with
+        the turn (see build_turn_batch), or None when the stored one is unchanged.
+        """
+        if not previous_messages:
+            return [], None
+        older, recent = split_to_budget(previous_messages)
+        recent = [upstream_message(m) for m in recent]
+        if not older:
+            return recent, None
+        summary = None
+        if chat_id:
+            try:
+                summary = self._history_summary(chat_id)
+            except Exception as e:
+                logging.warning(f"Could not read history summary for chat_id {chat_id}: {e}")
+        rolled = roll_summary(summary, older)
+        logging.info(f"Compacted history for chat_id {chat_id}: kept {len(recent)} messages, summarized {len(older)}")
+        return [summary_message(rolled, recent[0] if recent else None)] + recent, (
+            rolled if chat_id and rolled is not summary else None
+        )
+
+    def _assistant_request_kwargs(
         self,
-        url: str,
+        chat_id: Optional[str],
         user_id: str,
         message: str,
         previous_messages: Optional[List[Dict]] = None,
         files: Optional[List[FileTuple]] = None,
-        chat_id: Optional[str] = None,
-    ) -> Dict[str, Any]:
+    ) -> Tuple[Dict[str, Any], Optional[Dict]]:
         """
-        Sends a multipart request to /chat with both text fields and files.
-        - 'files' should be a list of (filename, bytes, content_type)
+        Validates the turn, backfills and compacts history, and builds the `requests` body
+        kwargs for the assistant call: json=... or, with files, a streaming
+        multipart encoder so file contents are read in chunks, never buffered whole.
+        Returns (kwargs, summary to store with the turn or None).
         """
-        data = {
-            "userId": user_id,
-            "message": message,
-        }
-        if chat_id:
-            data["id"] = chat_id
-        if previous_messages:
-            # backend expects previousMessages as a JSON string form field
-            data["previousMessages"] = json.dumps(previous_messages)
+        validate_turn(user_id, message)
+
+        # Backfill history if the client did not send it
+        if (not previous_messages) and chat_id:
+            with timed("history"):
+                previous_messages = self.get_conversation_history(chat_id)
+        with timed("compact"):
+            previous_messages, history_summary = self.compact_history(chat_id, previous_messages)
 
-        multipart_files = []
-        for (fname, blob, ctype) in (files or []):
-            multipart_files.append(("files", (fname, blob, ctype)))
+        payload = assistant_payload(chat_id, user_id, message, previous_messages)
+        if files and len(files) > 0:
+            # ---- multipart form (text + files) ----
+            form: Dict[str, str] = dict(payload)
+            if previous_messages:
+                # backend expects previousMessages as a JSON string form field
+                form["previousMessages"] = json.dumps(previous_messages)
 
-        resp = requests.post(url, data=data, files=multipart_files, timeout=120)
-        resp.raise_for_status()
-        return resp.json()
+            # repeated ("files", (filename, stream, content_type)) parts, streamed from the spooled uploads
+            fields = list(form.items())
+            for (fname, stream, content_type) in files:
+                stream.seek(0)
+                fields.append(("files", (fname, stream, content_type or "application/octet-stream")))
+            from requests_toolbelt.multipart.encoder import MultipartEncoder  # only needed for uploads
+            encoder = MultipartEncoder(fields=fields)
+            return {"data": encoder, "headers": {"Content-Type": encoder.content_type}}, history_summary
+
+        # ---- pure JSON (no files) ----
+        return {"json": payload}, history_summary
 
     def send_message_to_assistant(
         self,
@@ -95,14 +295,16 @@ class AiChatService:
         user_id: str,
         message: str,
         previous_messages: Optional[List[Dict]] = None,
-        files: Optional[List[Tuple[str, bytes, str]]] = None,  # (filename, bytes, content_type)
+        files: Optional[List[FileTuple]] = None,  # (filename, stream, content_type)
         timeout_seconds: int = 60,
     ) -> Dict:
         """
         Sends a message (and optional files) to the agent service.
 
         If `previous_messages` is empty and `chat_id` exists, it backfills history
-        from Firestore so the model keeps context.
+        from Firestore so the model keeps context. When compaction rolled the chat's
+        summary forward, the result carries it as `historySummary`, to be written with
+        the turn.
 
         Payloads:
         - JSON (no files):
@@ -119,69 +321,101 @@ class AiChatService:
           files:
             repeated field name "files" for each upload
         """
-        if not user_id:
-            raise ValueError("Missing required field: 'userId'")
-        if not message or not isinstance(message, str):
-            raise ValueError("Missing or invalid field: 'message'")
+        request_kwargs, history_summary = self._assistant_request_kwargs(chat_id, user_id, message, previous_messages, files)
 
-        # Backfill history if the client did not send it
-        if (not previous_messages) and chat_id:
-            previous_messages = self.get_conversation_history(chat_id)
-
-        url = AI_TEXT_ASSISTANT_URL
+        def _post():
+            resp = self.http.post(
+                AI_TEXT_ASSISTANT_URL, timeout=(UPSTREAM_CONNECT_TIMEOUT_SECONDS, timeout_seconds), **request_kwargs
+            )
+            resp.raise_for_status()
+            return resp.json()
 
         try:
-            if files and len(files) > 0:
-                # ---- multipart form (text + files) ----
-                form: Dict[str, str] = {
-                    "userId": user_id,
-                    "message": message,
-                }
-                if chat_id:
-                    form["id"] = chat_id
-                if previous_messages:
-                    form["previousMessages"] = json.dumps(previous_messages)
-
-                # requests expects a list of ("files", (filename, bytes, content_type)) tuples
-                multipart_files = [
-                    ("files", (fname, blob_bytes, content_type or "application/octet-stream"))
-                    for (fname, blob_bytes, content_type) in files
-                ]
-
-                resp = requests.post(
-                    url,
-                    data=form,
-                    files=multipart_files,
-                    timeout=timeout_seconds,
-                )
-            else:
-                # ---- pure JSON (no files) ----
-                payload: Dict = {
-                    "userId": user_id,
-                    "message": message,
-                }
-                if chat_id:
-                    payload["id"] = chat_id
-                if previous_messages:
-                    payload["previousMessages"] = previous_messages
-
-                resp = requests.post(
-                    url,
-                    json=payload,
-                    timeout=timeout_seconds,
-                )
+            # multipart bodies read the uploads once, so only JSON turns can be hedged
+            with timed("llm"):
+                result = call_upstream(get_upstream("assistant"), _post, is_upstream_failure, hedge="json" in request_kwargs)
+            return with_history_summary(result, history_summary)
+
+        except requests.RequestException as e:
+            logging.error(f"Assistant API request failed: {e}")
+            raise RuntimeError(f"Assistant service error: {str(e)}")
 
+    def stream_message_to_assistant(
+        self,
+        chat_id: Optional[str],
+        user_id: str,
+        message: str,
+        previous_messages: Optional[List[Dict]] = None,
+        files: Optional[List[FileTuple]] = None,
+        timeout_seconds: int = 60,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Same request as `send_message_to_assistant`, but asks the agent service for
+        `text/event-stream` and yields events as they arrive:
+          {"type": "token", "delta": "..."}   for each `token` event from upstream
+          {"type": "done", "result": {...}}   once, with the same shape as the JSON reply
+
+        If upstream answers with plain JSON instead of a stream, the whole reply is
+        yielded as one token followed by `done`. If the stream closes without a
+        `done` event, the result is assembled from the received tokens.
+        `timeout_seconds` bounds the wait between chunks, not the whole stream.
+        """
+        request_kwargs, history_summary = self._assistant_request_kwargs(chat_id, user_id, message, previous_messages, files)
+        headers = {**request_kwargs.pop("headers", {}), "Accept": "text/event-stream"}
+
+        def _open_stream():
+            resp = self.http.post(
+                AI_TEXT_ASSISTANT_URL,
+                headers=headers,
+                stream=True,
+                timeout=(UPSTREAM_CONNECT_TIMEOUT_SECONDS, timeout_seconds),
+                **request_kwargs,
+            )
             resp.raise_for_status()
-            return resp.json()
+            return resp
 
+        try:
+            # the breaker judges the stream by its response headers; a stream is never hedged
+            with timed("llm_connect"):
+                resp = call_upstream(get_upstream("assistant"), _open_stream, is_upstream_failure)
         except requests.RequestException as e:
-            logging.error(f"Assistant API request failed: {e}")
+            logging.error(f"Assistant API stream request failed: {e}")
             raise RuntimeError(f"Assistant service error: {str(e)}")
 
+        with resp, timed("llm_stream"):
+            if "text/event-stream" not in (resp.headers.get("Content-Type") or ""):
+                result = resp.json()
+                yield {"type": "token", "delta": result.get("message", "")}
+                yield {"type": "done", "result": with_history_summary(result, history_summary)}
+                return
+
+            deltas = []
+            try:
+                for event, data in iter_sse_events(resp.iter_lines(decode_unicode=True)):
+                    try:
+                        payload = json.loads(data)
+                    except ValueError:
+                        payload = data
+                    if event == "done":
+                        result = payload if isinstance(payload, dict) else {}
+                        yield {"type": "done", "result": with_history_summary(result, history_summary)}
+                        return
+                    if event == "error":
+                        raise RuntimeError(f"Assistant service error: {payload}")
+                    delta = payload.get("delta", "") if isinstance(payload, dict) else str(payload)
+                    if delta:
+                        deltas.append(delta)
+                        yield {"type": "token", "delta": delta}
+            except requests.RequestException as e:
+                logging.error(f"Assistant API stream interrupted: {e}")
+                raise RuntimeError(f"Assistant service error: {str(e)}")
+
+            yield {"type": "done", "result": with_history_summary({"message": "".join(deltas)}, history_summary)}
+
     def get_summary_for_cta(self, message: str,locale: str = "en"):
         if not message:
             logging.warning("Empty message provided for CTA summary")
-            return {"data": {"summary": "", "inferredCategory": {}}}
+            return empty_cta_summary()
         interaction_id = f'text_assistant_{str(uuid.uuid4())}'
         data = {
             "initialRequest": message,
@@ -189,34 +423,49 @@ class AiChatService:
             "responseDetails": [],
             "interactionId": interaction_id,
         }
-        try:
-            url = AI_REQUEST_ENHANCED_URL
+        def _post():
             headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer 123'}
-            resp = requests.post(url, json=data, headers=headers, timeout=30)
+            resp = self.http.post(
+                AI_REQUEST_ENHANCED_URL, json=data, headers=headers, timeout=(UPSTREAM_CONNECT_TIMEOUT_SECONDS, 30)
+            )
             resp.raise_for_status()
             return resp.json()
+
+        try:
+            # same interactionId on every attempt, so retries and hedges are safe to repeat
+            return call_upstream(
+                get_upstream("summary"), _post, is_upstream_failure, retries=SUMMARY_MAX_RETRIES, hedge=True
+            )
+        except CircuitOpenError as e:
+            logging.error(f"Enhanced request skipped: {e}")
+            return empty_cta_summary()
         except requests.exceptions.Timeout:
             logging.error("Enhanced API request timed out after 30s")
-            return {"data": {"summary": "", "inferredCategory": {}}}
+            return empty_cta_summary()
         except requests.RequestException as e:
             logging.error(f"Enhanced request failed: {e}")
-            return {"data": {"summary": "", "inferredCategory": {}}}
+            return empty_cta_summary()
 
     def handoff_human(self, chatId: str, reason: str):
         if not chatId:
             raise ValueError("Missing required field: 'chatId'")
         if not reason:
             raise ValueError("Missing required field: 'reason'")
-        try:   
-            url = AI_HUMAN_HANDOFF_URL
+        def _post():
             data = {
                 "chatId": chatId,
                 "reason": reason,
             }
             headers = {'Content-Type': 'application/json'}
-            resp = requests.post(url, json=data, headers=headers, timeout=30)
+            resp = self.http.post(
+                AI_HUMAN_HANDOFF_URL, json=data, headers=headers, timeout=(UPSTREAM_CONNECT_TIMEOUT_SECONDS, 30)
+            )
             resp.raise_for_status()
             return resp.json()
+
+        try:
+            # not idempotent (each call pages an agent): breaker only, no retries or hedging
+            return call_upstream(get_upstream("handoff"), _post, is_upstream_failure)
         except requests.RequestException as e:
             logging.error(f"Handoff human request failed: {e}")
             raise RuntimeError(f"Handoff service error: {str(e)}")
@@ -0,0 +1,251 @@
+# async_ai_chat_service.py
+import logging
+import uuid
+import json
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from dingdoor_utils_package.timing import timed
+from utils.http_client import get_async_http_client
+from utils.history_cache import HistoryCache
+from utils.history_compaction import roll_summary, split_to_budget, summary_message, upstream_message
+from utils.resilience import CircuitOpenError, call_upstream_async, get_upstream
+from services.ai_chat_service import (
+    AI_ASSISTANT_CHATS_COLLECTION,
+    AI_ASSISTANT_MESSAGES_COLLECTION,
+    AI_HUMAN_HANDOFF_URL,
+    AI_REQUEST_ENHANCED_URL,
+    AI_TEXT_ASSISTANT_URL,
+    HISTORY_CACHE_MAX_CHATS,
+    HISTORY_CACHE_TTL_SECONDS,
+    HISTORY_FIELDS,
+    HISTORY_LIMIT,
+    HISTORY_QUERY_MODE,
+    HISTORY_TAIL_MAX_PAGES,
+    SUMMARY_MAX_RETRIES,
+    UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+    FileTuple,
+    assistant_payload,
+    empty_cta_summary,
+    format_history_entry,
+    is_history_message,
+    validate_turn,
+    with_history_summary,
+)
+
+
+def is_upstream_failure(e: Exception) -> bool:
+    """httpx counterpart of ai_chat_service.is_upstream_failure."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+def _timeout(read_seconds: float) -> httpx.Timeout:
+    return httpx.Timeout(read_seconds, connect=UPSTREAM_CONNECT_TIMEOUT_SECONDS)
+
+
+class AsyncAiChatService:
+    """
+    asyncio counterpart of AiChatService for the ASGI handler: same upstream
+    contract, same history rules, but on httpx.AsyncClient and firestore.AsyncClient
+    so one instance can keep many turns in flight while the LLM is working.
+    """
+
+    def __init__(self, db: firestore.AsyncClient):
+        self.db = db
+        self.http = get_async_http_client()
+        self.history_cache = HistoryCache(
+            max_chats=HISTORY_CACHE_MAX_CHATS,
+            ttl_seconds=HISTORY_CACHE_TTL_SECONDS,
+            max_messages=HISTORY_LIMIT,
+        )
+
+    async def _history_version(self, chat_id: str):
+        snap = await self.db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id).get(field_paths=["lastMessageAt"])
+        return (snap.to_dict() or {}).get("lastMessageAt") if snap.exists else None
+
+    async def _cached_history(self, chat_id: str, limit: int) -> Optional[List[Dict]]:
+        entry = self.history_cache.get(chat_id)
+        if entry is None or entry["version"] is None:
+            self.history_cache.record("misses")
+            return None
+        if await self._history_version(chat_id) != entry["version"]:
+            self.history_cache.invalidate(chat_id)
+            self.history_cache.record("stale")
+            return None
+        messages = entry["messages"][-limit:]
+        self.history_cache.record("hits")
+        self.history_cache.record("readsSaved", max(len(messages) - 1, 0))
+        return messages
+
+    def record_turn(self, chat_id: str, messages: List[Dict], version: Any, is_new_chat: bool = False) -> None:
+        if not chat_id or version is None:
+            return
+        formatted = [format_history_entry(m) for m in messages]
+        if is_new_chat:
+            self.history_cache.put(chat_id, formatted, version=version)
+        else:
+            self.history_cache.append(chat_id, formatted, version=version)
+
+    async def _history_tail(self, messages_ref, limit: int) -> List[Any]:
+        """Async version of AiChatService._history_tail (same index, paging and field assumptions)."""
+        query = (
+            messages_ref
+            .where(filter=FieldFilter("isCxInteraction", "==", False))
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .select(HISTORY_FIELDS)
+        )
+        kept = []
+        for _ in range(HISTORY_TAIL_MAX_PAGES):
+            wanted = limit - len(kept)
+            docs = await query.limit(wanted).get()
+            kept.extend(doc for doc in docs if is_history_message(doc.to_dict()))
+            if len(docs) < wanted or len(kept) >= limit:
+                break
+            query = query.start_after(docs[-1])
+        kept.reverse()
+        return kept
+
+    async def get_conversation_history(self, chat_id: str, limit: int = HISTORY_LIMIT) -> List[Dict]:
+        if not chat_id:
+            return []
+        try:
+            cached = await self._cached_history(chat_id, limit)
+            if cached is not None:
+                return cached
+
+            messages_ref = self.db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(chat_id).collection("messages")
+            docs = None
+            if HISTORY_QUERY_MODE == "tail":
+                try:
+                    docs = await self._history_tail(messages_ref, limit)
+                except Exception as e:
+                    logging.warning(f"Tail history query failed for chat_id {chat_id}, falling back to legacy query: {e}")
+            if docs is None:
+                docs = await messages_ref.order_by("timestamp", direction=firestore.Query.ASCENDING).limit(limit).get()
+
+            formatted = []
+            for doc in docs:
+                d = doc.to_dict()
+                if is_history_message(d):
+                    formatted.append(format_history_entry(d))
+            logging.info(f"Retrieved {len(formatted)} messages for chat_id {chat_id}")
+            self.history_cache.put(chat_id, formatted, version=None)
+            return formatted
+        except Exception as e:
+            logging.error(f"Error retrieving conversation history: {e}")
+            return []
+
+    async def compact_history(self, chat_id: Optional[str], previous_messages: Optional[List[Dict]]) -> Tuple[List[Dict], Optional[Dict]]:
+        """Async version of AiChatService.compact_history (same budget, summary returned for the turn batch)."""
+        if not previous_messages:
+            return [], None
+        older, recent = split_to_budget(previous_messages)
+        recent = [upstream_message(m) for m in recent]
+        if not older:
+            return recent, None
+        summary = None
+        if chat_id:
+            try:
+                snap = await self.db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id).get(field_paths=["historySummary"])
+                summary = (snap.to_dict() or {}).get("historySummary") if snap.exists else None
+            except Exception as e:
+                logging.warning(f"Could not read history summary for chat_id {chat_id}: {e}")
+        rolled = roll_summary(summary, older)
+        logging.info(f"Compacted history for chat_id {chat_id}: kept {len(recent)} messages, summarized {len(older)}")
+        return [summary_message(rolled, recent[0] if recent else None)] + recent, (
+            rolled if chat_id and rolled is not summary else None
+        )
+
+    async def send_message_to_assistant(
+        self,
+        chat_id: Optional[str],
+        user_id: str,
+        message: str,
+        previous_messages: Optional[List[Dict]] = None,
+        files: Optional[List[FileTuple]] = None,
+        timeout_seconds: int = 60,
+    ) -> Dict:
+        """Async version of AiChatService.send_message_to_assistant (same payloads)."""
+        validate_turn(user_id, message)
+
+        # Backfill history if the client did not send it
+        if (not previous_messages) and chat_id:
+            with timed("history"):
+                previous_messages = await self.get_conversation_history(chat_id)
+        with timed("compact"):
+            previous_messages, history_summary = await self.compact_history(chat_id, previous_messages)
+
+        payload = assistant_payload(chat_id, user_id, message, previous_messages)
+
+        async def _post():
+            if files:
+                form = dict(payload)
+                if previous_messages:
+                    form["previousMessages"] = json.dumps(previous_messages)
+                multipart_files = []
+                for (fname, stream, content_type) in files:
+                    stream.seek(0)
+                    multipart_files.append(("files", (fname, stream, content_type or "application/octet-stream")))
+                resp = await self.http.post(AI_TEXT_ASSISTANT_URL, data=form, files=multipart_files, timeout=_timeout(timeout_seconds))
+            else:
+                resp = await self.http.post(AI_TEXT_ASSISTANT_URL, json=payload, timeout=_timeout(timeout_seconds))
+            resp.raise_for_status()
+            return resp.json()
+
+        try:
+            with timed("llm"):
+                result = await call_upstream_async(get_upstream("assistant"), _post, is_upstream_failure, hedge=not files)
+            return with_history_summary(result, history_summary)
+
+        except httpx.HTTPError as e:
+            logging.error(f"Assistant API request failed: {e}")
+            raise RuntimeError(f"Assistant service error: {str(e)}")
+
+    async def get_summary_for_cta(self, message: str, locale: str = "en"):
+        if not message:
+            logging.warning("Empty message provided for CTA summary")
+            return empty_cta_summary()
+        data = {
+            "initialRequest": message,
+            "locale": locale,
+            "responseDetails": [],
+            "interactionId": f'text_assistant_{str(uuid.uuid4())}',
+        }
+        async def _post():
+            headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer 123'}
+            resp = await self.http.post(AI_REQUEST_ENHANCED_URL, json=data, headers=headers, timeout=_timeout(30))
+            resp.raise_for_status()
+            return resp.json()
+
+        try:
+            return await call_upstream_async(
+                get_upstream("summary"), _post, is_upstream_failure, retries=SUMMARY_MAX_RETRIES, hedge=True
+            )
+        except CircuitOpenError as e:
+            logging.error(f"Enhanced request skipped: {e}")
+            return empty_cta_summary()
+        except httpx.TimeoutException:
+            logging.error("Enhanced API request timed out after 30s")
+            return empty_cta_summary()
+        except httpx.HTTPError as e:
+            logging.error(f"Enhanced request failed: {e}")
+            return empty_cta_summary()
+
+    async def handoff_human(self, chatId: str, reason: str):
+        if not chatId:
+            raise ValueError("Missing required field: 'chatId'")
+        if not reason:
+            raise ValueError("Missing required field: 'reason'")
+        async def _post():
+            resp = await self.http.post(AI_HUMAN_HANDOFF_URL, json={"chatId": chatId, "reason": reason}, timeout=_timeout(30))
+            resp.raise_for_status()
+            return resp.json()
+
+        try:
+            return await call_upstream_async(get_upstream("handoff"), _post, is_upstream_failure)
+        except httpx.HTTPError as e:
+            logging.error(f"Handoff human request failed: {e}")
+            raise RuntimeError(f"Handoff service error: {str(e)}")
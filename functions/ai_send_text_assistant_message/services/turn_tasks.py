@@ -0,0 +1,89 @@
+# turn_tasks.py
+# Write-behind side of a send-message turn: the follow-up work the handler leaves to the
+# task queue once the turn is stored (see WRITE_BEHIND in send_text_assistant_message.py).
+import os
+import logging
+from typing import Any, Callable, Dict, List
+from dingdoor_utils_package.signing import sign_attachments
+from utils.ai_chat_utils import save_turn_to_firestore
+from utils.task_queue import Task, TaskQueue
+
+AI_ASSISTANT_MESSAGES_COLLECTION = os.getenv("AI_ASSISTANT_MESSAGES_COLLECTION", "aiAssistantMessages")
+
+SIGN_ATTACHMENTS = "signAttachments"
+HUMAN_HANDOFF = "humanHandoff"
+# turn writes queued by instances from before turns were stored inline; still run after a deploy
+PERSIST_TURN = "persistTurn"
+
+
+def sign_payload(conversation_id: str, message_id: str, bucket: str, attachments: List[Dict]) -> Dict[str, Any]:
+    """What sign_message_attachments needs, as plain values for the task document."""
+    return {
+        "conversationId": conversation_id,
+        "messageId": message_id,
+        "bucket": bucket,
+        "attachments": attachments,
+    }
+
+
+def sign_message_attachments(task: Task) -> None:
+    """
+    Signs the URLs of a stored message's attachments and writes them to the message,
+    in a batch that also marks the task done. A URL that could not be signed fails the
+    task, so it is retried; until then readers sign the attachment themselves.
+    """
+    p = task.payload
+    attachments = sign_attachments(p["bucket"], p["attachments"])
+    unsigned = [a.get("filename") for a in attachments if not a.get("url")]
+    if unsigned:
+        raise RuntimeError(f"Could not sign {len(unsigned)} attachment URL(s): {unsigned}")
+    message_ref = (
+        task.db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(p["conversationId"])
+        .collection("messages").document(p["messageId"])
+    )
+    batch = task.db.batch()
+    batch.update(message_ref, {"attachments": attachments})
+    task.complete_in(batch)
+    batch.commit()
+    logging.info(f"Signed {len(attachments)} attachment URL(s) of message {p['messageId']} (attempt {task.attempt})")
+
+
+def persist_turn(task: Task, record_turn: Callable[..., None]) -> None:
+    """
+    Signs the attachment URLs and writes both messages plus the chat metadata in one
+    batch, under the ids the client already received (tasks queued before the turn
+    writes moved inline, see PERSIST_TURN). The task is marked done in the
+    same batch, so a re-run after a lost lease cannot count the turn twice.
+    """
+    p = task.payload
+    db = task.db
+    attachments = p.get("attachments") or None
+    if attachments and p.get("bucket"):
+        sign_attachments(p["bucket"], attachments)
+
+    conversation_id = p["conversationId"]
+    messages_collection = db.collection(AI_ASSISTANT_MESSAGES_COLLECTION).document(conversation_id).collection("messages")
+    user_msg, assistant_msg, chat_metadata = save_turn_to_firestore(
+        db, conversation_id, p["userId"], p["lastMessage"], p["title"],
+        messages_collection, messages_collection.document(p["userMessageId"]), p["userMessageId"], p["userMessage"],
+        p["userTimestamp"], p["assistantReply"], p["assistantTimestamp"], p.get("event"),
+        p.get("eventData") or {}, p.get("tokenUsage") or {}, p.get("offlineMessage", ""),
+        attachments=attachments, is_new_chat=p.get("isNewChat", False), assistant_message_id=p["assistantMessageId"],
+        history_summary=p.get("historySummary"), prepare=task.complete_in,
+    )
+    record_turn(conversation_id, [user_msg, assistant_msg], chat_metadata.get("lastMessageAt"), is_new_chat="createdAt" in chat_metadata)
+    logging.info(f"Persisted turn {p['userMessageId']}/{p['assistantMessageId']} of chat {conversation_id} (attempt {task.attempt})")
+
+
+def notify_handoff(task: Task, handoff_human: Callable[[str, str], Any]) -> None:
+    """Human handoff notification; at-least-once, so a retry can notify the CX side twice."""
+    p = task.payload
+    handoff_human(p["conversationId"], reason=p["reason"])
+    logging.info(f"Human handoff requested for chat {p['conversationId']} with reason: {p['reason']} (attempt {task.attempt})")
+
+
+def register_turn_tasks(task_queue: TaskQueue, handoff_human: Callable[[str, str], Any], record_turn: Callable[..., None]) -> TaskQueue:
+    task_queue.register(SIGN_ATTACHMENTS, sign_message_attachments)
+    task_queue.register(HUMAN_HANDOFF, lambda task: notify_handoff(task, handoff_human))
+    task_queue.register(PERSIST_TURN, lambda task: persist_turn(task, record_turn))
+    return task_queue
@@ -0,0 +1,91 @@
+import os
+import sys
+from unittest import mock
+import pytest
+
+# modules are imported from the function folder, as the Functions Framework does
+FUNCTION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, FUNCTION_DIR)
+
+# read at import by the handler and AiChatService; nothing is ever called on them
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test-project")
+os.environ.setdefault("AI_TEXT_ASSISTANT_URL", "http://assistant.test/chat")
+os.environ.setdefault("AI_REQUEST_ENHANCED_URL", "http://assistant.test/enhanced")
+os.environ.setdefault("AI_HUMAN_HANDOFF_URL", "http://assistant.test/handoff")
+
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """The fake behind utils.clients.get_firestore_client()."""
+    import utils.clients as clients
+    fake = FakeFirestore()
+    monkeypatch.setattr(clients, "_firestore_client", fake)
+    return fake
+
+
+class UpstreamResponse:
+    status_code = 200
+    ok = True
+    headers = {"Content-Type": "application/json"}
+
+    def __init__(self, body):
+        self._body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+class StreamingUpstreamResponse(UpstreamResponse):
+    """A text/event-stream reply; `lines` may hold an exception to raise mid-stream."""
+    headers = {"Content-Type": "text/event-stream"}
+
+    def __init__(self, lines):
+        super().__init__(None)
+        self._lines = lines
+        self.lines_read = 0
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self._lines:
+            if isinstance(line, Exception):
+                raise line
+            self.lines_read += 1
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+    Replaces the pooled upstream session; set `upstream.reply` to the assistant's
+    JSON reply, and `upstream.stream` to the SSE lines answered to streamed POSTs.
+    `upstream.calls` collects (url, kwargs) of every POST, `upstream.streams` the
+    streamed responses.
+    """
+    import utils.http_client as http_client
+    session = mock.MagicMock()
+    session.reply = {"message": "Hello!", "cta": "", "tokenUsage": {"totalTokens": 5}}
+    session.stream = None
+    session.calls = []
+    session.streams = []
+
+    def post(url, **kwargs):
+        session.calls.append((url, kwargs))
+        if kwargs.get("stream") and session.stream is not None:
+            session.streams.append(StreamingUpstreamResponse(session.stream))
+            return session.streams[-1]
+        return UpstreamResponse(session.reply)
+
+    session.post.side_effect = post
+    monkeypatch.setattr(http_client, "_session", session)
+    return session
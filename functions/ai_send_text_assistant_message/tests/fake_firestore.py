@@ -0,0 +1,267 @@
+"""
+In-memory stand-in for google.cloud.firestore.Client, enough for the code paths the
+tests drive. Every document read, query, write and commit is counted in `ops`, which
+is what the tests assert on. Reads are billed like Firestore: one per document
+returned, one for an empty query.
+"""
+import copy
+import itertools
+import threading
+from collections import Counter
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+from google.cloud.firestore import Increment
+from google.cloud.firestore_v1.field_path import FieldPath
+
+_ids = itertools.count(1)
+
+
+def _apply_transforms(current, data, merge_maps):
+    out = dict(current or {})
+    for key, value in data.items():
+        if "." in key or "`" in key:
+            parts = FieldPath.from_string(key).parts
+            target = out
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = _value(target.get(parts[-1]), value)
+        elif isinstance(value, dict) and merge_maps and isinstance(out.get(key), dict):
+            out[key] = _apply_transforms(out[key], value, True)
+        elif isinstance(value, dict):
+            out[key] = _apply_transforms({}, value, False)
+        else:
+            out[key] = _value(out.get(key), value)
+    return out
+
+
+def _value(current, value):
+    if isinstance(value, Increment):
+        return (current or 0) + value.value
+    return value
+
+
+class Snapshot:
+    def __init__(self, ref, data, update_time=None):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        return self._db._read(self, field_paths)
+
+    def set(self, data, merge=False):
+        return self._db._commit([("set", self, data, merge, None)])[0]
+
+    def update(self, data, option=None):
+        return self._db._commit([("update", self, data, True, option)])[0]
+
+    def create(self, data):
+        return self._db._commit([("create", self, data, False, None)])[0]
+
+    def delete(self):
+        return self._db._commit([("delete", self, None, False, None)])[0]
+
+
+class Query:
+    def __init__(self, collection, filters=(), orders=(), limit=None, start_after=None, fields=None):
+        self._col = collection
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit=self._limit,
+                     start_after=self._start_after, fields=self._fields)
+        state.update(changes)
+        return Query(self._col, **state)
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + [(field, str(direction).upper().endswith("DESCENDING"))])
+
+    def limit(self, n):
+        return self._copy(limit=n)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values):
+        return self._copy(start_after=values)
+
+    def _matches(self, data):
+        ops = {"==": lambda a, b: a == b, ">=": lambda a, b: a is not None and a >= b,
+               "<=": lambda a, b: a is not None and a <= b, "<": lambda a, b: a is not None and a < b,
+               ">": lambda a, b: a is not None and a > b}
+        return all(ops[op](data.get(field), value) for field, op, value in self._filters)
+
+    def get(self, transaction=None):
+        return self._col._db._query(self)
+
+    def stream(self, transaction=None):
+        return iter(self.get())
+
+
+class CollectionReference(Query):
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._db, f"{self.path}/{doc_id or 'auto%06d' % next(_ids)}")
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(("set", ref, data, merge, None))
+
+    def update(self, ref, data, option=None):
+        self._ops.append(("update", ref, data, True, option))
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, False, None))
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, False, None))
+
+    def commit(self):
+        return self._db._commit(self._ops)
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class WriteOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs = {}       # path -> (data, update_time)
+        self.ops = Counter()  # reads, writes, commits, queries
+        self.fail_next_commit = None  # exception raised by the next commit
+        self._clock = itertools.count(1)
+        self._lock = threading.RLock()
+
+    # ---- client API ----
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def write_option(self, last_update_time=None, **kwargs):
+        return WriteOption(last_update_time)
+
+    def get_all(self, refs, field_paths=None, transaction=None):
+        for ref in refs:
+            yield self._read(ref, field_paths)
+
+    # ---- test helpers ----
+    def put(self, path, data):
+        with self._lock:
+            self.docs[path] = (dict(data), next(self._clock))
+
+    def data(self, path):
+        return (self.docs.get(path) or (None,))[0]
+
+    def children(self, collection_path):
+        prefix = collection_path + "/"
+        return {p: d for p, (d, _) in self.docs.items() if p.startswith(prefix) and "/" not in p[len(prefix):]}
+
+    def reset_ops(self):
+        self.ops.clear()
+
+    # ---- internals ----
+    def _read(self, ref, field_paths=None):
+        with self._lock:
+            self.ops["reads"] += 1
+            data, update_time = self.docs.get(ref.path, (None, None))
+            if data is not None and field_paths:
+                data = {k: v for k, v in data.items() if k in field_paths}
+            return Snapshot(ref, data, update_time)
+
+    def _query(self, query):
+        with self._lock:
+            self.ops["queries"] += 1
+            rows = [(DocumentReference(self, p), d) for p, d in self.children(query._col.path).items() if query._matches(d)]
+            for field, desc in reversed(query._orders):
+                key = (lambda r: r[0].id) if field == "__name__" else (lambda r, f=field: (r[1].get(f) is None, r[1].get(f)))
+                rows.sort(key=key, reverse=desc)
+            if query._start_after is not None:
+                values = query._start_after
+                fields = [f for f, _ in query._orders]
+                def key_of(row):
+                    return tuple(row[0].id if f == "__name__" else row[1].get(f) for f in fields)
+                target = tuple(values.get(f) for f in fields)
+                for i, row in enumerate(rows):
+                    if key_of(row) == target:
+                        rows = rows[i + 1:]
+                        break
+            if query._limit is not None:
+                rows = rows[:query._limit]
+            snaps = []
+            for ref, data in rows:
+                if query._fields is not None:
+                    data = {k: v for k, v in data.items() if k in query._fields}
+                snaps.append(Snapshot(ref, data, self.docs[ref.path][1]))
+            self.ops["reads"] += max(1, len(snaps))  # Firestore bills an empty query as one read
+            return snaps
+
+    def _commit(self, writes):
+        with self._lock:
+            self.ops["commits"] += 1
+            if self.fail_next_commit is not None:
+                error, self.fail_next_commit = self.fail_next_commit, None
+                raise error
+            # preconditions first: a batch applies all of its writes or none
+            for kind, ref, data, merge, option in writes:
+                exists = ref.path in self.docs
+                if kind == "create" and exists:
+                    raise AlreadyExists(f"Document already exists: {ref.path}")
+                if kind == "update" and not exists:
+                    raise NotFound(f"No document to update: {ref.path}")
+                if option is not None and self.docs[ref.path][1] != option.last_update_time:
+                    raise FailedPrecondition(f"Stale update_time for {ref.path}")
+            update_time = next(self._clock)
+            for kind, ref, data, merge, option in writes:
+                self.ops["writes"] += 1
+                if kind == "delete":
+                    self.docs.pop(ref.path, None)
+                    continue
+                current = self.docs.get(ref.path, (None, None))[0] if (merge or kind == "update") else None
+                self.docs[ref.path] = (_apply_transforms(current, data, True), update_time)
+            return [WriteResult(update_time) for _ in writes]
@@ -0,0 +1,77 @@
+"""
+Rolling history summary: which messages it already covers, and that it is stored with
+the turn rather than in a write of its own.
+"""
+import json
+import uuid
+
+import flask
+
+from utils.ai_chat_utils import AI_ASSISTANT_CHATS_COLLECTION
+from utils.history_compaction import roll_summary
+
+
+def _message(role, text, timestamp=None):
+    message = {"role": role, "output": text, "attachments": []}
+    if timestamp is not None:
+        message["timestamp"] = timestamp
+    return message
+
+
+def test_summary_only_adds_messages_after_the_covered_timestamp():
+    previous = {"text": "User: one\nAssistant: two", "coversThrough": 2}
+    older = [_message("user", "one", 1), _message("assistant", "two", 2), _message("user", "three", 3)]
+
+    rolled = roll_summary(previous, older)
+
+    assert rolled["text"].split("\n") == ["User: one", "Assistant: two", "User: three"]
+    assert rolled["coversThrough"] == 3
+    assert roll_summary(rolled, older) is rolled
+
+
+def test_summary_appends_when_the_covered_message_left_the_window():
+    # the history window moved past message 2: everything in it is newer, nothing is repeated
+    previous = {"text": "User: one\nAssistant: two", "coversThrough": 2}
+    older = [_message("user", "five", 5), _message("assistant", "six", 6)]
+
+    rolled = roll_summary(previous, older)
+
+    assert rolled["text"].split("\n") == ["User: one", "Assistant: two", "User: five", "Assistant: six"]
+    assert rolled["coversThrough"] == 6
+
+
+def test_summary_is_rebuilt_when_its_anchor_is_unknown():
+    # client-sent history (no timestamps) that no longer contains the covered position
+    previous = {"text": "User: one\nAssistant: two", "coversThrough": "fingerprint-of-a-gone-message"}
+    older = [_message("user", "one"), _message("assistant", "two")]
+
+    rolled = roll_summary(previous, older)
+
+    assert rolled["text"].split("\n") == ["User: one", "Assistant: two"]
+
+
+def test_rolled_summary_is_written_in_the_turn_commit(db, upstream):
+    chat_id = str(uuid.uuid4())
+    db.put(f"{AI_ASSISTANT_CHATS_COLLECTION}/{chat_id}", {"id": chat_id, "userId": "u1", "lastMessageAt": 1})
+    for i in range(1, 11):  # ~400 tokens each: the oldest ones do not fit HISTORY_TOKEN_BUDGET
+        role = "user" if i % 2 else "assistant"
+        db.put(f"aiAssistantMessages/{chat_id}/messages/m{i}", {
+            "role": role, "content": f"message {i} " + "x" * 1600, "timestamp": i, "isCxInteraction": False,
+        })
+    upstream.reply = {"id": chat_id, "message": "Hello!", "cta": "", "tokenUsage": {}}
+    db.reset_ops()
+
+    from api.http.text_assistant.send_text_assistant_message import ai_send_text_assistant_message
+    with flask.Flask(__name__).test_request_context("/", method="POST", json={"userId": "u1", "message": "hi", "id": chat_id}):
+        response = ai_send_text_assistant_message(flask.request)
+    assert response.status_code == 200, json.loads(response.get_data())
+
+    assert db.ops["commits"] == 1
+    summary = db.data(f"{AI_ASSISTANT_CHATS_COLLECTION}/{chat_id}")["historySummary"]
+    sent = upstream.calls[0][1]["json"]["previousMessages"]
+    assert sent[0]["output"].startswith("Summary of the earlier conversation:")
+    summarized = 10 - (len(sent) - 1)
+    assert summary["coversThrough"] == summarized
+    assert len(summary["text"].split("\n")) == summarized
+    # the timestamps only anchor the summary; they are not sent upstream
+    assert all("timestamp" not in m for m in sent)
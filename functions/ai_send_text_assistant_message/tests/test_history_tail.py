@@ -0,0 +1,35 @@
+"""
+The tail history query: the latest N assistant-visible turns, even when system
+events the query cannot exclude sit among them.
+"""
+import uuid
+
+
+def _put_messages(db, chat_id, events):
+    for i, event in enumerate(events, start=1):
+        db.put(f"aiAssistantMessages/{chat_id}/messages/m{i:02d}", {
+            "role": "user" if i % 2 else "assistant",
+            "content": f"message {i}",
+            "timestamp": i,
+            "isCxInteraction": event == "cx",
+            "event": event if event != "cx" else None,
+        })
+
+
+def test_tail_reads_on_past_human_agent_joined_events(db):
+    from services.ai_chat_service import AiChatService
+    chat_id = str(uuid.uuid4())
+    # 30 messages; among the latest: two humanAgentJoined events and a CX reply
+    events = [None] * 30
+    events[24] = events[27] = "humanAgentJoined"
+    events[26] = "cx"
+    _put_messages(db, chat_id, events)
+    db.reset_ops()
+
+    history = AiChatService().get_conversation_history(chat_id, limit=10)
+
+    contents = [m["output"] for m in history]
+    expected = [f"message {i}" for i in range(1, 31) if events[i - 1] is None][-10:]
+    assert contents == expected
+    # one extra page for the two events dropped after reading
+    assert db.ops["queries"] == 2
@@ -0,0 +1,122 @@
+"""
+The SSE variant of a turn (_stream_reply) against a streaming fake upstream: the
+frames sent to the client, a client that disconnects mid-stream, and what happens
+to the Idempotency-Key when the stream ends without a stored response.
+"""
+import json
+import uuid
+from unittest import mock
+
+import flask
+import pytest
+
+from utils.sse import format_sse_event, iter_sse_events
+
+app = flask.Flask(__name__)
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    import api.http.text_assistant.send_text_assistant_message as handler
+    # the fake has no transactions; what the stream does with the key is what is checked
+    store = mock.MagicMock()
+    store.begin.return_value = None
+    monkeypatch.setattr(handler, "idempotency_store", store)
+    return handler
+
+
+def _upstream_stream(chat_id, *deltas, done=True):
+    lines = []
+    for delta in deltas:
+        lines += format_sse_event("token", {"delta": delta}).split("\n")[:-1]
+    if done:
+        result = {"id": chat_id, "message": "".join(deltas), "cta": "", "tokenUsage": {"totalTokens": 7}}
+        lines += format_sse_event("done", result).split("\n")[:-1]
+    return lines
+
+
+def _open_stream(handler, chat_id, key="key-1"):
+    """Starts a streamed turn; returns the response body iterator (the SSE generator)."""
+    with app.test_request_context(
+        "/", method="POST", json={"userId": "u1", "message": "hi"},
+        headers={"Accept": "text/event-stream", "Idempotency-Key": key},
+    ):
+        response = handler.ai_send_text_assistant_message(flask.request)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    return response.response
+
+
+def _frames(chunks):
+    lines = "".join(chunks).split("\n")
+    return [(event, json.loads(data)) for event, data in iter_sse_events(lines)]
+
+
+def _messages(db, chat_id):
+    return list(db.children(f"aiAssistantMessages/{chat_id}/messages").values())
+
+
+def test_stream_relays_tokens_then_done_and_stores_the_response(db, upstream, handler):
+    chat_id = str(uuid.uuid4())
+    upstream.stream = _upstream_stream(chat_id, "**Hel", "lo**")
+
+    frames = _frames(_open_stream(handler, chat_id))
+
+    assert [event for event, _ in frames] == ["token", "token", "done"]
+    assert [data["delta"] for _, data in frames[:2]] == ["**Hel", "lo**"]
+    done = frames[2][1]
+    assert done["conversationId"] == chat_id
+    assert done["reply"] == "<p><strong>Hello</strong></p>"
+    # persisted before `done`, and the body is what a retry with the same key replays
+    assert len(_messages(db, chat_id)) == 2
+    handler.idempotency_store.complete.assert_called_once_with("u1", "key-1", 200, done)
+    handler.idempotency_store.release.assert_not_called()
+    assert upstream.streams[0].closed
+
+
+def test_client_disconnect_still_finishes_and_stores_the_turn(db, upstream, handler, capsys):
+    chat_id = str(uuid.uuid4())
+    upstream.stream = _upstream_stream(chat_id, "one ", "two ", "three")
+
+    body = _open_stream(handler, chat_id)
+    first = next(body)
+    body.close()  # GeneratorExit at the first yield, as when the client goes away
+
+    assert _frames([first]) == [("token", {"delta": "one "})]
+    # the rest of the upstream stream was read and the whole reply stored
+    assert upstream.streams[0].lines_read == len(upstream.stream)
+    stored = [m for m in _messages(db, chat_id) if m["role"] == "assistant"]
+    assert stored[0]["content"] == "<p>one two three</p>"
+    handler.idempotency_store.complete.assert_called_once()
+    handler.idempotency_store.release.assert_not_called()
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert record["stream"] == "disconnected"
+
+
+def test_upstream_failure_sends_error_and_releases_the_key(db, upstream, handler):
+    chat_id = str(uuid.uuid4())
+    upstream.stream = _upstream_stream(chat_id, "partial", done=False) + format_sse_event(
+        "error", "model overloaded"
+    ).split("\n")[:-1]
+
+    frames = _frames(_open_stream(handler, chat_id))
+
+    assert [event for event, _ in frames] == ["token", "error"]
+    assert "model overloaded" in frames[1][1]["error"]
+    assert _messages(db, chat_id) == []
+    handler.idempotency_store.complete.assert_not_called()
+    handler.idempotency_store.release.assert_called_once_with("u1", "key-1")
+
+
+def test_disconnect_then_upstream_failure_releases_the_key(db, upstream, handler):
+    chat_id = str(uuid.uuid4())
+    upstream.stream = _upstream_stream(chat_id, "one ", done=False) + [ConnectionError("upstream reset")]
+
+    body = _open_stream(handler, chat_id)
+    next(body)
+    body.close()
+
+    # nothing was stored, so a retry must be able to run the turn again right away
+    assert _messages(db, chat_id) == []
+    handler.idempotency_store.complete.assert_not_called()
+    handler.idempotency_store.release.assert_called_once_with("u1", "key-1")
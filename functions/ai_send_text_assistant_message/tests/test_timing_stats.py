@@ -0,0 +1,69 @@
+"""
+Instance counters registered with register_stats are logged in every timing record
+under `stats`.
+"""
+import itertools
+import json
+import time
+
+import flask
+import pytest
+
+from dingdoor_utils_package.timing import RequestTimer
+from utils.resilience import CircuitOpenError, _hedged, call_upstream, get_upstream
+
+
+def _record(capsys):
+    capsys.readouterr()
+    RequestTimer("test").emit(status=200)
+    return json.loads(capsys.readouterr().out.splitlines()[-1])
+
+
+def test_open_breaker_is_in_the_timing_record(capsys):
+    upstream = get_upstream("stats-breaker")
+
+    def fail():
+        raise ConnectionError("down")
+
+    for _ in range(upstream.breaker.min_calls):
+        with pytest.raises(ConnectionError):
+            call_upstream(upstream, fail, is_failure=lambda e: True)
+    with pytest.raises(CircuitOpenError):
+        call_upstream(upstream, fail, is_failure=lambda e: True)
+
+    breaker = _record(capsys)["stats"]["upstreams"]["stats-breaker"]["breaker"]
+    assert breaker["state"] == "open"
+    assert (breaker["opened"], breaker["rejected"]) == (1, 1)
+
+
+def test_hedge_rates_are_in_the_timing_record(capsys):
+    upstream = get_upstream("stats-hedge")
+    calls = itertools.count()
+
+    def slow_then_fast():
+        if next(calls) == 0:
+            time.sleep(0.2)  # the first request stalls past the hedge delay
+            return "first"
+        return "second"
+
+    assert _hedged(upstream, slow_then_fast, delay=0.02) == "second"
+    assert _hedged(upstream, lambda: "fast", delay=0.5) == "fast"  # answered before the delay: no hedge
+
+    hedge = _record(capsys)["stats"]["upstreams"]["stats-hedge"]["hedge"]
+    assert (hedge["armed"], hedge["hedged"], hedge["hedgeWins"]) == (2, 1, 1)
+    assert (hedge["firedRate"], hedge["wonRate"]) == (0.5, 1.0)
+
+
+def test_history_cache_misses_are_in_the_timing_record(db, upstream, capsys):
+    from api.http.text_assistant.send_text_assistant_message import ai_chat_service, ai_send_text_assistant_message
+    # a chat this instance has never cached: its history is read, a miss
+    db.put("aiAssistantChats/c-miss", {"userId": "u1", "lastMessageAt": 1})
+    misses = ai_chat_service.history_cache_stats()["misses"]
+    upstream.reply = {"id": "c-miss", "message": "Hello!", "cta": "", "tokenUsage": {}}
+
+    capsys.readouterr()
+    with flask.Flask(__name__).test_request_context("/", method="POST", json={"userId": "u1", "message": "hi", "id": "c-miss"}):
+        assert ai_send_text_assistant_message(flask.request).status_code == 200
+    record = json.loads(capsys.readouterr().out.splitlines()[-1])
+
+    assert record["stats"]["historyCache"]["misses"] == misses + 1
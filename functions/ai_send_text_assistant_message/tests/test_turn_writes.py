@@ -0,0 +1,147 @@
+"""
+Firestore operations per turn: both messages and the chat document go out in one
+commit, and nothing reads the chat document before writing it.
+"""
+import json
+import uuid
+import flask
+import pytest
+from utils.ai_chat_utils import AI_ASSISTANT_CHATS_COLLECTION, save_turn_to_firestore
+
+app = flask.Flask(__name__)
+
+
+def _save_turn(db, chat_id, user_id, is_new_chat):
+    messages = db.collection("aiAssistantMessages").document(chat_id).collection("messages")
+    user_ref = messages.document()
+    return save_turn_to_firestore(
+        db, chat_id, user_id, "Hello!", "Title", messages, user_ref, user_ref.id,
+        "hi", 1000, "Hello!", 2000, None, {}, {"totalTokens": 5},
+        is_new_chat=is_new_chat,
+    )
+
+
+def _chat(db, chat_id):
+    return db.data(f"{AI_ASSISTANT_CHATS_COLLECTION}/{chat_id}")
+
+
+def test_new_chat_turn_is_one_commit_and_no_reads(db):
+    _, _, chat_metadata = _save_turn(db, "c1", "u1", is_new_chat=True)
+
+    assert db.ops["commits"] == 1
+    assert db.ops["reads"] == 0
+    assert "createdAt" in chat_metadata
+    chat = _chat(db, "c1")
+    assert (chat["userId"], chat["title"], chat["totalMessageCount"]) == ("u1", "Title", 2)
+    assert len(db.children("aiAssistantMessages/c1/messages")) == 2
+
+
+def test_existing_chat_turn_is_one_commit_and_keeps_owner(db):
+    db.put(f"{AI_ASSISTANT_CHATS_COLLECTION}/c1", {"id": "c1", "userId": "owner", "title": "Mine", "createdAt": 1, "totalMessageCount": 4})
+    db.reset_ops()
+
+    _, _, chat_metadata = _save_turn(db, "c1", "someone-else", is_new_chat=False)
+
+    assert db.ops["commits"] == 1
+    assert db.ops["reads"] == 0
+    assert "createdAt" not in chat_metadata
+    chat = _chat(db, "c1")
+    assert (chat["userId"], chat["title"], chat["createdAt"]) == ("owner", "Mine", 1)
+    assert chat["totalMessageCount"] == 6
+    assert chat["lastMessage"] == "Hello!"
+
+
+@pytest.mark.parametrize("exists", [True, False])
+def test_wrong_new_chat_guess_costs_one_more_commit(db, exists):
+    if exists:
+        db.put(f"{AI_ASSISTANT_CHATS_COLLECTION}/c1", {"id": "c1", "userId": "owner", "title": "Mine", "totalMessageCount": 4})
+        db.reset_ops()
+
+    _, _, chat_metadata = _save_turn(db, "c1", "u1", is_new_chat=exists)
+
+    # the failed batch applied nothing; the retry with the other guess is the only write
+    assert db.ops["commits"] == 2
+    assert db.ops["reads"] == 0
+    assert ("createdAt" in chat_metadata) is not exists
+    assert _chat(db, "c1")["userId"] == ("owner" if exists else "u1")
+    assert _chat(db, "c1")["totalMessageCount"] == (6 if exists else 2)
+    assert len(db.children("aiAssistantMessages/c1/messages")) == 2
+
+
+def _post_turn(body):
+    from api.http.text_assistant.send_text_assistant_message import ai_send_text_assistant_message
+    with app.test_request_context("/", method="POST", json=body):
+        response = ai_send_text_assistant_message(flask.request)
+    return response.status_code, json.loads(response.get_data())
+
+
+def test_handler_turn_operation_counts(db, upstream):
+    chat_id = str(uuid.uuid4())
+    upstream.reply = {"id": chat_id, "message": "**Hello!**", "cta": "", "tokenUsage": {"totalTokens": 5}}
+
+    # first turn of a new chat: no history to load, one commit
+    status, body = _post_turn({"userId": "u1", "message": "hi"})
+    assert status == 200 and body["conversationId"] == chat_id
+    assert (db.ops["commits"], db.ops["reads"], db.ops["queries"]) == (1, 0, 0)
+
+    # next turn: the history is cached from the turn just written, so the only read is
+    # its version check (the chat's lastMessageAt); still one commit
+    db.reset_ops()
+    status, body = _post_turn({"userId": "u1", "message": "again", "id": chat_id})
+    assert status == 200
+    assert (db.ops["commits"], db.ops["reads"], db.ops["queries"]) == (1, 1, 0)
+
+    chat = _chat(db, chat_id)
+    assert chat["userId"] == "u1"
+    assert chat["totalMessageCount"] == 4
+    assert len(db.children(f"aiAssistantMessages/{chat_id}/messages")) == 4
+
+
+def test_write_behind_stores_the_turn_and_defers_the_handoff(db, upstream, monkeypatch):
+    import api.http.text_assistant.send_text_assistant_message as handler
+    monkeypatch.setattr(handler, "WRITE_BEHIND", True)
+    dispatched = []
+    monkeypatch.setattr(handler.task_queue, "_dispatch", lambda task_id, ordering_key: dispatched.append(task_id))
+    chat_id = str(uuid.uuid4())
+    upstream.reply = {"id": chat_id, "message": "A person will take over.", "cta": "human_handoff", "ctaData": "asked for a person", "tokenUsage": {}}
+
+    status, body = _post_turn({"userId": "u1", "message": "a person please"})
+
+    # the turn and its handoff task go out in one commit; the handoff call waits for the task
+    assert status == 200
+    assert (db.ops["commits"], db.ops["reads"], db.ops["queries"]) == (1, 0, 0)
+    assert len(db.children(f"aiAssistantMessages/{chat_id}/messages")) == 2
+    assert [url for url, _ in upstream.calls] == ["http://assistant.test/chat"]
+    task = db.data(f"aiAssistantTasks/{dispatched[0]}")
+    assert (task["kind"], task["status"], task["payload"]["reason"]) == ("humanHandoff", "pending", "asked for a person")
+
+    # the next turn's history already has this one, whether or not the task has run
+    status, _ = _post_turn({"userId": "u1", "message": "hello?", "id": chat_id})
+    assert status == 200
+    assert [m["output"] for m in upstream.calls[-1][1]["json"]["previousMessages"]][0] == "a person please"
+
+    assert handler.task_queue.run_task(dispatched[0])
+    assert upstream.calls[-1][0] == "http://assistant.test/handoff"
+    assert db.data(f"aiAssistantTasks/{dispatched[0]}")["status"] == "done"
+
+
+def test_sign_task_writes_the_urls_to_the_stored_message(db, monkeypatch):
+    import services.turn_tasks as turn_tasks
+    from api.http.text_assistant.send_text_assistant_message import task_queue
+    attachments = [{"filename": "a.pdf", "storagePath": "conversations/u1/blobs/abc"}]
+    db.put("aiAssistantMessages/c1/messages/m1", {"role": "user", "content": "see file", "attachments": attachments})
+
+    def sign(bucket, items):
+        for a in items:
+            a["url"] = f"https://signed.test/{bucket}/{a['storagePath']}"
+        return items
+
+    monkeypatch.setattr(turn_tasks, "sign_attachments", sign)
+    dispatched = []
+    monkeypatch.setattr(task_queue, "_dispatch", lambda task_id, ordering_key: dispatched.append(task_id))
+    task_queue.enqueue(turn_tasks.SIGN_ATTACHMENTS, turn_tasks.sign_payload("c1", "m1", "bucket", attachments), "c1")
+
+    assert task_queue.run_task(dispatched[0])
+    stored = db.data("aiAssistantMessages/c1/messages/m1")["attachments"]
+    assert stored == [{**attachments[0], "url": "https://signed.test/bucket/conversations/u1/blobs/abc"}]
+    assert db.data(f"aiAssistantTasks/{dispatched[0]}")["status"] == "done"
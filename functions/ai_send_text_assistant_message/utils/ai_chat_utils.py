@@ -1,19 +1,20 @@
 import os
 import datetime
 import time
+from google.api_core.exceptions import AlreadyExists, NotFound
 from google.cloud.firestore import Increment
 from datetime import datetime
+from dingdoor_utils_package.token_usage import chat_usage_fields, stage_daily_usage, usage_counters
 from models.ai_assistant_chat import AiAssistantMessage
 
 AI_ASSISTANT_CHATS_COLLECTION = os.getenv("AI_ASSISTANT_CHATS_COLLECTION", "aiAssistantChats")
 
-def save_messages_to_firestore(db,messages_collection, user_message_ref, user_message_id,user_message, user_timestamp, assistant_reply, assistant_timestamp, cta ,cta_data, token_usage,offline_msg="", attachments=None):
+def _build_turn_messages(messages_collection, user_message_id, user_message, user_timestamp, assistant_reply, assistant_timestamp, cta, cta_data, token_usage, offline_msg="", attachments=None, assistant_message_id=None):
     """
-    Save both user and assistant messages to Firestore
-    in messages/{chatId}/messages/ collection
+    Builds the user and assistant message documents for one turn.
+    `assistant_message_id` reuses an id allocated earlier (write-behind), otherwise one is generated.
+    Returns (assistant_message_ref, user_message_data, assistant_message_data).
     """
-    # Create message collection reference
-    
     # Create user message
     user_message_data = AiAssistantMessage(
         role="user",
@@ -26,7 +27,7 @@ def save_messages_to_firestore(db,messages_collection, user_message_ref, user_me
     ).__dict__
     
     # Create assistant message
-    assistant_message_ref = messages_collection.document()  # Auto-generate ID
+    assistant_message_ref = messages_collection.document(assistant_message_id)  # Auto-generate ID unless given
     assistant_message_data = AiAssistantMessage(
         role="assistant", 
         content=assistant_reply if not offline_msg else offline_msg,
@@ -37,63 +38,112 @@ def save_messages_to_firestore(db,messages_collection, user_message_ref, user_me
         id=assistant_message_ref.id,  # Use the auto-generated ID
         isCxInteraction=False
     ).__dict__
-    
-    # Use a batch write for efficiency
-    batch = db.batch()
-    batch.set(user_message_ref, user_message_data)
-    batch.set(assistant_message_ref, assistant_message_data)
-    batch.commit()
 
-    return user_message_data, assistant_message_data
+    return assistant_message_ref, user_message_data, assistant_message_data
 
 
-def update_chat_metadata(db, chat_id, user_id, last_message, title, message_count=2):
+def build_turn_batch(db, chat_id, user_id, last_message, title, messages_collection, user_message_ref, user_message_id, user_message, user_timestamp, assistant_reply, assistant_timestamp, cta, cta_data, token_usage, offline_msg="", attachments=None, is_new_chat=False, message_count=2, assistant_message_id=None, history_summary=None):
     """
-    Updates or creates the chat document metadata in Firestore.
-    
-    Args:
-        db: Firestore client instance
-        chat_id: ID of the chat to update
-        user_id: ID of the user who owns the chat
-        message_count: Number of messages to add to the count (default=2 for user+assistant)
-        
-    Returns:
-        The updated or created chat document data
+    Stages both messages of a turn and the chat document metadata in one write batch
+    (no read). Works with both firestore.Client and firestore.AsyncClient; the caller
+    commits (`batch.commit()` / `await batch.commit()`), normally through
+    save_turn_to_firestore / commit_turn_async, which correct a wrong `is_new_chat`.
+
+    The chat document is:
+      - created when `is_new_chat`, with id/userId/title/createdAt. create() fails the
+        batch (AlreadyExists) when the chat exists, so an owner is never overwritten;
+      - otherwise updated (lastMessage*, updatedAt, counters only). update() fails the
+        batch (NotFound) when the chat does not exist yet.
+      - totalMessageCount uses Increment, so concurrent turns never lose counts
+      - the turn's tokenUsage is added to the chat totals and to the per-user/per-day
+        counters (utils/token_usage.py) in the same batch, so rollups never drift from the messages
+      - `history_summary`, the chat's rolled history summary (AiChatService.compact_history),
+        is written as `historySummary` with the turn instead of in a write of its own
+
+    Returns (batch, user_message_data, assistant_message_data, chat_metadata) where
+    chat_metadata holds the plain values written (lastMessageAt/updatedAt/lastMessage,
+    historySummary when given, plus id/userId/title/createdAt when the chat is created).
     """
-    doc_ref = db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id)
-    
-    # Check if document exists
-    doc_snapshot = doc_ref.get()
+    assistant_message_ref, user_message_data, assistant_message_data = _build_turn_messages(
+        messages_collection, user_message_id, user_message, user_timestamp, assistant_reply, assistant_timestamp,
+        cta, cta_data, token_usage, offline_msg, attachments, assistant_message_id
+    )
+
     now = int(time.time() * 1000)
-    if doc_snapshot.exists:
-        # Update existing document with atomic increment
-        update_data = {
-            "lastMessageAt": now,
-            "updatedAt": now,
+    chat_metadata = {
+        "lastMessageAt": now,
+        "updatedAt": now,
+        "lastMessage": last_message,
+    }
+    if history_summary:
+        chat_metadata["historySummary"] = {**history_summary, "updatedAt": now}
+    chat_ref = db.collection(AI_ASSISTANT_CHATS_COLLECTION).document(chat_id)
+
+    usage = usage_counters(token_usage)
+    batch = db.batch()
+    if is_new_chat:
+        chat_metadata.update({"id": chat_id, "userId": user_id, "title": title, "createdAt": now})
+        batch.create(chat_ref, {
+            **chat_metadata,
             "totalMessageCount": Increment(message_count),
-            "lastMessage": last_message
-        }
-        doc_ref.update(update_data)
-        
-        # Return the updated data by getting the current values first
-        current_data = doc_snapshot.to_dict()
-        # Create a new dict for the response with manually calculated count
-        response_data = current_data.copy()
-        response_data["lastMessageAt"] = now
-        response_data["updatedAt"] = now
-        response_data["totalMessageCount"] = (current_data.get("totalMessageCount") or 0) + message_count
-        return response_data
+            **(chat_usage_fields(usage) if usage else {}),
+        })
     else:
-        # Create new document
-        new_chat_data = {
-            "id": chat_id,
-            "userId": user_id,
-            "createdAt": now,
-            "lastMessageAt": now,
-            "updatedAt": now,
-            "totalMessageCount": message_count,
-            "lastMessage": last_message,
-            "title": title
-        }
-        doc_ref.set(new_chat_data)
-        return new_chat_data
+        batch.update(chat_ref, {
+            **chat_metadata,
+            "totalMessageCount": Increment(message_count),
+            **(chat_usage_fields(usage, field_paths=True) if usage else {}),
+        })
+    if usage:
+        stage_daily_usage(batch, db, user_id, usage, assistant_timestamp)
+    batch.set(user_message_ref, user_message_data)
+    batch.set(assistant_message_ref, assistant_message_data)
+
+    return batch, user_message_data, assistant_message_data, chat_metadata
+
+
+def wrong_chat_guess(error: Exception, is_new_chat: bool) -> bool:
+    """
+    True when a turn batch failed only because `is_new_chat` was wrong: create() on a
+    chat that exists, or update() on one that does not (e.g. a client-chosen id). The
+    batch applied nothing, so it can be rebuilt with the opposite guess and committed.
+    """
+    return isinstance(error, AlreadyExists) if is_new_chat else isinstance(error, NotFound)
+
+
+def save_turn_to_firestore(*args, is_new_chat=False, prepare=None, **kwargs):
+    """
+    Writes both messages of a turn and the chat document metadata in a single commit.
+    Takes the same arguments as build_turn_batch; `is_new_chat` is a guess, corrected once if wrong.
+    `prepare(batch)` adds the caller's own writes to the batch before each commit.
+
+    Returns (user_message_data, assistant_message_data, chat_metadata); chat_metadata
+    has `createdAt` when this turn created the chat.
+    """
+    for attempt in range(2):
+        batch, user_message_data, assistant_message_data, chat_metadata = build_turn_batch(*args, is_new_chat=is_new_chat, **kwargs)
+        if prepare is not None:
+            prepare(batch)
+        try:
+            batch.commit()
+            return user_message_data, assistant_message_data, chat_metadata
+        except (AlreadyExists, NotFound) as e:
+            if attempt or not wrong_chat_guess(e, is_new_chat):
+                raise
+            is_new_chat = not is_new_chat
+
+
+async def commit_turn_async(*args, is_new_chat=False, prepare=None, **kwargs):
+    """save_turn_to_firestore for firestore.AsyncClient."""
+    for attempt in range(2):
+        batch, user_message_data, assistant_message_data, chat_metadata = build_turn_batch(*args, is_new_chat=is_new_chat, **kwargs)
+        if prepare is not None:
+            prepare(batch)
+        try:
+            await batch.commit()
+            return user_message_data, assistant_message_data, chat_metadata
+        except (AlreadyExists, NotFound) as e:
+            if attempt or not wrong_chat_guess(e, is_new_chat):
+                raise
+            is_new_chat = not is_new_chat
+
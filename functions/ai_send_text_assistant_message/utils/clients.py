@@ -0,0 +1,20 @@
+import threading
+from google.cloud import firestore
+
+_firestore_client = None
+_firestore_lock = threading.Lock()
+
+
+def get_firestore_client() -> firestore.Client:
+    """
+    Returns the process-wide Firestore client, created on first use.
+
+    The handler and AiChatService share this one client (one gRPC channel)
+    instead of each building their own at import time.
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        with _firestore_lock:
+            if _firestore_client is None:
+                _firestore_client = firestore.Client()
+    return _firestore_client
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+class HistoryCache:
+    """
+    Bounded LRU + TTL cache of recent conversation history, keyed by chat id.
+
+    Each entry carries a `version` (the chat document's `lastMessageAt` after the
+    last write this instance knows about). Callers compare it against the chat
+    document to detect writes made elsewhere (other instances, the insert function).
+    """
+
+    def __init__(self, max_chats: int = 512, ttl_seconds: float = 600, max_messages: int = 20):
+        self.max_chats = max_chats
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "readsSaved": 0}
+
+    def get(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """Returns {"messages": [...], "version": ...} or None if absent/expired."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["storedAt"] > self.ttl_seconds:
+                del self._entries[chat_id]
+                return None
+            self._entries.move_to_end(chat_id)
+            return {"messages": list(entry["messages"]), "version": entry["version"]}
+
+    def put(self, chat_id: str, messages: List[Dict], version: Any = None) -> None:
+        with self._lock:
+            self._entries[chat_id] = {
+                "messages": list(messages)[-self.max_messages:],
+                "version": version,
+                "storedAt": time.monotonic(),
+            }
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+
+    def append(self, chat_id: str, messages: List[Dict], version: Any = None) -> bool:
+        """Appends to an existing entry; returns False (no-op) when the chat is not cached."""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is None:
+                return False
+            entry["messages"] = (entry["messages"] + list(messages))[-self.max_messages:]
+            entry["version"] = version
+            entry["storedAt"] = time.monotonic()
+            self._entries.move_to_end(chat_id)
+            return True
+
+    def invalidate(self, chat_id: str) -> None:
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def record(self, stat: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[stat] += amount
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
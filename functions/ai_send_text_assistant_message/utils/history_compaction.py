@@ -0,0 +1,193 @@
+import hashlib
+import html
+import os
+import re
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Tuple
+
+# Rough budget for previousMessages sent upstream (~4 characters per token for en/es text)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_SUMMARY_TOKEN_BUDGET = int(os.getenv("HISTORY_SUMMARY_TOKEN_BUDGET", "500"))
+# at least 1: the newest message is always sent as-is
+HISTORY_MIN_RECENT_MESSAGES = max(1, int(os.getenv("HISTORY_MIN_RECENT_MESSAGES", "2")))
+# a single message longer than this is cut before it is counted against the budget
+HISTORY_MESSAGE_MAX_CHARS = int(os.getenv("HISTORY_MESSAGE_MAX_CHARS", "4000"))
+# each message folded into the rolling summary contributes at most this much text
+SUMMARY_LINE_MAX_CHARS = 240
+CHARS_PER_TOKEN = 4
+ATTACHMENT_FIELDS = ("fileId", "filename", "contentType")
+# stored history entries carry their message timestamp; it anchors the summary and is not sent upstream
+ANCHOR_KEY = "timestamp"
+
+_BLOCK_TAGS = {"p", "br", "ul", "ol", "div", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "tr"}
+_WHITESPACE = re.compile(r"[ \t]+")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+        elif tag == "li":
+            self.parts.append("\n- ")
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+
+def html_to_text(value: str) -> str:
+    """Plain text of a stored (rendered) message; text without markup is returned as-is."""
+    if not value:
+        return ""
+    if "<" not in value:
+        return html.unescape(value).strip()
+    parser = _TextExtractor()
+    parser.feed(value)
+    parser.close()
+    text = _WHITESPACE.sub(" ", "".join(parser.parts))
+    return _BLANK_LINES.sub("\n\n", "\n".join(line.strip() for line in text.splitlines())).strip()
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _text_key(message: Dict) -> str:
+    # stored history uses "output"; client-sent previousMessages may use "content"
+    return "output" if "output" in message or "content" not in message else "content"
+
+
+def slim_message(message: Dict) -> Dict:
+    """Same shape as the input entry, with HTML reduced to text and attachments reduced to ids/names."""
+    key = _text_key(message)
+    text = html_to_text(message.get(key) or "")
+    if len(text) > HISTORY_MESSAGE_MAX_CHARS:
+        text = text[:HISTORY_MESSAGE_MAX_CHARS].rstrip() + " …"
+    slim = {**message, key: text}
+    if message.get("attachments"):
+        slim["attachments"] = [
+            {f: a[f] for f in ATTACHMENT_FIELDS if a.get(f)} for a in message["attachments"] if isinstance(a, dict)
+        ]
+    return slim
+
+
+def message_tokens(message: Dict) -> int:
+    names = " ".join(a.get("filename", "") for a in message.get("attachments") or [])
+    return estimate_tokens(f"{message.get('role', '')}: {message.get(_text_key(message)) or ''} {names}")
+
+
+def position_fingerprints(messages: List[Dict], width: int = 3) -> List[str]:
+    """
+    One fingerprint per message, over it and the `width - 1` messages before it, so a
+    position is still recognised when short replies ("ok", "thanks") repeat.
+    """
+    fingerprints = []
+    for i in range(len(messages)):
+        window = messages[max(0, i - width + 1):i + 1]
+        raw = "\x1e".join(f"{m.get('role', '')}\x1f{m.get(_text_key(m)) or ''}" for m in window)
+        fingerprints.append(hashlib.sha1(raw.encode("utf-8")).hexdigest())
+    return fingerprints
+
+
+def _is_timestamp(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def message_anchors(messages: List[Dict]) -> List[Any]:
+    """
+    What the rolling summary records as the last message it covers: the stored
+    `timestamp` (epoch ms) of history read from Firestore, or a position fingerprint
+    when the messages carry none (client-sent previousMessages).
+    """
+    if all(_is_timestamp(m.get(ANCHOR_KEY)) for m in messages):
+        return [m[ANCHOR_KEY] for m in messages]
+    return position_fingerprints(messages)
+
+
+def upstream_message(message: Dict) -> Dict:
+    """A compacted entry without the anchor, as sent upstream."""
+    return {k: v for k, v in message.items() if k != ANCHOR_KEY}
+
+
+def split_to_budget(
+    messages: List[Dict],
+    budget: int = HISTORY_TOKEN_BUDGET,
+    min_recent: int = HISTORY_MIN_RECENT_MESSAGES,
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Slims every message and keeps the newest ones that fit in `budget` tokens
+    (always at least `min_recent`). Returns (older, recent), both oldest-first.
+    """
+    slimmed = [slim_message(m) for m in messages]
+    kept = 0
+    used = 0
+    for message in reversed(slimmed):
+        cost = message_tokens(message)
+        if kept >= min_recent and used + cost > budget:
+            break
+        used += cost
+        kept += 1
+    cut = len(slimmed) - kept
+    return slimmed[:cut], slimmed[cut:]
+
+
+def _summary_line(message: Dict) -> str:
+    text = " ".join((message.get(_text_key(message)) or "").split())
+    if len(text) > SUMMARY_LINE_MAX_CHARS:
+        text = text[:SUMMARY_LINE_MAX_CHARS].rsplit(" ", 1)[0] + " …"
+    role = "User" if message.get("role") == "user" else "Assistant"
+    return f"{role}: {text}"
+
+
+def _covered_count(covers_through: Any, anchors: List[Any]) -> Optional[int]:
+    """How many of `anchors` (oldest first) the stored summary already covers, or None if unknown."""
+    if _is_timestamp(covers_through) and all(_is_timestamp(a) for a in anchors):
+        # also right when the covered message has since fallen out of the window
+        return sum(1 for a in anchors if a <= covers_through)
+    if covers_through in anchors:
+        return len(anchors) - anchors[::-1].index(covers_through)
+    return None
+
+
+def roll_summary(previous: Optional[Dict], older: List[Dict], budget: int = HISTORY_SUMMARY_TOKEN_BUDGET) -> Optional[Dict]:
+    """
+    Folds the messages that fell out of the budget into the chat's rolling summary.
+
+    `previous` is the stored summary ({"text", "coversThrough"}); only messages after the
+    one it already covers are added, and the oldest lines are dropped once the summary
+    exceeds `budget`. When it cannot be told which of `older` the stored text covers
+    (its anchor is gone and the messages have no timestamps), the summary is rebuilt
+    from `older` rather than appended to. Returns the same dict when nothing new was
+    folded in, or None when there is nothing to summarize.
+    """
+    if not older:
+        return previous
+    anchors = message_anchors(older)
+    start = _covered_count(previous.get("coversThrough"), anchors) if previous else None
+    if start == len(older):
+        return previous
+
+    lines = [line for line in previous.get("text", "").split("\n") if line] if start is not None else []
+    lines.extend(_summary_line(m) for m in older[start or 0:])
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return {"text": "\n".join(lines), "coversThrough": anchors[-1]}
+
+
+def summary_message(summary: Dict, like: Optional[Dict] = None) -> Dict:
+    """
+    The rolling summary as the first previousMessages entry, keyed like the entries it
+    precedes. previousMessages only carries user/assistant turns, so the summary is a
+    context turn in the role opposite to the entry after it (roles keep alternating).
+    """
+    key = _text_key(like) if like else "output"
+    role = "assistant" if like and like.get("role") == "user" else "user"
+    return {"role": role, key: f"Summary of the earlier conversation:\n{summary['text']}", "attachments": []}
@@ -0,0 +1,78 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Pool sizing / retry policy for upstream calls (assistant, enhanced request, handoff)
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))   # number of per-host pools kept
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))          # keep-alive connections per host
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.3"))
+
+_session = None
+_session_lock = threading.Lock()
+_async_client = None
+
+
+def _build_retry() -> Retry:
+    # Only connection-level failures are retried: the request never reached the
+    # upstream, so replaying a POST cannot duplicate an LLM call or a handoff.
+    return Retry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        raise_on_status=False,
+    )
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=_build_retry(),
+        pool_block=False,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the process-wide pooled session.
+
+    The session lives at module level so warm invocations reuse the open
+    TCP/TLS connections to each upstream host instead of handshaking per call.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get_async_http_client():
+    """
+    Process-wide pooled httpx.AsyncClient for the async handler, sized from the
+    same HTTP_* settings. httpx transport retries cover connection failures only,
+    matching the sync retry policy. httpx is imported lazily so the sync handler
+    never pays for it.
+    """
+    global _async_client
+    if _async_client is None:
+        import httpx
+        limits = httpx.Limits(
+            max_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+            max_keepalive_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+        )
+        _async_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_MAX_RETRIES, limits=limits),
+        )
+    return _async_client
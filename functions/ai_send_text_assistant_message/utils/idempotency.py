@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Optional
+from google.cloud import firestore
+
+IDEMPOTENCY_COLLECTION = os.getenv("AI_ASSISTANT_IDEMPOTENCY_COLLECTION", "aiAssistantIdempotency")
+# how long a finished response can be replayed (also the Firestore TTL field, see README)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# a pending claim older than this is treated as abandoned (crashed instance) and can be taken over
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "180"))
+# how long a duplicate waits for the first request to finish before giving up with 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "75"))
+# a duplicate waiting on an owner on the same instance still re-reads the document this often
+IDEMPOTENCY_LOCAL_POLL_SECONDS = float(os.getenv("IDEMPOTENCY_LOCAL_POLL_SECONDS", "5"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class IdempotencyError(ValueError):
+    """Raised when a key cannot be honoured; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+def request_fingerprint(chat_id: Optional[str], message: str, files: Optional[Iterable] = None) -> str:
+    """Hash of what makes two requests "the same": chat, message text and uploaded file names."""
+    names = sorted(fname for (fname, _, _) in (files or []))
+    raw = json.dumps({"chatId": chat_id or "", "message": message, "files": names}, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Records the response of the first request made with an `Idempotency-Key` so that
+    retries replay it instead of calling the assistant (and writing the turn) again.
+
+    One Firestore document per (userId, key):
+      status "pending" while the first request runs (leaseExpiresAt guards crashed owners),
+      status "done" with the stored response until expiresAt.
+    Duplicates arriving while the first request is pending wait for it: on the same
+    instance through an in-process event (still re-reading the document every
+    IDEMPOTENCY_LOCAL_POLL_SECONDS, in case the owner never signals), otherwise by
+    polling the document.
+    """
+
+    def __init__(self, db_getter: Callable[[], firestore.Client], collection: str = IDEMPOTENCY_COLLECTION):
+        self._db_getter = db_getter
+        self.collection = collection
+        self._local: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def _doc_id(self, user_id: str, key: str) -> str:
+        return hashlib.sha256(f"{user_id}:{key}".encode("utf-8")).hexdigest()
+
+    def _ref(self, doc_id: str):
+        return self._db_getter().collection(self.collection).document(doc_id)
+
+    def _try_claim(self, doc_id: str, user_id: str, fingerprint: str) -> Dict[str, Any]:
+        """One transactional attempt: {"state": "claimed" | "done" | "pending", "response": ...}."""
+        db = self._db_getter()
+        ref = self._ref(doc_id)
+
+        @firestore.transactional
+        def _claim(transaction):
+            now = datetime.now(timezone.utc)
+            snap = ref.get(transaction=transaction)
+            data = snap.to_dict() if snap.exists else None
+            abandoned = data is not None and (
+                data.get("expiresAt") is None or data["expiresAt"] <= now
+                or (data.get("status") == "pending" and data.get("leaseExpiresAt") and data["leaseExpiresAt"] <= now)
+            )
+            if data is None or abandoned:
+                transaction.set(ref, {
+                    "userId": user_id,
+                    "fingerprint": fingerprint,
+                    "status": "pending",
+                    "createdAt": now,
+                    "leaseExpiresAt": now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+                    "expiresAt": now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+                })
+                return {"state": "claimed"}
+            if data.get("fingerprint") != fingerprint:
+                raise IdempotencyError("Idempotency-Key was already used with a different request", 422)
+            if data.get("status") == "done":
+                return {"state": "done", "response": data.get("response") or {}}
+            return {"state": "pending"}
+
+        return _claim(db.transaction())
+
+    def begin(self, user_id: str, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Claims the key for this request. Returns None when the caller owns it (and must
+        later call complete() or release()), or the stored {"statusCode", "body"} to replay.
+        Raises IdempotencyError (409) if the first request is still running after
+        IDEMPOTENCY_WAIT_SECONDS, or (422) if the key was used for a different request.
+        """
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise IdempotencyError(f"Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters", 400)
+        doc_id = self._doc_id(user_id, key)
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        delay = 0.25
+        while True:
+            outcome = self._try_claim(doc_id, user_id, fingerprint)
+            if outcome["state"] == "claimed":
+                with self._lock:
+                    self._local.setdefault(doc_id, threading.Event())
+                return None
+            if outcome["state"] == "done":
+                return outcome["response"]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IdempotencyError("A request with this Idempotency-Key is still in progress", 409)
+            with self._lock:
+                event = self._local.get(doc_id)
+            if event is not None:
+                # the owner runs on this instance: wake up as soon as it finishes, and
+                # fall back to the document if it never signals
+                event.wait(min(IDEMPOTENCY_LOCAL_POLL_SECONDS, remaining))
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 2.0)
+
+    def complete(self, user_id: str, key: str, status_code: int, body: Dict[str, Any]) -> None:
+        """Stores the response for replay until the TTL expires."""
+        doc_id = self._doc_id(user_id, key)
+        now = datetime.now(timezone.utc)
+        self._ref(doc_id).update({
+            "status": "done",
+            "response": {"statusCode": status_code, "body": body},
+            "completedAt": now,
+            "expiresAt": now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+        })
+        self._wake(doc_id)
+
+    def release(self, user_id: str, key: str) -> None:
+        """Drops a claim whose request failed, so a retry recomputes instead of replaying the error."""
+        doc_id = self._doc_id(user_id, key)
+        self._ref(doc_id).delete()
+        self._wake(doc_id)
+
+    def _wake(self, doc_id: str) -> None:
+        with self._lock:
+            event = self._local.pop(doc_id, None)
+        if event is not None:
+            event.set()
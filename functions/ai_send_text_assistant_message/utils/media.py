@@ -0,0 +1,125 @@
+import os
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, List, Tuple
+from dingdoor_utils_package.uploads import FileTuple, stream_size
+
+# Optional preprocessing of uploads before they go upstream and to GCS (Pillow / pikepdf)
+MEDIA_PREPROCESS = os.getenv("MEDIA_PREPROCESS", "false").lower() == "true"
+MEDIA_MAX_DIMENSION = int(os.getenv("MEDIA_MAX_DIMENSION", "2048"))      # longest side, px
+MEDIA_JPEG_QUALITY = int(os.getenv("MEDIA_JPEG_QUALITY", "85"))          # also used for WEBP
+MEDIA_MIN_BYTES = int(os.getenv("MEDIA_MIN_BYTES", str(256 * 1024)))    # smaller files are left alone
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+SPOOL_MAX_MEMORY_BYTES = 1024 * 1024
+
+IMAGE_FORMATS = {"image/jpeg": "JPEG", "image/jpg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+PDF_TYPES = {"application/pdf"}
+
+# Pillow and zlib release the GIL while resizing/encoding, so threads are enough here
+_media_pool = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+
+
+def _spooled() -> IO[bytes]:
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES)
+
+
+def _optimize_image(stream: IO[bytes], image_format: str) -> IO[bytes]:
+    from PIL import Image, ImageOps
+
+    stream.seek(0)
+    with Image.open(stream) as img:
+        # apply the EXIF orientation before the EXIF block is dropped on save
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MEDIA_MAX_DIMENSION, MEDIA_MAX_DIMENSION), Image.LANCZOS)
+        out = _spooled()
+        try:
+            if image_format == "JPEG":
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                img.save(out, "JPEG", quality=MEDIA_JPEG_QUALITY, optimize=True, progressive=True)
+            elif image_format == "WEBP":
+                img.save(out, "WEBP", quality=MEDIA_JPEG_QUALITY, method=4)
+            else:
+                img.save(out, "PNG", optimize=True)
+        except Exception:
+            out.close()
+            raise
+    return out
+
+
+def _optimize_pdf(stream: IO[bytes]) -> IO[bytes]:
+    import pikepdf
+
+    stream.seek(0)
+    out = _spooled()
+    try:
+        with pikepdf.open(stream) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                out,
+                linearize=True,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+    except Exception:
+        out.close()
+        raise
+    return out
+
+
+def optimize_file(file: FileTuple) -> FileTuple:
+    """
+    Returns a smaller copy of an image (downscaled to MEDIA_MAX_DIMENSION, re-encoded
+    in its own format, metadata stripped) or PDF (linearized, streams compressed).
+    The filename and content type are kept; the original is returned when the file
+    type is not handled, is below MEDIA_MIN_BYTES, fails to process, or would not shrink.
+    """
+    fname, stream, ctype = file
+    kind = (ctype or "").lower()
+    size = stream_size(stream)
+    if size < MEDIA_MIN_BYTES or (kind not in IMAGE_FORMATS and kind not in PDF_TYPES):
+        return file
+    try:
+        out = _optimize_image(stream, IMAGE_FORMATS[kind]) if kind in IMAGE_FORMATS else _optimize_pdf(stream)
+    except ImportError as e:
+        logging.warning(f"Media preprocessing enabled but its dependency is missing: {e}")
+        return file
+    except Exception as e:
+        logging.warning(f"Could not optimize '{fname}' ({ctype}), sending the original: {e}")
+        return file
+    finally:
+        stream.seek(0)
+
+    new_size = stream_size(out)
+    if new_size >= size:
+        out.close()
+        return file
+    logging.info(f"Optimized '{fname}' ({ctype}): {size} -> {new_size} bytes")
+    return (fname, out, ctype)
+
+
+def preprocess_media(file_list: List[FileTuple], keep_original: bool = False) -> Tuple[List[FileTuple], List[FileTuple]]:
+    """
+    Runs optimize_file over the uploads on the shared media pool (order preserved).
+
+    Returns (upstream_files, storage_files): the assistant always gets the optimized
+    files; GCS gets the originals only when `keep_original` is requested.
+    With MEDIA_PREPROCESS off both are `file_list` unchanged. The optimized copies are
+    the caller's to close, with close_copies() once the turn no longer needs them.
+    """
+    if not MEDIA_PREPROCESS or not file_list:
+        return file_list, file_list
+    if len(file_list) == 1:
+        optimized = [optimize_file(file_list[0])]
+    else:
+        optimized = list(_media_pool.map(optimize_file, file_list))
+    return optimized, (file_list if keep_original else optimized)
+
+
+def close_copies(file_list: List[FileTuple], processed: List[FileTuple]) -> None:
+    """Closes the spooled copies in `processed`; the original uploads belong to the request."""
+    originals = {id(stream) for _, stream, _ in file_list}
+    for _, stream, _ in processed:
+        if id(stream) not in originals:
+            stream.close()
@@ -0,0 +1,307 @@
+import os
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+from dingdoor_utils_package.timing import register_stats
+
+# Rolling-window circuit breaker (one per upstream)
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))              # no verdict on fewer calls
+BREAKER_FAILURE_RATIO = float(os.getenv("BREAKER_FAILURE_RATIO", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "20"))      # fail fast this long, then probe
+# Hedging: a second request once the first is slower than this percentile of recent latencies
+HEDGE_UPSTREAMS = {u.strip() for u in os.getenv("HEDGE_UPSTREAMS", "").split(",") if u.strip()}
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "8"))
+LATENCY_WINDOW_SIZE = 200
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the upstream while its breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} upstream unavailable (circuit open), retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    closed    -> calls go through; outcomes are kept for BREAKER_WINDOW_SECONDS
+    open      -> once the window holds BREAKER_MIN_CALLS with a failure ratio at or above
+                 BREAKER_FAILURE_RATIO; calls fail fast for BREAKER_OPEN_SECONDS
+    half_open -> a single probe call is let through: success closes, failure re-opens
+    """
+
+    def __init__(self, name: str, window_seconds: float = BREAKER_WINDOW_SECONDS, min_calls: int = BREAKER_MIN_CALLS,
+                 failure_ratio: float = BREAKER_FAILURE_RATIO, open_seconds: float = BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self._outcomes: "deque[tuple]" = deque()  # (monotonic ts, ok)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def _trim(self, now: float) -> None:
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
+
+    def _transition(self, state: str) -> None:
+        if state != self._state:
+            logging.warning(f"Circuit breaker '{self.name}': {self._state} -> {state}")
+            self._state = state
+
+    def before_call(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self._state == "open":
+                remaining = self.open_seconds - (now - self._opened_at)
+                if remaining > 0:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self._transition("half_open")
+            if self._state == "half_open":
+                if self._probe_in_flight:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpenError(self.name, 1)
+                self._probe_in_flight = True
+            self._counters["calls"] += 1
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not ok:
+                self._counters["failures"] += 1
+            if self._state == "half_open":
+                self._probe_in_flight = False
+                self._outcomes.clear()
+                if ok:
+                    self._transition("closed")
+                else:
+                    self._open(now)
+                return
+            self._outcomes.append((now, ok))
+            self._trim(now)
+            failures = sum(1 for _, success in self._outcomes if not success)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_ratio:
+                self._open(now)
+
+    def _open(self, now: float) -> None:
+        self._opened_at = now
+        self._counters["opened"] += 1
+        self._outcomes.clear()
+        self._transition("open")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._trim(time.monotonic())
+            window_failures = sum(1 for _, ok in self._outcomes if not ok)
+            return dict(self._counters, state=self._state, windowCalls=len(self._outcomes), windowFailures=window_failures)
+
+
+class LatencyWindow:
+    """Last LATENCY_WINDOW_SIZE successful latencies (seconds) of one upstream."""
+
+    def __init__(self, size: int = LATENCY_WINDOW_SIZE):
+        self._samples: "deque[float]" = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float, min_samples: int = HEDGE_MIN_SAMPLES) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Upstream:
+    """Breaker, latency window and hedge counters for one upstream endpoint."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.latency = LatencyWindow()
+        self.hedge_enabled = name in HEDGE_UPSTREAMS
+        self._lock = threading.Lock()
+        self._hedges = {"armed": 0, "hedged": 0, "hedgeWins": 0}  # armed: calls that could have been hedged
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._hedges[key] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        return self.latency.percentile(HEDGE_PERCENTILE) if self.hedge_enabled else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            hedges = dict(self._hedges)
+        p50 = self.latency.percentile(50, min_samples=1)
+        return {
+            "breaker": self.breaker.snapshot(),
+            "hedge": dict(
+                hedges,
+                enabled=self.hedge_enabled,
+                delaySeconds=self.hedge_delay(),
+                firedRate=round(hedges["hedged"] / hedges["armed"], 3) if hedges["armed"] else None,
+                wonRate=round(hedges["hedgeWins"] / hedges["hedged"], 3) if hedges["hedged"] else None,
+            ),
+            "latencyP50Seconds": p50,
+        }
+
+
+_upstreams: Dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+
+def get_upstream(name: str) -> Upstream:
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = Upstream(name)
+        return _upstreams[name]
+
+
+def resilience_stats() -> Dict[str, Any]:
+    """Breaker state, hedge counters and latency per upstream, for logs/metrics."""
+    with _upstreams_lock:
+        upstreams = list(_upstreams.values())
+    return {u.name: u.snapshot() for u in upstreams}
+
+
+register_stats("upstreams", resilience_stats)
+
+
+def jittered_delays(retries: int, base: float, cap: float) -> Iterator[float]:
+    """Full-jitter exponential backoff: uniform(0, min(cap, base * 2**attempt))."""
+    for attempt in range(retries):
+        yield random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def call_upstream(
+    upstream: Upstream,
+    fn: Callable[[], Any],
+    is_failure: Callable[[Exception], bool],
+    retries: int = 0,
+    backoff_base: float = 0.2,
+    backoff_cap: float = 2.0,
+    hedge: bool = False,
+) -> Any:
+    """
+    Runs `fn` (one upstream request) behind the upstream's breaker.
+
+    `retries` re-runs `fn` after a jittered backoff when `is_failure(e)`; only pass it
+    for idempotent calls. `hedge` (also only for idempotent, replayable requests) fires
+    a second `fn` when the first is slower than the recent latency percentile and
+    returns whichever finishes first. Exceptions from `fn` are re-raised unchanged;
+    CircuitOpenError is raised without calling `fn` while the breaker is open.
+    """
+    upstream.breaker.before_call()
+    delays = jittered_delays(retries, backoff_base, backoff_cap)
+    while True:
+        started = time.monotonic()
+        try:
+            delay = upstream.hedge_delay() if hedge else None
+            result = _hedged(upstream, fn, delay) if delay is not None else fn()
+        except Exception as e:
+            failed = is_failure(e)
+            retry_in = next(delays, None) if failed else None
+            if retry_in is None:
+                upstream.breaker.record(not failed)
+                raise
+            time.sleep(retry_in)
+            continue
+        upstream.latency.add(time.monotonic() - started)
+        upstream.breaker.record(True)
+        return result
+
+
+def _hedged(upstream: Upstream, fn: Callable[[], Any], delay: float) -> Any:
+    upstream._count("armed")
+    first = _hedge_pool.submit(fn)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    upstream._count("hedged")
+    second = _hedge_pool.submit(fn)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    upstream._count("hedgeWins")
+                # the slower request cannot be cancelled mid-flight; its result is discarded
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+async def call_upstream_async(
+    upstream: Upstream,
+    fn: Callable[[], Awaitable[Any]],
+    is_failure: Callable[[Exception], bool],
+    retries: int = 0,
+    backoff_base: float = 0.2,
+    backoff_cap: float = 2.0,
+    hedge: bool = False,
+) -> Any:
+    """asyncio version of call_upstream; the losing hedge is cancelled."""
+    upstream.breaker.before_call()
+    delays = jittered_delays(retries, backoff_base, backoff_cap)
+    while True:
+        started = time.monotonic()
+        try:
+            delay = upstream.hedge_delay() if hedge else None
+            result = await (_hedged_async(upstream, fn, delay) if delay is not None else fn())
+        except Exception as e:
+            failed = is_failure(e)
+            retry_in = next(delays, None) if failed else None
+            if retry_in is None:
+                upstream.breaker.record(not failed)
+                raise
+            await asyncio.sleep(retry_in)
+            continue
+        upstream.latency.add(time.monotonic() - started)
+        upstream.breaker.record(True)
+        return result
+
+
+async def _hedged_async(upstream: Upstream, fn: Callable[[], Awaitable[Any]], delay: float) -> Any:
+    upstream._count("armed")
+    first = asyncio.ensure_future(fn())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    upstream._count("hedged")
+    second = asyncio.ensure_future(fn())
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        upstream._count("hedgeWins")
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,36 @@
+import json
+from typing import Any, Iterable, Iterator, Tuple
+
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Serializes one Server-Sent Event; `data` is sent as a single JSON line."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def iter_sse_events(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Parses a text/event-stream line iterator into (event, data) pairs.
+    Multi-line `data:` fields are joined with newlines; comments are skipped.
+    """
+    event = "message"
+    data_lines = []
+    for line in lines:
+        if line is None:
+            continue
+        if line == "":
+            if data_lines:
+                yield event, "\n".join(data_lines)
+            event = "message"
+            data_lines = []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "event":
+            event = value
+        elif field == "data":
+            data_lines.append(value)
+    if data_lines:
+        yield event, "\n".join(data_lines)
@@ -0,0 +1,64 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Dict, Iterable, Tuple
+from dingdoor_utils_package.timing import timed
+
+# A stage is (fn, dependency names); fn receives a dict with the results of its dependencies.
+Stage = Tuple[Callable[[Dict[str, Any]], Any], Iterable[str]]
+
+STAGE_GRAPH_WORKERS = int(os.getenv("STAGE_GRAPH_WORKERS", "8"))
+
+_stage_pool = ThreadPoolExecutor(max_workers=STAGE_GRAPH_WORKERS, thread_name_prefix="stages")
+
+
+def _timed_stage(name: str, fn: Callable[[Dict[str, Any]], Any], dep_results: Dict[str, Any]) -> Any:
+    with timed(name):
+        return fn(dep_results)
+
+
+def run_stage_graph(stages: Dict[str, Stage]) -> Dict[str, Any]:
+    """
+    Runs `stages` concurrently, starting each one as soon as all of its
+    dependencies have finished. Returns {stage name: result}.
+    Each stage runs in the caller's context and is timed under its own name.
+
+    If a stage raises, no new stage is started, the ones already running are
+    allowed to finish, and the first error is re-raised to the caller. Stages
+    depending on a failed stage therefore never run.
+    """
+    deps = {name: set(stage_deps) for name, (_, stage_deps) in stages.items()}
+    for name, stage_deps in deps.items():
+        missing = stage_deps - stages.keys()
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on unknown stages: {sorted(missing)}")
+
+    results: Dict[str, Any] = {}
+    pending = dict(stages)
+    running = {}
+    error = None
+
+    while pending or running:
+        if error is None:
+            ready = [name for name in pending if deps[name] <= results.keys()]
+            for name in ready:
+                fn, _ = pending.pop(name)
+                dep_results = {d: results[d] for d in deps[name]}
+                running[_stage_pool.submit(contextvars.copy_context().run, _timed_stage, name, fn, dep_results)] = name
+            if not running and pending:
+                raise ValueError(f"Stage graph has a cycle between: {sorted(pending)}")
+        elif not running:
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            exc = future.exception()
+            if exc is not None:
+                error = error or exc
+            else:
+                results[name] = future.result()
+
+    if error is not None:
+        raise error
+    return results
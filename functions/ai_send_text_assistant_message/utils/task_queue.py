@@ -0,0 +1,291 @@
+import os
+import logging
+import queue
+import random
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# Firestore-backed work queue for write-behind persistence (see README "Write-behind persistence")
+TASKS_COLLECTION = os.getenv("AI_ASSISTANT_TASKS_COLLECTION", "aiAssistantTasks")
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "2"))                  # local worker threads per instance
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "8"))        # then the task is parked as "failed"
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "120"))    # a claimed task is re-run after this
+TASK_SWEEP_SECONDS = float(os.getenv("TASK_SWEEP_SECONDS", "30"))   # how often due/orphaned tasks are picked up
+TASK_SWEEP_LIMIT = int(os.getenv("TASK_SWEEP_LIMIT", "25"))
+TASK_BACKOFF_BASE_SECONDS = float(os.getenv("TASK_BACKOFF_BASE_SECONDS", "2"))
+TASK_BACKOFF_CAP_SECONDS = float(os.getenv("TASK_BACKOFF_CAP_SECONDS", "300"))
+TASK_TTL_SECONDS = int(os.getenv("TASK_TTL_SECONDS", str(7 * 24 * 3600)))  # done/failed tasks expire (TTL on expiresAt)
+
+# identifies this instance as the lease owner of the tasks it claims
+WORKER_ID = uuid.uuid4().hex
+
+
+class LeaseLost(Exception):
+    """The task was re-claimed by another worker (our lease expired) or already finished."""
+
+
+class Task:
+    """A claimed task as seen by its handler."""
+
+    def __init__(self, db: firestore.Client, ref, kind: str, payload: Dict[str, Any], attempt: int, update_time):
+        self.db = db
+        self.ref = ref
+        self.id = ref.id
+        self.kind = kind
+        self.payload = payload
+        self.attempt = attempt
+        self._update_time = update_time
+        self.completed = False
+
+    def _precondition(self):
+        # the write only applies while the task document is exactly as we claimed it
+        return self.db.write_option(last_update_time=self._update_time)
+
+    def complete_in(self, batch) -> None:
+        """
+        Marks the task done in the handler's own write batch, so its writes and the
+        completion commit together: a batch from a worker whose lease was lost fails
+        as a whole, which keeps non-idempotent writes (counters) from being applied twice.
+        """
+        batch.update(self.ref, _finished("done"), option=self._precondition())
+        self.completed = True
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _finished(status: str, error: Optional[str] = None) -> Dict[str, Any]:
+    fields = {"status": status, "finishedAt": _now_ms(), "expiresAt": _now_ms() + TASK_TTL_SECONDS * 1000}
+    if error is not None:
+        fields["lastError"] = error
+    return fields
+
+
+def _backoff_seconds(attempt: int) -> float:
+    # full jitter, as for upstream retries
+    return random.uniform(0, min(TASK_BACKOFF_CAP_SECONDS, TASK_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+class TaskQueue:
+    """
+    Durable queue of `{kind, payload}` tasks stored in TASKS_COLLECTION.
+
+    enqueue() writes the task document (the durability point) and hands its id to
+    `dispatch`. By default that is the in-process worker pool: TASK_WORKERS threads,
+    each task routed by its ordering key so tasks sharing a key run in enqueue order
+    on this instance. A sweeper re-dispatches tasks that are due again (retries) or
+    whose lease expired (e.g. the instance that took them was shut down).
+
+    To move execution to Cloud Tasks, pass a `dispatch` that creates an HTTP task
+    pointing at an endpoint calling `run_task(task_id)`; claiming, retries and
+    completion stay the same.
+
+    Delivery is at-least-once. run_task claims a task with a conditional update (one
+    runner at a time, for TASK_LEASE_SECONDS); handlers that must not repeat writes use
+    `task.complete_in(batch)`. Call start() at startup so the sweeper also runs on
+    instances that have not enqueued anything yet.
+    """
+
+    def __init__(self, db_getter: Callable[[], firestore.Client], dispatch: Optional[Callable[[str, str], None]] = None):
+        self._db = db_getter
+        self._handlers: Dict[str, Callable[[Task], Any]] = {}
+        self._dispatch = dispatch or self._dispatch_local
+        self._queues: List["queue.Queue[str]"] = []
+        self._started = False
+        self._lock = threading.Lock()
+        self._stats = {"enqueued": 0, "done": 0, "retried": 0, "failed": 0, "leaseLost": 0, "swept": 0}
+
+    def register(self, kind: str, handler: Callable[[Task], Any]) -> None:
+        self._handlers[kind] = handler
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            backlog = sum(q.qsize() for q in self._queues)
+            return dict(self._stats, localBacklog=backlog)
+
+    def _collection(self):
+        return self._db().collection(TASKS_COLLECTION)
+
+    # ---- producer ----
+
+    def _new_task(self, kind: str, payload: Dict[str, Any], ordering_key: Optional[str]) -> Tuple[Any, Dict[str, Any]]:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for task kind '{kind}'")
+        ref = self._collection().document()
+        now = _now_ms()
+        return ref, {
+            "kind": kind,
+            "payload": payload,
+            "orderingKey": ordering_key or ref.id,
+            "status": "pending",
+            "attempts": 0,
+            "createdAt": now,
+            "notBefore": now,
+        }
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], ordering_key: Optional[str] = None) -> str:
+        """Stores the task (raises if Firestore rejects it) and dispatches it; returns the task id."""
+        ref, data = self._new_task(kind, payload, ordering_key)
+        ref.create(data)
+        self._count("enqueued")
+        self._dispatch(ref.id, data["orderingKey"])
+        return ref.id
+
+    def stage(self, batch, kind: str, payload: Dict[str, Any], ordering_key: Optional[str] = None) -> Callable[[], str]:
+        """
+        Adds the task document to the caller's write batch instead of writing it on its
+        own, so the task is stored in the same commit as the writes it follows up on.
+        Returns the function that dispatches the task (and returns its id): call it
+        once the batch has committed. A task whose batch never commits does not exist.
+        """
+        ref, data = self._new_task(kind, payload, ordering_key)
+        batch.create(ref, data)
+
+        def dispatch() -> str:
+            self._count("enqueued")
+            self._dispatch(ref.id, data["orderingKey"])
+            return ref.id
+
+        return dispatch
+
+    # ---- local worker ----
+
+    def _dispatch_local(self, task_id: str, ordering_key: str) -> None:
+        self.start()
+        self._queues[zlib.crc32(ordering_key.encode()) % len(self._queues)].put(task_id)
+
+    def start(self) -> None:
+        """Starts the local workers and the sweeper (once; later calls do nothing)."""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            for i in range(max(1, TASK_WORKERS)):
+                q: "queue.Queue[str]" = queue.Queue()
+                self._queues.append(q)
+                threading.Thread(target=self._work, args=(q,), name=f"tasks-{i}", daemon=True).start()
+            threading.Thread(target=self._sweep_forever, name="tasks-sweep", daemon=True).start()
+            self._started = True
+
+    def _work(self, q: "queue.Queue[str]") -> None:
+        while True:
+            task_id = q.get()
+            try:
+                self.run_task(task_id)
+            except Exception:
+                logging.exception(f"Task {task_id} could not be run")
+
+    def _sweep_forever(self) -> None:
+        while True:
+            time.sleep(TASK_SWEEP_SECONDS)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.warning(f"Task sweep failed: {e}")
+
+    def sweep(self) -> int:
+        """Dispatches pending tasks whose notBefore has passed (retries and expired leases)."""
+        docs = (
+            self._collection()
+            .where(filter=FieldFilter("status", "==", "pending"))
+            .where(filter=FieldFilter("notBefore", "<=", _now_ms()))
+            .order_by("notBefore")
+            .limit(TASK_SWEEP_LIMIT)
+            .get()
+        )
+        for doc in docs:
+            self._dispatch(doc.id, (doc.to_dict() or {}).get("orderingKey") or doc.id)
+        if docs:
+            self._count("swept", len(docs))
+        return len(docs)
+
+    # ---- consumer ----
+
+    def _claim(self, ref) -> Optional[Tuple[Dict[str, Any], Any]]:
+        """
+        Claims a due task: returns (its data as claimed, update_time of the claim write),
+        or None. The claim is an update conditioned on the update_time of the snapshot
+        it was decided from, so of two workers racing for a task only one write applies;
+        its WriteResult gives the update_time that every later write is conditioned on.
+        """
+        snap = ref.get()
+        data = snap.to_dict() if snap.exists else None
+        if not data or data.get("status") != "pending" or data.get("notBefore", 0) > _now_ms():
+            return None
+        claim = {
+            "attempts": data.get("attempts", 0) + 1,
+            "notBefore": _now_ms() + TASK_LEASE_SECONDS * 1000,  # the lease: swept again once it lapses
+            "leaseOwner": WORKER_ID,
+        }
+        try:
+            result = ref.update(claim, option=self._db().write_option(last_update_time=snap.update_time))
+        except FailedPrecondition:
+            self._count("leaseLost")
+            return None
+        return {**data, **claim}, result.update_time
+
+    def run_task(self, task_id: str) -> bool:
+        """
+        Claims and runs one task. Returns False when there was nothing to do (already
+        done, not due yet, or claimed by another worker). A handler error schedules a
+        retry with jittered exponential backoff, up to TASK_MAX_ATTEMPTS.
+        """
+        db = self._db()
+        ref = self._collection().document(task_id)
+        claimed = self._claim(ref)
+        if claimed is None:
+            return False
+        data, update_time = claimed
+        task = Task(db, ref, data.get("kind"), data.get("payload") or {}, data["attempts"], update_time)
+
+        handler = self._handlers.get(task.kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for task kind '{task.kind}'")
+            handler(task)
+            if not task.completed:
+                ref.update(_finished("done"), option=task._precondition())
+            self._count("done")
+            return True
+        except Exception as e:
+            if _is_precondition_failure(e) or isinstance(e, LeaseLost):
+                self._count("leaseLost")
+                logging.warning(f"Task {task_id} ({task.kind}) lost its lease, leaving it to the other worker")
+                return False
+            self._fail(task, e)
+            return False
+
+    def _fail(self, task: Task, error: Exception) -> None:
+        message = f"{type(error).__name__}: {error}"[:1000]
+        try:
+            if task.attempt >= TASK_MAX_ATTEMPTS:
+                logging.error(f"Task {task.id} ({task.kind}) failed after {task.attempt} attempts, giving up: {message}")
+                task.ref.update(_finished("failed", message), option=task._precondition())
+                self._count("failed")
+            else:
+                delay = _backoff_seconds(task.attempt)
+                logging.warning(f"Task {task.id} ({task.kind}) attempt {task.attempt} failed, retrying in {delay:.1f}s: {message}")
+                task.ref.update(
+                    {"notBefore": _now_ms() + int(delay * 1000), "lastError": message, "leaseOwner": None},
+                    option=task._precondition(),
+                )
+                self._count("retried")
+        except Exception as e:
+            # the lease lapses on its own and the sweeper retries the task
+            logging.warning(f"Could not record failure of task {task.id}: {e}")
+
+
+def _is_precondition_failure(e: Exception) -> bool:
+    return isinstance(e, FailedPrecondition)
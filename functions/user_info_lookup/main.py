@@ -6,12 +6,15 @@ from functions_framework import http
 from google.cloud.logging_v2.handlers import StructuredLogHandler
 
 from dingdoor_utils_package import fetch_one
+from dingdoor_utils_package.responses import finalize_response
 from utils.phone import normalize_phone
 
 load_dotenv()
 
 #loading env vars
 env = os.getenv("ENV", "DEV")
+# lookups are per phone number (personal data) and the warehouse changes slowly
+CACHE_CONTROL = os.getenv("CACHE_CONTROL", "private, max-age=300")
 
 
 # ------------- logging (structured -> Cloud Logging) -----------------
@@ -35,6 +38,11 @@ SELECT postalCode, name, lastName FROM ranked WHERE rn = 1 ORDER BY createdAt DE
 
 @http
 def http_lookup(request: Request):
+    # GET answers carry an ETag + Cache-Control and revalidate to 304; larger bodies are gzip/br encoded
+    return finalize_response(request, make_response(_lookup(request)), etag=True, cache_control=CACHE_CONTROL)
+
+
+def _lookup(request: Request):
     if request.method == "POST":
         body = request.get_json(silent=True) or {}
         phone = body.get("phoneNumber")
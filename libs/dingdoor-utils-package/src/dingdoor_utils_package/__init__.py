@@ -1,3 +1,11 @@
-from .bq_utils import get_client, fetch_all, fetch_one
+# Submodules are imported explicitly (e.g. `from dingdoor_utils_package.responses import
+# finalize_response`), so a function only needs the extras of the helpers it uses.
+# The BigQuery helpers stay importable from the package root, loaded on first access.
 __all__ = ["get_client", "fetch_all", "fetch_one"]
 
+
+def __getattr__(name):
+    if name in __all__:
+        from . import bq_utils
+        return getattr(bq_utils, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
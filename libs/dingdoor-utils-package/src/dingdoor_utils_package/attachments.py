@@ -0,0 +1,154 @@
+import os
+import contextvars
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, List, Optional
+from google.api_core.exceptions import PreconditionFailed
+from .signing import get_storage_client, signed_url
+from .timing import register_stats
+from .uploads import FileTuple, stream_sha256, stream_size
+
+ATTACHMENT_UPLOAD_WORKERS = int(os.getenv("ATTACHMENT_UPLOAD_WORKERS", "4"))
+# files above the threshold go through a resumable upload in fixed-size chunks
+RESUMABLE_UPLOAD_THRESHOLD_BYTES = int(os.getenv("RESUMABLE_UPLOAD_THRESHOLD_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))  # multiple of 256 KB
+# content-addressed storage: identical files share one object under `content_prefix/<sha256><ext>`
+ATTACHMENT_DEDUP = os.getenv("ATTACHMENT_DEDUP", "true").lower() == "true"
+KNOWN_BLOBS_CACHE_SIZE = int(os.getenv("ATTACHMENT_KNOWN_BLOBS_CACHE_SIZE", "4096"))
+
+# bounded pool shared by every request served by this instance
+_upload_pool = ThreadPoolExecutor(max_workers=ATTACHMENT_UPLOAD_WORKERS, thread_name_prefix="attachments")
+
+# content-addressed objects this instance has already seen in the bucket (skips the upload)
+_known_blobs: "OrderedDict[str, bool]" = OrderedDict()
+_known_blobs_lock = threading.Lock()
+_dedup_stats = {"uploaded": 0, "deduplicated": 0, "bytesSaved": 0}
+
+
+def _remember_blob(key: str) -> None:
+    with _known_blobs_lock:
+        _known_blobs[key] = True
+        _known_blobs.move_to_end(key)
+        while len(_known_blobs) > KNOWN_BLOBS_CACHE_SIZE:
+            _known_blobs.popitem(last=False)
+
+
+def _is_known_blob(key: str) -> bool:
+    with _known_blobs_lock:
+        if key in _known_blobs:
+            _known_blobs.move_to_end(key)
+            return True
+        return False
+
+
+def dedup_stats() -> dict:
+    with _known_blobs_lock:
+        return dict(_dedup_stats, knownBlobs=len(_known_blobs))
+
+
+register_stats("attachmentDedup", dedup_stats)
+
+
+def content_blob_path(content_prefix: str, sha256: str, filename: str) -> str:
+    return f"{content_prefix}/{sha256}{os.path.splitext(filename)[1].lower()}"
+
+
+def upload_to_bucket(
+    bucket_name: str,
+    blob_path: str,
+    stream: IO[bytes],
+    content_type: str,
+    filename: Optional[str] = None,
+    if_absent: bool = False,
+    sign: bool = True,
+) -> dict:
+    """
+    Uploads `stream` to `blob_path` and returns the attachment metadata stored on the message.
+
+    With `if_absent` (content-addressed paths) an object that already exists is reused:
+    the create is conditional (if_generation_match=0), and its PreconditionFailed means
+    the content is already stored, so no exists() call is made first and concurrent
+    uploads of the same content cannot clobber each other. `filename` is the name shown to the user
+    (defaults to the object name). With `sign=False` the `url` is left empty for
+    sign_attachments to fill in later.
+    """
+    size = stream_size(stream)
+    filename = filename or os.path.basename(blob_path)
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(blob_path)
+    cache_key = f"{bucket_name}/{blob_path}"
+
+    reused = if_absent and _is_known_blob(cache_key)
+    if not reused:
+        if size > RESUMABLE_UPLOAD_THRESHOLD_BYTES:
+            blob.chunk_size = UPLOAD_CHUNK_BYTES
+        # set before upload so the metadata travels with the object (no follow-up patch)
+        blob.cache_control = "public, max-age=3600"
+        blob.content_disposition = f'inline; filename="{filename}"'
+        try:
+            blob.upload_from_file(
+                stream, size=size, content_type=content_type, rewind=True,
+                if_generation_match=0 if if_absent else None,
+            )
+        except PreconditionFailed:
+            if not if_absent:
+                raise
+            reused = True  # already uploaded (earlier, or by a concurrent request)
+    if if_absent:
+        _remember_blob(cache_key)
+    with _known_blobs_lock:
+        if reused:
+            _dedup_stats["deduplicated"] += 1
+            _dedup_stats["bytesSaved"] += size
+        else:
+            _dedup_stats["uploaded"] += 1
+
+    return {
+        "filename": filename,
+        "contentType": content_type,
+        "bytes": size,
+        "storagePath": blob_path,
+        "gcsUri": f"gs://{bucket_name}/{blob_path}",
+        "url": signed_url(bucket_name, blob_path, filename) if sign else None,
+    }
+
+
+def _upload_one(bucket_name: str, base_path: str, file: FileTuple, content_prefix: Optional[str], sign: bool) -> dict:
+    fname, stream, ctype = file
+    if not (content_prefix and ATTACHMENT_DEDUP):
+        return upload_to_bucket(bucket_name, f"{base_path}/{fname}", stream, ctype, sign=sign)
+    sha256 = stream_sha256(stream)
+    attachment = upload_to_bucket(
+        bucket_name, content_blob_path(content_prefix, sha256, fname), stream, ctype, filename=fname, if_absent=True,
+        sign=sign,
+    )
+    attachment["sha256"] = sha256
+    return attachment
+
+
+def upload_attachments(
+    bucket_name: str, base_path: str, file_list: List[FileTuple], content_prefix: Optional[str] = None,
+    sign: bool = True,
+) -> List[dict]:
+    """
+    Uploads every file concurrently on the shared bounded pool.
+
+    With `content_prefix` (and ATTACHMENT_DEDUP on) each file is stored once per
+    content hash under `content_prefix/` and re-sends reuse the existing object;
+    otherwise files go under `base_path/` as before. `sign=False` skips the signed
+    URLs (see signing.sign_attachments).
+
+    Returns the attachment metadata in the same order as `file_list`.
+    An upload failure is raised to the caller, same as the sequential loop did.
+    """
+    if not file_list:
+        return []
+    if len(file_list) == 1:
+        return [_upload_one(bucket_name, base_path, file_list[0], content_prefix, sign)]
+
+    futures = [
+        _upload_pool.submit(contextvars.copy_context().run, _upload_one, bucket_name, base_path, file, content_prefix, sign)
+        for file in file_list
+    ]
+    return [f.result() for f in futures]
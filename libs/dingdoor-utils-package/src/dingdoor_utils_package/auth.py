@@ -0,0 +1,47 @@
+import os
+from typing import Any, Dict
+import firebase_admin
+from firebase_admin import auth
+
+# custom claim (set with auth.set_custom_user_claims) that marks staff allowed to read any user's data
+ADMIN_CLAIM = os.getenv("ADMIN_CLAIM", "admin")
+
+
+class Unauthorized(Exception):
+    """The request carries no valid Firebase ID token."""
+
+
+_app = None
+def get_app():
+    global _app
+    if _app is None:
+        try:
+            _app = firebase_admin.get_app()
+        except ValueError:
+            _app = firebase_admin.initialize_app()
+    return _app
+
+
+def verified_claims(request) -> Dict[str, Any]:
+    """
+    Decoded claims of the Firebase ID token sent as `Authorization: Bearer <token>`.
+    Signature, expiry and audience (this project) are checked; the public keys are
+    cached by firebase_admin, so this costs no request once warm.
+    """
+    scheme, _, token = (request.headers.get("Authorization") or "").partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or not token:
+        raise Unauthorized("Missing Firebase ID token")
+    try:
+        return auth.verify_id_token(token, app=get_app())
+    except (ValueError, auth.InvalidIdTokenError) as e:
+        raise Unauthorized(f"Invalid Firebase ID token: {e}")
+
+
+def verified_uid(request) -> str:
+    """uid of the request's Firebase ID token (see verified_claims)."""
+    return verified_claims(request)["uid"]
+
+
+def is_admin(claims: Dict[str, Any]) -> bool:
+    return claims.get(ADMIN_CLAIM) is True
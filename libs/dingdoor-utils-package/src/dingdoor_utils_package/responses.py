@@ -0,0 +1,148 @@
+import os
+import gzip
+import hashlib
+from typing import Any, Dict, Mapping, Optional
+
+# Response compression and conditional GETs (see README "Compressed and cacheable responses")
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))  # smaller bodies are sent as-is
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))              # 0-11; 5 is close to gzip speed
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+NO_BODY_STATUSES = (204, 304)
+
+try:  # optional: without the Brotli wheel only gzip is offered
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """`Accept-Encoding` as {coding: q}; codings with q=0 are kept so they can be refused."""
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The coding to use ("br" or "gzip"), or None for identity. Ties prefer br."""
+    accepted = accepted_encodings(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+    offered = (["br"] if brotli is not None else []) + ["gzip"]
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def encode_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def make_etag(body: bytes) -> str:
+    """Weak validator of the uncompressed body, so gzip/br/identity share one ETag."""
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of `If-None-Match` against `etag` (RFC 9110 13.1.2)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+
+def _add_vary(headers, value: str) -> None:
+    current = [v.strip() for v in (headers.get("Vary") or "").split(",") if v.strip()]
+    if value.lower() not in (v.lower() for v in current):
+        headers["Vary"] = ", ".join(current + [value])
+
+
+def _is_streamed(response: Any) -> bool:
+    # Flask: generator bodies; Starlette: StreamingResponse has no `body`
+    return bool(getattr(response, "is_streamed", False)) or not (hasattr(response, "get_data") or hasattr(response, "body"))
+
+
+def _get_body(response: Any) -> bytes:
+    return response.get_data() if hasattr(response, "get_data") else bytes(response.body)
+
+
+def _set_body(response: Any, body: bytes) -> None:
+    if hasattr(response, "set_data"):
+        response.set_data(body)  # also updates Content-Length
+    else:
+        response.body = body
+        response.headers["Content-Length"] = str(len(body))
+
+
+def finalize_response(
+    request: Any,
+    response: Any,
+    cors: Optional[Mapping[str, str]] = None,
+    etag: bool = False,
+    cache_control: Optional[str] = None,
+) -> Any:
+    """
+    Last step for a Flask or Starlette response:
+
+      - `cors` headers are added (the same ones add_cors_headers/add_cors set);
+      - with `etag`, a 200 GET/HEAD gets an ETag and `cache_control` (default
+        "private, no-cache"); a matching `If-None-Match` turns it into an empty 304;
+      - bodies of at least COMPRESS_MIN_BYTES are gzip/br encoded per `Accept-Encoding`.
+
+    Streamed bodies (SSE) pass through untouched apart from the CORS headers.
+    """
+    if cors:
+        response.headers.update(cors)
+    if _is_streamed(response) or response.headers.get("Content-Encoding"):
+        return response
+
+    body = _get_body(response)
+    method = (getattr(request, "method", "") or "").upper()
+    if etag and method in ("GET", "HEAD") and response.status_code == 200:
+        tag = make_etag(body)
+        response.headers["ETag"] = tag
+        response.headers["Cache-Control"] = cache_control or "private, no-cache"
+        _add_vary(response.headers, "Accept-Encoding")
+        if etag_matches(request.headers.get("If-None-Match"), tag):
+            response.status_code = 304
+            _set_body(response, b"")
+            return response
+
+    content_type = (response.headers.get("Content-Type") or "").lower()
+    if (
+        response.status_code in NO_BODY_STATUSES
+        or len(body) < COMPRESS_MIN_BYTES
+        or not content_type.startswith(COMPRESSIBLE_TYPES)
+    ):
+        return response
+    _add_vary(response.headers, "Accept-Encoding")
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    _set_body(response, encode_body(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,56 @@
+import os
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List, Optional
+from .signing_credentials import get_signing_access_token, signing_credentials_stats
+from .timing import register_stats, timed
+
+SIGNED_URL_SA_EMAIL = os.getenv("SIGNED_URL_SA_EMAIL", "bucket-manager-text-assistant@knock24-inc.iam.gserviceaccount.com")
+SIGNED_URL_EXPIRES_HOURS = int(os.getenv("SIGNED_URL_EXPIRES_HOURS", "72"))
+SIGNING_WORKERS = int(os.getenv("SIGNING_WORKERS", "4"))
+
+_storage_client = None
+def get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage  # deferred: text-only requests never touch GCS
+        _storage_client = storage.Client()
+    return _storage_client
+
+_sign_pool = ThreadPoolExecutor(max_workers=SIGNING_WORKERS, thread_name_prefix="signing")
+
+register_stats("signingCredentials", signing_credentials_stats)
+
+
+def signed_url(bucket_name: str, blob_path: str, filename: str) -> Optional[str]:
+    """V4 signed GET URL for a stored attachment, or None if signing fails."""
+    blob = get_storage_client().bucket(bucket_name).blob(blob_path)
+    try:
+        with timed("signed_url"):
+            access_token = get_signing_access_token()
+            return blob.generate_signed_url(
+                version="v4",
+                expiration=timedelta(hours=SIGNED_URL_EXPIRES_HOURS),
+                method="GET",
+                service_account_email=SIGNED_URL_SA_EMAIL,
+                access_token=access_token,  # forces IAM-backed signing (no local key)
+                # shared objects keep the first uploader's name; each message's URL carries its own
+                response_disposition=f'inline; filename="{filename}"',
+            )
+    except Exception as e:
+        logging.warning(f"Could not generate signed URL for {blob_path}: {e}")
+        return None
+
+
+def sign_attachments(bucket_name: str, attachments: List[dict]) -> List[dict]:
+    """Fills in the `url` of attachments that have none (concurrently, in place)."""
+    unsigned = [a for a in attachments if not a.get("url") and a.get("storagePath")]
+    futures = [
+        _sign_pool.submit(contextvars.copy_context().run, signed_url, bucket_name, a["storagePath"], a.get("filename"))
+        for a in unsigned
+    ]
+    for a, f in zip(unsigned, futures):
+        a["url"] = f.result()
+    return attachments
@@ -0,0 +1,48 @@
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+# IMPORTANT: request a token with the right scopes for IAMCredentials.signBlob
+SIGNING_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]  # or "https://www.googleapis.com/auth/iam"
+# refresh this long before the token actually expires
+SIGNING_TOKEN_REFRESH_MARGIN = timedelta(seconds=int(os.getenv("SIGNING_TOKEN_REFRESH_MARGIN_SECONDS", "300")))
+
+_creds = None
+_auth_request = None
+_lock = threading.Lock()
+_stats = {"hits": 0, "refreshes": 0}
+
+
+def _is_fresh(creds) -> bool:
+    if not creds.token or not creds.expiry:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - SIGNING_TOKEN_REFRESH_MARGIN > now
+
+
+def get_signing_access_token() -> str:
+    """
+    Returns an access token for IAM-backed URL signing, cached process-wide.
+
+    The token is reused until SIGNING_TOKEN_REFRESH_MARGIN before expiry; when
+    concurrent uploads race on a stale token only the first one refreshes it.
+    """
+    global _creds, _auth_request
+    with _lock:
+        if _creds is None:
+            import google.auth
+            from google.auth.transport.requests import Request
+            _creds, _ = google.auth.default(scopes=SIGNING_SCOPES)
+            _auth_request = Request()
+        if _is_fresh(_creds):
+            _stats["hits"] += 1
+        else:
+            _creds.refresh(_auth_request)
+            _stats["refreshes"] += 1
+        return _creds.token
+
+
+def signing_credentials_stats() -> dict:
+    with _lock:
+        return dict(_stats)
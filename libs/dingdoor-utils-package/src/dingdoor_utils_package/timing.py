@@ -0,0 +1,165 @@
+import os
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# Server-Timing header + one structured log line per request; cheap enough to leave on
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+
+_current: ContextVar[Optional["RequestTimer"]] = ContextVar("request_timer", default=None)
+
+# instance-wide counters (caches, breakers, queues) logged with every timing record
+_stats_sources: Dict[str, Callable[[], Any]] = {}
+
+
+def register_stats(name: str, source: Callable[[], Any]) -> None:
+    """Adds `source()` to every timing record of this instance as `stats.<name>`."""
+    _stats_sources[name] = source
+
+
+def collect_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = {}
+    for name, source in list(_stats_sources.items()):
+        try:
+            stats[name] = source()
+        except Exception as e:  # a broken counter must not cost the request its log line
+            stats[name] = {"error": str(e)}
+    return stats
+
+
+class RequestTimer:
+    """
+    Stage durations of one request. Stages may run on other threads (stage graph,
+    upload pool); durations of a stage that runs more than once (e.g. one signed URL
+    per file) are summed, so concurrent stages can add up to more than `total`.
+    """
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.fields: Dict[str, Any] = {}
+        self.deferred = False  # emit() is left to whoever streams the response body
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        """`Server-Timing` header value: one metric per stage plus `total`, in ms."""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(parts)
+
+    def emit(self, status: Optional[int] = None, **fields: Any) -> None:
+        """Writes the request's timing as one JSON line (parsed by Cloud Logging as jsonPayload)."""
+        with self._lock:
+            stages = {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+            repeated = {name: n for name, n in self.counts.items() if n > 1}
+        record = {
+            "severity": "INFO",
+            "message": f"{self.handler} timing",
+            "handler": self.handler,
+            "status": status,
+            "totalMs": round(self.total_ms(), 1),
+            "stagesMs": stages,
+            **self.fields,
+            **fields,
+        }
+        if repeated:
+            record["stageCounts"] = repeated
+        stats = collect_stats()
+        if stats:
+            record["stats"] = stats
+        sys.stdout.write(json.dumps(record, default=str) + "\n")
+        sys.stdout.flush()
+
+
+def current_timer() -> Optional[RequestTimer]:
+    return _current.get()
+
+
+@contextmanager
+def request_timer(handler: str) -> Iterator[Optional[RequestTimer]]:
+    """Makes a RequestTimer current for the block (None when SERVER_TIMING is off)."""
+    timer = RequestTimer(handler) if SERVER_TIMING else None
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def use_timer(timer: Optional[RequestTimer]) -> Iterator[None]:
+    """Re-enters a request's timer where the context was lost (e.g. a streamed response body)."""
+    token = _current.set(timer)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def defer_emit() -> Optional[RequestTimer]:
+    """
+    For responses that outlive the handler (streamed bodies): marks the current timer
+    so the handler does not log it, and returns it for the stream to emit() when done.
+    """
+    timer = _current.get()
+    if timer is not None:
+        timer.deferred = True
+    return timer
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Times the block (or, as `@timed("stage")`, the decorated function) into the current
+    request's timer; a no-op outside a request or with SERVER_TIMING off.
+    """
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(stage):
+        yield
+
+
+def annotate(**fields: Any) -> None:
+    """Adds fields to the current request's timing log record."""
+    timer = _current.get()
+    if timer is not None:
+        with timer._lock:
+            timer.fields.update(fields)
+
+
+def finish_request(timer: Optional[RequestTimer], response: Any) -> Any:
+    """
+    Adds the `Server-Timing` header to a Flask or Starlette response and logs the
+    timing record, unless a streamed body has taken that over (defer_emit).
+    """
+    if timer is None:
+        return response
+    response.headers["Server-Timing"] = timer.server_timing()
+    if not timer.deferred:
+        timer.emit(status=response.status_code)
+    return response
@@ -0,0 +1,150 @@
+import os
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+from google.cloud.firestore import Increment
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# Token usage rollups, maintained in the same batch as the turn (see README "Token usage rollups")
+TOKEN_USAGE_COLLECTION = os.getenv("AI_ASSISTANT_TOKEN_USAGE_COLLECTION", "aiAssistantTokenUsage")
+TOKEN_USAGE_SHARDS = int(os.getenv("TOKEN_USAGE_SHARDS", "4"))                 # per user and day
+TOKEN_USAGE_GLOBAL_SHARDS = int(os.getenv("TOKEN_USAGE_GLOBAL_SHARDS", "20"))  # all users, per day
+TOKEN_USAGE_TIMEZONE = ZoneInfo(os.getenv("TOKEN_USAGE_TIMEZONE", "UTC"))      # where a "day" starts
+TOKEN_USAGE_MAX_DAYS = int(os.getenv("TOKEN_USAGE_MAX_DAYS", "92"))            # longest range a read may ask for
+
+GLOBAL_USER = "_all"                   # userId of the all-users daily counters
+CHAT_TOTALS_FIELD = "tokenUsageTotals"  # per-chat totals on the aiAssistantChats document
+CHAT_TURNS_FIELD = "tokenUsageTurns"
+
+
+def usage_counters(token_usage: Any) -> Dict[str, float]:
+    """
+    Numeric counters of a turn's `tokenUsage` (whatever the upstream reports, e.g.
+    promptTokens/completionTokens/totalTokens). Nested maps are flattened with "_";
+    anything non-numeric is ignored.
+    """
+    counters: Dict[str, float] = {}
+
+    def _walk(value: Any, prefix: str) -> None:
+        if isinstance(value, dict):
+            for key, inner in value.items():
+                name = str(key).replace(".", "_").replace("/", "_")
+                _walk(inner, f"{prefix}_{name}" if prefix else name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and prefix:
+            counters[prefix] = value
+
+    _walk(token_usage, "")
+    return counters
+
+
+def usage_day(ts_ms: Optional[int] = None) -> str:
+    """YYYY-MM-DD of `ts_ms` (default now) in TOKEN_USAGE_TIMEZONE."""
+    ts = (ts_ms / 1000) if ts_ms else time.time()
+    return datetime.fromtimestamp(ts, tz=timezone.utc).astimezone(TOKEN_USAGE_TIMEZONE).date().isoformat()
+
+
+def _safe_id(value: str) -> str:
+    return str(value).replace("/", "_")
+
+
+def _shard_ref(db, user_id: str, day: str, shard: int):
+    return db.collection(TOKEN_USAGE_COLLECTION).document(f"{_safe_id(user_id)}_{day}_{shard}")
+
+
+def chat_usage_fields(counters: Dict[str, float], field_paths: bool = False) -> Dict[str, Any]:
+    """
+    Increments for the chat document, to add to its metadata write. `field_paths`
+    spells the totals as `tokenUsageTotals.<name>` paths, as update() replaces whole maps.
+    """
+    if field_paths:
+        return {
+            **{FieldPath(CHAT_TOTALS_FIELD, name).to_api_repr(): Increment(value) for name, value in counters.items()},
+            CHAT_TURNS_FIELD: Increment(1),
+        }
+    return {
+        CHAT_TOTALS_FIELD: {name: Increment(value) for name, value in counters.items()},
+        CHAT_TURNS_FIELD: Increment(1),
+    }
+
+
+def stage_daily_usage(batch, db, user_id: str, counters: Dict[str, float], ts_ms: Optional[int] = None) -> None:
+    """
+    Adds the turn's counters to one random shard of the user's daily document and of
+    the all-users daily document. Shards keep a busy day under Firestore's sustained
+    write rate per document; readers add the shards up.
+    """
+    day = usage_day(ts_ms)
+    now = int(time.time() * 1000)
+    for uid, shards in ((user_id, TOKEN_USAGE_SHARDS), (GLOBAL_USER, TOKEN_USAGE_GLOBAL_SHARDS)):
+        shard = random.randrange(max(1, shards))
+        batch.set(_shard_ref(db, uid, day, shard), {
+            "userId": uid,
+            "day": day,
+            "shard": shard,
+            "updatedAt": now,
+            "turns": Increment(1),
+            "tokens": {name: Increment(value) for name, value in counters.items()},
+        }, merge=True)
+
+
+def _add(into: Dict[str, float], counters: Dict[str, Any]) -> None:
+    for name, value in (counters or {}).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            into[name] = into.get(name, 0) + value
+
+
+def parse_day_range(day_from: Optional[str], day_to: Optional[str]) -> Tuple[str, str]:
+    """Validated (from, to) days; defaults to the current month up to today. Raises ValueError."""
+    today = date.fromisoformat(usage_day())
+    end = date.fromisoformat(day_to) if day_to else today
+    start = date.fromisoformat(day_from) if day_from else end.replace(day=1)
+    if start > end:
+        raise ValueError("'from' must not be after 'to'")
+    if (end - start) > timedelta(days=TOKEN_USAGE_MAX_DAYS - 1):
+        raise ValueError(f"Range is limited to {TOKEN_USAGE_MAX_DAYS} days")
+    return start.isoformat(), end.isoformat()
+
+
+def read_daily_usage(db, user_id: str, day_from: str, day_to: str) -> Dict[str, Any]:
+    """
+    Sums the daily shards of `user_id` (GLOBAL_USER for everyone) between two days,
+    inclusive: one indexed query reading at most days x shards documents.
+    """
+    docs = (
+        db.collection(TOKEN_USAGE_COLLECTION)
+        .where(filter=FieldFilter("userId", "==", user_id))
+        .where(filter=FieldFilter("day", ">=", day_from))
+        .where(filter=FieldFilter("day", "<=", day_to))
+        .get()
+    )
+    days: Dict[str, Dict[str, Any]] = {}
+    totals: Dict[str, float] = {}
+    turns = 0
+    for doc in docs:
+        d = doc.to_dict() or {}
+        entry = days.setdefault(d.get("day"), {"day": d.get("day"), "turns": 0, "tokens": {}})
+        entry["turns"] += d.get("turns") or 0
+        _add(entry["tokens"], d.get("tokens"))
+        _add(totals, d.get("tokens"))
+        turns += d.get("turns") or 0
+    return {
+        "from": day_from,
+        "to": day_to,
+        "turns": turns,
+        "totals": totals,
+        "days": [days[day] for day in sorted(days)],
+    }
+
+
+def read_chat_usage(chat_snapshot) -> Dict[str, Any]:
+    d = chat_snapshot.to_dict() or {}
+    return {
+        "chatId": chat_snapshot.id,
+        "userId": d.get("userId"),
+        "turns": d.get(CHAT_TURNS_FIELD) or 0,
+        "totals": d.get(CHAT_TOTALS_FIELD) or {},
+    }
+
@@ -0,0 +1,66 @@
+import os
+import io
+import hashlib
+import uuid
+import mimetypes
+from typing import IO, List, Tuple
+
+FileTuple = Tuple[str, IO[bytes], str]  # (filename, stream, content_type)
+
+# whole request body, checked against Content-Length before the form is parsed
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))
+MAX_UPLOAD_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", str(25 * 1024 * 1024)))
+
+
+class UploadTooLarge(ValueError):
+    """Raised when the request or one of its files exceeds the configured limits."""
+
+
+def check_request_size(req) -> None:
+    """
+    Rejects oversized requests before any body byte is read and caps what
+    Werkzeug will read for bodies without a Content-Length.
+    """
+    if req.content_length is not None and req.content_length > MAX_REQUEST_BYTES:
+        raise UploadTooLarge(f"Request body exceeds {MAX_REQUEST_BYTES} bytes")
+    try:
+        req.max_content_length = MAX_REQUEST_BYTES  # per request since Flask 3.1
+    except AttributeError:
+        # older Flask: a read-only property backed by the app config (same limit for every request)
+        from flask import current_app
+        current_app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+
+
+def stream_size(stream: IO[bytes]) -> int:
+    """Size of a seekable stream; leaves it rewound to the start."""
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def stream_sha256(stream: IO[bytes], chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a seekable stream, read in chunks; leaves it rewound to the start."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def collect_uploads(incoming) -> List[FileTuple]:
+    """
+    Turns Werkzeug FileStorage objects into (filename, stream, content_type) without
+    reading them into memory. Werkzeug already spools file parts over 500 KB to a
+    temporary file, so the streams stay disk-backed until they are sent on.
+    """
+    file_list = []
+    for f in incoming:
+        size = stream_size(f.stream)
+        if size > MAX_UPLOAD_FILE_BYTES:
+            raise UploadTooLarge(f"File '{f.filename}' exceeds {MAX_UPLOAD_FILE_BYTES} bytes")
+        ctype = f.content_type or (mimetypes.guess_type(f.filename)[0] or "application/octet-stream")
+        fname = f.filename or f"upload-{uuid.uuid4().hex}"
+        file_list.append((fname, f.stream, ctype))
+    return file_list
@@ -0,0 +1,75 @@
+"""
+Sets `isCxInteraction` on chat messages written before the field existed.
+
+The send function reads history with `isCxInteraction == False` (tail query, see
+firestore.indexes.json), so a message without the field is never part of the
+history the assistant gets. Messages missing it are set to False (they were treated
+as assistant-visible before the tail query), or to True when their role is neither
+`user` nor `assistant` (CX replies, system events).
+
+Every message of the `messages` collection group is scanned (Firestore cannot query
+for a missing field), reading only `isCxInteraction` and `role`, in pages ordered
+by document name; writes go out in batches of --batch-size. Re-running it is safe.
+
+Usage:
+  python scripts/backfill_is_cx_interaction.py --project dingdoor-development --dry-run
+  python scripts/backfill_is_cx_interaction.py --project dingdoor-development
+
+Needs google-cloud-firestore and application default credentials (or FIRESTORE_EMULATOR_HOST).
+"""
+import argparse
+
+from google.cloud import firestore
+
+AI_ROLES = ("user", "assistant")
+
+
+def backfill(db, page_size: int, batch_size: int, dry_run: bool) -> dict:
+    counts = {"scanned": 0, "missing": 0, "setTrue": 0}
+    query = db.collection_group("messages").order_by("__name__").select(["isCxInteraction", "role"])
+    batch, staged, last = db.batch(), 0, None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.limit(page_size).get())
+        for doc in docs:
+            counts["scanned"] += 1
+            data = doc.to_dict() or {}
+            if "isCxInteraction" in data:
+                continue
+            is_cx = data.get("role") not in AI_ROLES
+            counts["missing"] += 1
+            counts["setTrue"] += int(is_cx)
+            if dry_run:
+                continue
+            batch.update(doc.reference, {"isCxInteraction": is_cx})
+            staged += 1
+            if staged == batch_size:
+                batch.commit()
+                batch, staged = db.batch(), 0
+        if len(docs) < page_size:
+            break
+        last = docs[-1]
+        print(f"... {counts['scanned']} scanned, {counts['missing']} missing the field")
+    if staged:
+        batch.commit()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--project", help="GCP project (default: from the environment)")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=400)
+    parser.add_argument("--dry-run", action="store_true", help="count the messages to fix, write nothing")
+    args = parser.parse_args()
+
+    counts = backfill(firestore.Client(project=args.project), args.page_size, args.batch_size, args.dry_run)
+    action = "would be set" if args.dry_run else "set"
+    print(
+        f"{counts['scanned']} messages scanned; isCxInteraction {action} on {counts['missing']} "
+        f"({counts['setTrue']} to true)"
+    )
+
+
+if __name__ == "__main__":
+    main()
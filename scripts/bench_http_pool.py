@@ -0,0 +1,133 @@
+"""
+Upstream call benchmark for the send function's pooled HTTP session (utils/http_client.py).
+
+Starts a local keep-alive stub server (HTTPS with a throwaway self-signed cert when
+`openssl` is available, so the TLS handshake is part of what is measured) and posts
+the same JSON body N times, first with a bare `requests.post` per call (what
+AiChatService did before), then through get_http_session(). Reports latency per call
+and how many connections the stub accepted.
+
+Usage:
+  python scripts/bench_http_pool.py
+  python scripts/bench_http_pool.py --calls 200 --delay-ms 5 --plain-http
+"""
+import argparse
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "functions", "ai_send_text_assistant_message"))
+
+import requests  # noqa: E402
+from utils.http_client import get_http_session  # noqa: E402
+
+REPLY = json.dumps({"id": "bench-chat", "message": "Hello! " * 50, "cta": "", "tokenUsage": {"totalTokens": 120}}).encode()
+
+
+class _StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # one write per response and no Nagle: otherwise delayed ACKs add ~40 ms to every reused connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    delay_seconds = 0.0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        with _StubHandler.lock:
+            _StubHandler.connections += 1
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(REPLY)))
+        self.end_headers()
+        self.wfile.write(REPLY)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _self_signed_context(workdir):
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def _run(post, url, calls):
+    _StubHandler.connections = 0
+    latencies = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        response = post(url, json={"message": "hi", "previousMessages": []}, verify=False, timeout=30)
+        response.raise_for_status()
+        response.json()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, _StubHandler.connections
+
+
+def _report(name, latencies, connections):
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<8} mean {statistics.mean(latencies):7.2f} ms   p50 {statistics.median(latencies):7.2f} ms   "
+          f"p95 {p95:7.2f} ms   connections {connections}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=100, help="POSTs per variant")
+    parser.add_argument("--delay-ms", type=float, default=0, help="stub processing time per call")
+    parser.add_argument("--plain-http", action="store_true", help="skip TLS even if openssl is available")
+    args = parser.parse_args(argv)
+
+    _StubHandler.delay_seconds = args.delay_ms / 1000
+    server = _StubServer(("127.0.0.1", 0), _StubHandler)
+    with tempfile.TemporaryDirectory() as workdir:
+        context = None if args.plain_http else _self_signed_context(workdir)
+        if context is not None:
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"{'https' if context else 'http'}://127.0.0.1:{server.server_address[1]}/chat"
+        print(f"{args.calls} POSTs to {url}")
+
+        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+        bare = _run(requests.post, url, args.calls)
+        pooled = _run(get_http_session().post, url, args.calls)
+        server.shutdown()
+
+    _report("bare", *bare)
+    _report("pooled", *pooled)
+    saved = statistics.mean(bare[0]) - statistics.mean(pooled[0])
+    print(f"pooled saves {saved:.2f} ms per call ({saved / statistics.mean(bare[0]) * 100:.0f}%)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
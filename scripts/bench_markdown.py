@@ -0,0 +1,81 @@
+"""
+CPU per turn of markdown rendering: markdown.markdown() (a new Markdown instance and
+extension registry per call) against utils/markdown_renderer.render_markdown, both
+uncached (a new reply every call) and cached (the same text again, e.g. a retried turn).
+
+The inputs are assistant-style replies: headings, numbered steps, bullet lists,
+bold/links and a code block, from a short answer up to a long ~7 KB one.
+
+Usage:
+  python scripts/bench_markdown.py
+  python scripts/bench_markdown.py --repeat 500
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "functions", "ai_send_text_assistant_message"))
+
+import markdown  # noqa: E402
+from utils.markdown_renderer import render_markdown  # noqa: E402
+
+SECTION = """## {n}. Checking the thermostat
+
+Before we send a technician, a few things are worth checking. **Most no-cooling calls**
+are fixed by one of these steps:
+
+1. Make sure the thermostat is set to *Cool* and the setpoint is below room temperature.
+2. Replace the batteries if the display is blank or dim.
+3. Check the breaker labelled **AC** or **HVAC** in your electrical panel.
+
+- Filters should be replaced every 1-3 months; a clogged filter can freeze the coil.
+- If you see ice on the copper lines, turn the system *off* and set the fan to **On** for two hours.
+- Our [maintenance plans](https://example.com/plans) include two visits a year.
+
+```
+Model: XR-{n}00   Serial: 4821-{n}   Installed: 2019
+```
+
+If none of this helps, reply with a photo of the outdoor unit and we will book a visit.
+"""
+
+SHORT = "Sure! Your appointment is on **Tuesday at 10am**. Reply *change* to pick another time."
+
+
+def _replies():
+    return {
+        "short (~90 B)": SHORT,
+        "medium (~0.8 KB)": SECTION.format(n=1),
+        "long (~7 KB)": "\n".join(SECTION.format(n=n) for n in range(1, 10)),
+    }
+
+
+def _per_call_ms(fn, texts):
+    started = time.perf_counter()
+    for text in texts:
+        fn(text)
+    return (time.perf_counter() - started) * 1000 / len(texts)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=200, help="renders per input and variant")
+    args = parser.parse_args(argv)
+
+    uncached = render_markdown.__wrapped__  # the per-thread renderer without the LRU cache
+    print(f"{'input':<16}{'markdown.markdown':>20}{'renderer':>12}{'cached':>12}")
+    for name, text in _replies().items():
+        assert render_markdown(text) == markdown.markdown(text)
+        # a distinct text per call so neither variant benefits from the cache
+        texts = [f"{text}\n\n<!-- {i} -->" for i in range(args.repeat)]
+        baseline = _per_call_ms(markdown.markdown, texts)
+        reused = _per_call_ms(uncached, texts)
+        cached = _per_call_ms(render_markdown, [text] * args.repeat)
+        print(f"{name:<16}{baseline:>17.3f} ms{reused:>9.3f} ms{cached:>9.4f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
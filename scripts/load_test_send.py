@@ -0,0 +1,171 @@
+"""
+Load test for ai_send_text_assistant_message: concurrent turns one instance keeps in
+flight, sync (Flask) handler against the asyncio handler (TEXT_ASSISTANT_ASYNC=true).
+
+A local stub stands in for the assistant service and answers every turn after
+--upstream-ms, like the LLM does; it records how many calls it is serving at once,
+which is the number of turns the instance has in flight. Each mode starts the
+function with functions-framework in its own process, fires --turns turns from
+--concurrency client threads, and reports throughput and the peak.
+
+The sync mode runs with THREADS=1 by default (one request per instance, the Cloud
+Run functions default); pass --sync-threads to model a higher concurrency setting.
+Turns are written to Firestore, so point it at the emulator (make emu-firestore).
+
+Usage:
+  FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 python scripts/load_test_send.py
+  python scripts/load_test_send.py --turns 200 --concurrency 50 --upstream-ms 3000 --modes async
+"""
+import argparse
+import http.server
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTION_DIR = os.path.join(ROOT, "functions", "ai_send_text_assistant_message")
+
+
+class _Upstream(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    delay_seconds = 1.0
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with _Upstream.lock:
+            _Upstream.in_flight += 1
+            _Upstream.peak = max(_Upstream.peak, _Upstream.in_flight)
+        try:
+            time.sleep(self.delay_seconds)
+        finally:
+            with _Upstream.lock:
+                _Upstream.in_flight -= 1
+        body = json.dumps({
+            "id": f"load-{uuid.uuid4()}",  # a new chat per turn: no history to load
+            "message": "Thanks! A technician can visit **tomorrow at 10am**.",
+            "cta": "",
+            "tokenUsage": {"promptTokens": 900, "completionTokens": 40, "totalTokens": 940},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _UpstreamServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_function(mode: str, port: int, upstream_url: str, sync_threads: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        AI_TEXT_ASSISTANT_URL=upstream_url,
+        AI_REQUEST_ENHANCED_URL=upstream_url,
+        AI_HUMAN_HANDOFF_URL=upstream_url,
+        TEXT_ASSISTANT_ASYNC="true" if mode == "async" else "false",
+        THREADS=str(sync_threads),
+        WRITE_BEHIND="false",
+    )
+    env.setdefault("GOOGLE_CLOUD_PROJECT", "dingdoor-development")
+    cmd = ["functions-framework", "--target", "ai_send_text_assistant_message", "--host", "127.0.0.1", "--port", str(port)]
+    if mode == "async":
+        cmd.append("--asgi")
+    proc = subprocess.Popen(cmd, cwd=FUNCTION_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"functions-framework ({mode}) exited with code {proc.returncode}")
+        try:
+            requests.options(f"http://127.0.0.1:{port}/", timeout=1)
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"functions-framework ({mode}) did not start within 60 s")
+
+
+def _run_mode(mode: str, args, upstream_url: str) -> dict:
+    port = _free_port()
+    proc = _start_function(mode, port, upstream_url, args.sync_threads)
+    url = f"http://127.0.0.1:{port}/"
+    _Upstream.peak = 0
+    statuses = Counter()
+
+    def turn(i):
+        try:
+            response = requests.post(url, json={"userId": "load-test-user", "message": f"Is anyone available? ({i})"}, timeout=args.timeout)
+            statuses[response.status_code] += 1
+        except requests.RequestException as e:
+            statuses[type(e).__name__] += 1
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(turn, range(args.turns)))
+        elapsed = time.perf_counter() - started
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    return {"mode": mode, "seconds": elapsed, "statuses": dict(statuses), "peak": _Upstream.peak}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=25, help="client threads posting turns")
+    parser.add_argument("--upstream-ms", type=float, default=2000, help="stub assistant latency per turn")
+    parser.add_argument("--sync-threads", type=int, default=1, help="THREADS for the sync handler's server")
+    parser.add_argument("--modes", nargs="+", choices=("sync", "async"), default=["sync", "async"])
+    parser.add_argument("--timeout", type=float, default=600, help="client timeout per turn, seconds")
+    args = parser.parse_args(argv)
+
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        print("FIRESTORE_EMULATOR_HOST is not set: turns would be written to a real project (see make emu-firestore)")
+        return 1
+
+    _Upstream.delay_seconds = args.upstream_ms / 1000
+    upstream = _UpstreamServer(("127.0.0.1", 0), _Upstream)
+    threading.Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_address[1]}/chat"
+
+    print(f"{args.turns} turns, {args.concurrency} clients, upstream {args.upstream_ms:.0f} ms")
+    print(f"{'mode':<8}{'seconds':>9}{'turns/s':>10}{'peak in flight':>16}  statuses")
+    for mode in args.modes:
+        result = _run_mode(mode, args, upstream_url)
+        print(f"{mode:<8}{result['seconds']:>9.1f}{args.turns / result['seconds']:>10.2f}{result['peak']:>16}  {result['statuses']}")
+    upstream.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
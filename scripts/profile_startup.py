@@ -0,0 +1,144 @@
+"""
+Cold-start profiler for the functions under functions/.
+
+For each function a fresh interpreter is started in the function's folder with
+`python -X importtime`, `main` is imported (what the Functions Framework does on
+a cold start), and every lazy client getter found in the function's own modules
+(`get_*_client`, `get_*_session`, ...) is called once to time client creation.
+
+Usage:
+  python scripts/profile_startup.py                                   # every function
+  python scripts/profile_startup.py ai_send_text_assistant_message --top 20
+  make profile-startup FN=ai_send_text_assistant_message
+
+Run it with the env the function needs (e.g. FIRESTORE_EMULATOR_HOST,
+GOOGLE_CLOUD_PROJECT, the AI_* URLs); import or client errors are reported, not raised.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS_DIR = os.path.join(ROOT, "functions")
+
+# runs inside the function folder; prints one JSON line on stdout
+_CHILD = r'''
+import inspect, json, os, re, sys, time
+sys.path.insert(0, os.getcwd())
+getter = re.compile(r"^_?get_\w*(client|session)$")
+out = {"importMs": None, "error": None, "clients": {}}
+t0 = time.perf_counter()
+try:
+    import main
+except Exception as e:
+    out["error"] = repr(e)
+out["importMs"] = round((time.perf_counter() - t0) * 1000, 1)
+if out["error"] is None:
+    root = os.getcwd()
+    for mod_name, mod in sorted(sys.modules.items()):
+        path = getattr(mod, "__file__", None) or ""
+        if not path.startswith(root):
+            continue
+        for attr, fn in sorted(vars(mod).items()):
+            if not (inspect.isfunction(fn) and fn.__module__ == mod_name and getter.match(attr)):
+                continue
+            params = inspect.signature(fn).parameters.values()
+            if any(p.default is p.empty and p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD) for p in params):
+                continue
+            t1 = time.perf_counter()
+            try:
+                fn()
+                result = {"ms": round((time.perf_counter() - t1) * 1000, 1)}
+            except Exception as e:
+                result = {"ms": round((time.perf_counter() - t1) * 1000, 1), "error": repr(e)}
+            out["clients"][f"{mod_name}.{attr}"] = result
+print("__PROFILE__" + json.dumps(out))
+'''
+
+
+def _parse_importtime(stderr: str):
+    """Returns [(module, self_us, cumulative_us, depth)] from `-X importtime` output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        name_col = parts[2].rstrip()
+        depth = (len(name_col) - len(name_col.lstrip())) // 2
+        rows.append((name_col.strip(), int(parts[0]), int(parts[1]), depth))
+    return rows
+
+
+def _package_of(module: str) -> str:
+    # namespace packages are grouped one level deeper (google.cloud.firestore, not google)
+    parts = module.split(".")
+    depth = 3 if parts[0] == "google" and len(parts) > 2 and parts[1] == "cloud" else 2 if parts[0] == "google" else 1
+    return ".".join(parts[:depth])
+
+
+def profile_function(fn_name: str) -> dict:
+    fn_dir = os.path.join(FUNCTIONS_DIR, fn_name)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD],
+        cwd=fn_dir, capture_output=True, text=True, timeout=300,
+    )
+    report = {"function": fn_name, "importMs": None, "error": None, "clients": {}, "modules": []}
+    for line in proc.stdout.splitlines():
+        if line.startswith("__PROFILE__"):
+            report.update(json.loads(line[len("__PROFILE__"):]))
+    if report["importMs"] is None:
+        report["error"] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}"
+
+    rows = _parse_importtime(proc.stderr)
+    main_at = next((i for i, row in enumerate(rows) if row[0] == "main"), None)
+    if main_at is not None:
+        # -X importtime prints children before their parent: main's subtree is the
+        # contiguous block of deeper rows right above it
+        main_depth = rows[main_at][3]
+        start = main_at
+        while start > 0 and rows[start - 1][3] > main_depth:
+            start -= 1
+        by_package = {}
+        for name, own, _, _ in rows[start:main_at + 1]:
+            by_package[_package_of(name)] = by_package.get(_package_of(name), 0) + own
+        report["modules"] = sorted(
+            ({"module": name, "selfMs": round(us / 1000, 1)} for name, us in by_package.items()),
+            key=lambda m: m["selfMs"], reverse=True,
+        )
+    return report
+
+
+def _print_report(report: dict, top: int) -> None:
+    print(f"== {report['function']}")
+    print(f"   import main: {report['importMs']} ms" + (f"  (error: {report['error']})" if report["error"] else ""))
+    for m in report["modules"][:top]:
+        print(f"   {m['selfMs']:>9.1f} ms  {m['module']}")
+    for name, c in report["clients"].items():
+        print(f"   client {name}: {c['ms']} ms" + (f"  (error: {c['error']})" if "error" in c else ""))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("functions", nargs="*", help="function folders under functions/ (default: all)")
+    parser.add_argument("--top", type=int, default=10, help="packages to list per function, by import time")
+    parser.add_argument("--json", action="store_true", help="print the raw reports as JSON")
+    args = parser.parse_args(argv)
+
+    names = args.functions or sorted(
+        d for d in os.listdir(FUNCTIONS_DIR) if os.path.isfile(os.path.join(FUNCTIONS_DIR, d, "main.py"))
+    )
+    reports = [profile_function(name) for name in names]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            _print_report(report, args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())